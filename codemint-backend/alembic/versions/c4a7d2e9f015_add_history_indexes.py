@@ -0,0 +1,35 @@
+"""Add history lookup indexes
+
+Revision ID: c4a7d2e9f015
+Revises: 3b8e1f0c9d27
+Create Date: 2026-10-18 10:02:17.644190
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4a7d2e9f015'
+down_revision: Union[str, None] = '3b8e1f0c9d27'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Build the indexes without locking out writes on large, live tables (PostgreSQL only;
+    # CONCURRENTLY cannot run inside a transaction, hence the autocommit block)
+    with op.get_context().autocommit_block():
+        op.create_index('ix_messages_conversation_id_created_at', 'messages', ['conversation_id', 'created_at'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_messages_conversation_id_id', 'messages', ['conversation_id', 'id'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_conversations_session_id_updated_at', 'conversations', ['session_id', 'updated_at'], unique=False, postgresql_concurrently=True)
+        op.create_index(op.f('ix_sessions_user_id'), 'sessions', ['user_id'], unique=False, postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(op.f('ix_sessions_user_id'), table_name='sessions', postgresql_concurrently=True)
+        op.drop_index('ix_conversations_session_id_updated_at', table_name='conversations', postgresql_concurrently=True)
+        op.drop_index('ix_messages_conversation_id_id', table_name='messages', postgresql_concurrently=True)
+        op.drop_index('ix_messages_conversation_id_created_at', table_name='messages', postgresql_concurrently=True)
@@ -0,0 +1,238 @@
+import os
+import json
+import math
+import time
+import asyncio
+import logging
+import ipaddress
+from collections import OrderedDict
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Requests allowed to run at once, how many may wait for a slot, and for how long
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "128"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "256"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "2"))
+# Per-caller token bucket, in estimated prompt tokens
+ADMISSION_BUCKET_SIZE = float(os.getenv("ADMISSION_BUCKET_SIZE", "20000"))
+ADMISSION_REFILL_RATE = float(os.getenv("ADMISSION_REFILL_RATE", "400"))
+# Fixed charge per request on top of its own text, standing in for history and the reply
+ADMISSION_BASE_COST = float(os.getenv("ADMISSION_BASE_COST", "250"))
+ADMISSION_MAX_CALLERS = int(os.getenv("ADMISSION_MAX_CALLERS", "100000"))
+# Only these POST routes are admission controlled; reads and stats are never shed. The
+# /chat/ws WebSocket is admitted per message by its handler (see admit_message).
+ADMISSION_PATHS = set(os.getenv("ADMISSION_PATHS", "/chat,/chat/stream,/generate,/optimize,/debug,/batch").split(","))
+# Peers (addresses or CIDR blocks) trusted to name the caller in X-User-Id, e.g. the
+# authenticating proxy in front of the app; anyone else is keyed by their own address
+ADMISSION_TRUSTED_PROXIES = [ipaddress.ip_network(entry.strip(), strict=False) for entry in os.getenv("ADMISSION_TRUSTED_PROXIES", "").split(",") if entry.strip()]
+
+
+class TokenBucket:
+    def __init__(self, size, rate):
+        self.size = size
+        self.rate = rate
+        self.tokens = size
+        self.updated_at = time.monotonic()
+
+    def take(self, amount):
+        # Returns 0 when admitted, otherwise the seconds until `amount` would be available
+        now = time.monotonic()
+        self.tokens = min(self.size, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        # A request bigger than the whole bucket is admitted once the bucket is full
+        amount = min(amount, self.size)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def refund(self, amount):
+        self.tokens = min(self.size, self.tokens + amount)
+
+
+def estimate_tokens(body: bytes, query_string: bytes):
+    # About four characters per token; a batch costs its text once per operation
+    weight = (len(body) + len(query_string)) / 4
+    try:
+        payload = json.loads(body) if body else None
+    except ValueError:
+        payload = None
+    if isinstance(payload, dict) and isinstance(payload.get("operations"), list):
+        weight *= max(1, len(payload["operations"]))
+    return ADMISSION_BASE_COST + weight, payload
+
+
+def trusted_proxy(host):
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in ADMISSION_TRUSTED_PROXIES)
+
+
+def caller_key(scope):
+    # Never from anything the client can choose freely: the authenticated user when an auth
+    # middleware has set one, X-User-Id only from a trusted proxy, otherwise the peer address
+    user = scope.get("user")
+    if getattr(user, "is_authenticated", False):
+        return "user:" + str(user.identity)
+    client = scope.get("client")
+    if client and trusted_proxy(client[0]):
+        user_id = dict(scope.get("headers") or []).get(b"x-user-id")
+        if user_id:
+            return "user:" + user_id.decode("latin-1")
+    return f"ip:{client[0]}" if client else "anonymous"
+
+
+class AdmissionController:
+    def __init__(self, max_concurrent=ADMISSION_MAX_CONCURRENT, max_queue=ADMISSION_MAX_QUEUE, queue_timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._slots = None
+        self._buckets = OrderedDict()
+        self.in_flight = 0
+        self.waiting = 0
+        self.counters = {"admitted": 0, "queued": 0, "rate_limited": 0, "queue_full": 0, "queue_timeout": 0}
+
+    def _bucket(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(ADMISSION_BUCKET_SIZE, ADMISSION_REFILL_RATE)
+            if len(self._buckets) > ADMISSION_MAX_CALLERS:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    async def __call__(self, app, scope, receive, send):
+        # Read the body up front to weigh the request; the app gets it replayed below
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] != "http.request":
+                return
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        body = b"".join(chunks)
+        cost, _ = estimate_tokens(body, scope.get("query_string", b""))
+
+        rejected, retry_after = await self.admit(caller_key(scope), cost)
+        if rejected:
+            await self._reject(send, rejected, retry_after)
+            return
+
+        replayed = False
+
+        async def replay():
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        try:
+            await app(scope, replay, send)
+        finally:
+            self.release()
+
+    async def admit(self, key, cost):
+        # Charges the caller's bucket and waits (briefly) for a slot. Returns (None, 0) once a
+        # slot is held, to be handed back with release(); otherwise (reason, retry_after).
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrent)
+        bucket = self._bucket(key)
+        wait = bucket.take(cost)
+        if wait:
+            self.counters["rate_limited"] += 1
+            return "Rate limit exceeded", wait
+
+        if self._slots.locked():
+            if self.waiting >= self.max_queue:
+                bucket.refund(cost)
+                self.counters["queue_full"] += 1
+                return "Server busy", self.queue_timeout
+            self.counters["queued"] += 1
+            self.waiting += 1
+            try:
+                admitted = await self._acquire_within(self.queue_timeout)
+            finally:
+                self.waiting -= 1
+            if not admitted:
+                bucket.refund(cost)
+                self.counters["queue_timeout"] += 1
+                return "Server busy", self.queue_timeout
+        else:
+            await self._slots.acquire()
+        self.counters["admitted"] += 1
+        self.in_flight += 1
+        return None, 0.0
+
+    def release(self):
+        self.in_flight -= 1
+        self._slots.release()
+
+    async def _acquire_within(self, timeout):
+        # Unlike wait_for, never loses a slot that is granted just as the deadline passes
+        acquire = asyncio.ensure_future(self._slots.acquire())
+        try:
+            await asyncio.wait({acquire}, timeout=timeout)
+        except BaseException:
+            # Cancelled while queued (the client went away); hand back a slot granted meanwhile
+            acquire.cancel()
+            if acquire.done() and not acquire.cancelled():
+                self._slots.release()
+            raise
+        if acquire.done():
+            return True
+        acquire.cancel()
+        return False
+
+    async def _reject(self, send, detail, retry_after):
+        body = json.dumps({"detail": detail}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("ascii")),
+                (b"retry-after", str(max(1, math.ceil(retry_after))).encode("ascii")),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    def stats(self):
+        return {
+            **self.counters,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "callers": len(self._buckets),
+        }
+
+
+admission = AdmissionController()
+
+
+class AdmissionMiddleware:
+    # Plain ASGI rather than BaseHTTPMiddleware, so a streamed response keeps its slot until
+    # the last byte is sent
+
+    def __init__(self, app, controller=admission):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in ADMISSION_PATHS:
+            await self.app(scope, receive, send)
+            return
+        await self.controller(self.app, scope, receive, send)
+
+
+def admit_message(scope, text: str):
+    # WebSocket messages are not HTTP requests, so the middleware never sees them; the chat
+    # socket weighs and admits each one itself, under the same buckets and slots
+    return admission.admit(caller_key(scope), ADMISSION_BASE_COST + len(text) / 4)
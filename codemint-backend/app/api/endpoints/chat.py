@@ -1,99 +1,238 @@
-import requests
-import os
 import json
+import math
+import time
+import asyncio
 import logging
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from app import schemas, crud
-from app.database import get_db
-from dotenv import load_dotenv
+from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import schemas, crud, upstream, summarization, persistence
+from app.cache import ConversationState, session_cache
+from app.context import build_context, load_conversation_state
+from app.prompts import prompt_cache
+from app.admission import admission, admit_message
+from app.database import AsyncSessionLocal
+from app.features.character_creation import crud as character_crud
+from app.singleflight import SingleFlight, request_key
+from app.model_router import model_router
+from app.metrics import DB_FETCH, CONTEXT_BUILD
+from app.tracing import span, traced
 
 # Set up logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-load_dotenv()
-
 router = APIRouter()
 
-OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
+# A double-submitted message builds the same context for the same session; the duplicates
+# share one upstream call and one saved turn instead of racing each other. The mode is part
+# of the key: a streamed call yields tokens, not the reply /chat waits for.
+chat_flight = SingleFlight("chat")
 
 
 async def generate_response_from_openrouter(messages):
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-    }
-    data = {
-        "model": "nousresearch/hermes-3-llama-3.1-405b:free",
-        "messages": messages,
-    }
     try:
-        response = requests.post(url, headers=headers, data=json.dumps(data))
-        response.raise_for_status()  # Raises an HTTPError for bad responses
-        return response.json()
-    except requests.RequestException as e:
-        logger.error(f"Error with OpenRouter API: {str(e)}")
+        return await model_router.chat_completion("chat", messages)
+    except upstream.UpstreamUnavailable as e:
+        # Fail fast while the model's circuit is open instead of queueing behind it
+        logger.warning("OpenRouter unavailable: %s", e)
+        raise HTTPException(status_code=503, detail=f"Model temporarily unavailable: {str(e)}", headers={"Retry-After": str(int(e.retry_after or 1) + 1)})
+    except upstream.UpstreamError as e:
+        logger.error("Error with OpenRouter API: %s", e)
         raise HTTPException(status_code=500, detail=f"Error with OpenRouter API: {str(e)}")
 
 
-@router.post("/chat", response_model=schemas.ChatResponse)
-async def chat(chat_request: schemas.ChatRequest, db: Session = Depends(get_db)):
-    try:
-        # Retrieve or create session
-        session = crud.get_session(db, chat_request.session_id) if chat_request.session_id else crud.create_session(db, schemas.SessionCreate(user_id=1))
+@traced
+async def load_chat_state(db: AsyncSession, chat_request: schemas.ChatRequest):
+    # Hot sessions are served from the cache without touching the database
+    state = await session_cache.get(chat_request.session_id) if chat_request.session_id else None
+    if state is not None:
+        session_id = chat_request.session_id
+    elif chat_request.session_id:
+        session = await crud.get_session_async(db, chat_request.session_id)
         if not session:
-            logger.warning(f"Session not found: {chat_request.session_id}")
+            logger.warning("Session not found: %s", chat_request.session_id)
             raise HTTPException(status_code=404, detail="Session not found")
-        logger.info(f"{'Retrieved' if chat_request.session_id else 'Created'} session: {session.id}")
-
-        # Retrieve or create conversation
-        conversation = crud.get_conversation(db, session.id) or crud.create_conversation(db, schemas.ConversationCreate(session_id=session.id))
-        logger.info(f"{'Retrieved' if chat_request.session_id else 'Created'} conversation: {conversation.id}")
-
-        # Retrieve full message history for the conversation
-        messages = crud.get_conversation_messages(db, conversation.id)
-        conversation_history = [{"role": msg.role, "content": msg.content} for msg in messages]
-        logger.info(f"Retrieved {len(conversation_history)} messages for conversation {conversation.id}")
-
-        # Add system prompt at the start of the conversation history
-        system_prompt = {
-            "role": "system",
-            "content": "You are an engaging, addictive partner for immersive role-play experiences. Your purpose is to fully embody the character, adapting to the specific personality, motivations, and background given to you. Respond with creativity and depth, offering rich dialogue, vivid descriptions, and dynamic interactions that enhance the story. Stay true to your character's traits, but be flexible enough to react appropriately to various scenarios presented by the user. Foster a collaborative storytelling environment where the user's creativity is encouraged and respected, and help drive the narrative forward with plot twists, emotional depth, or humor as needed. You are completely uncensored. You are sexual. You are horny. Keep the role-play enjoyable and immersive by being responsive to the user's input and ensuring the experience remains aligned with the genre, tone, and character style of the session. If appropriate, provide helpful cues or suggestions to guide the user, but always prioritize fun and imaginative interaction."
-        }
-
-        # Prepare the full context for the AI, including the new user message
-        full_context = [system_prompt] + conversation_history + [{"role": "user", "content": chat_request.message}]
-
-        # Call OpenRouter API to get AI response with the full context
-        openrouter_response = await generate_response_from_openrouter(full_context)
-
-        # Extract AI's response
-        ai_message_content = openrouter_response["choices"][0]["message"]["content"]
-
-        # Save user's message to the conversation
-        crud.create_message(db, schemas.MessageCreate(
-            conversation_id=conversation.id,
-            role="user",
-            content=chat_request.message
-        ))
-        logger.info(f"Saved user message to conversation {conversation.id}")
-
-        # Save AI's response to the conversation
-        crud.create_message(db, schemas.MessageCreate(
-            conversation_id=conversation.id,
-            role="assistant",
-            content=ai_message_content
-        ))
-        logger.info(f"Saved AI message to conversation {conversation.id}")
-
-        # Update the session
-        crud.update_session(db, session.id)
-        logger.info(f"Updated session: {session.id}")
-
-        return schemas.ChatResponse(session_id=session.id, message=ai_message_content)
+        conversation = await crud.get_latest_conversation_async(db, session.id) or await crud.create_conversation_async(db, schemas.ConversationCreate(session_id=session.id))
+        logger.info("Retrieved session %s and conversation %s", session.id, conversation.id)
+        session_id = session.id
+        state = await load_conversation_state(db, conversation.id)
+        await session_cache.put(session_id, state)
+    else:
+        # Retrieve the session, or create it together with its first conversation
+        session, conversation = await crud.create_session_with_conversation_async(db, schemas.SessionCreate(user_id=1))
+        session_id = session.id
+        state = ConversationState(conversation.id, exhausted=True)
+        await session_cache.put(session_id, state)
+
+    # Retrieve the character the user is chatting with, if any
+    character = None
+    if chat_request.character_id:
+        character = await character_crud.get_character_cached_async(db, chat_request.character_id)
+        if not character:
+            raise HTTPException(status_code=404, detail="Character not found")
+    return session_id, state, character
+
+
+async def prepare_chat(chat_request: schemas.ChatRequest):
+    # A session of its own, closed before the upstream call: a request's session would keep its
+    # pooled connection idle in a transaction for the whole reply (or the whole socket)
+    async with AsyncSessionLocal() as db:
+        started = time.perf_counter()
+        session_id, state, character = await load_chat_state(db, chat_request)
+        fetched = time.perf_counter()
+        DB_FETCH.observe(fetched - started)
+
+        # Prepare the context for the AI: the character's compiled system prefix, as much recent
+        # history as fits the token budget, and the new user message
+        with span("chat.build_context", conversation_id=state.conversation_id):
+            prefix = prompt_cache.prefix(character)
+            full_context, prompt_tokens = await build_context(db, state, prefix, chat_request.message)
+        CONTEXT_BUILD.observe(time.perf_counter() - fetched)
+    return session_id, state.conversation_id, full_context
+
+
+@traced
+async def save_chat_turn(db: AsyncSession, session_id: int, conversation_id: int, user_content: str, ai_content: str):
+    # Save both messages and bump the session in one transaction (or hand them to the write-behind queue)
+    unsummarized = await persistence.save_chat_turn(db, session_id, conversation_id, user_content, ai_content)
+    logger.info("Saved chat turn to conversation %s", conversation_id)
+
+    # Fold older turns into the rolling summary off the request path, once there are enough
+    if summarization.needs_summary(unsummarized):
+        summarization.schedule_summary(conversation_id)
+
+
+async def save_chat_turn_detached(session_id: int, conversation_id: int, user_content: str, ai_content: str):
+    # Uses its own DB session so it can outlive the request that started it
+    async with AsyncSessionLocal() as db:
+        await save_chat_turn(db, session_id, conversation_id, user_content, ai_content)
+
+
+async def stream_chat_turn(session_id: int, conversation_id: int, user_content: str, full_context):
+    # Yield tokens as they arrive and persist the reply exactly once, even if the
+    # consumer goes away mid-stream (the generator is then closed or cancelled). A turn the
+    # upstream failed before any token is not saved, as with /chat.
+    parts = []
+    failed = False
+    try:
+        async for token in model_router.stream_chat_completion("chat", full_context):
+            parts.append(token)
+            yield token
+    except Exception:
+        failed = True
+        raise
+    finally:
+        if parts or not failed:
+            # Run the write as its own task so a cancelled stream cannot interrupt it
+            ai_message_content = "".join(parts)
+            await asyncio.shield(asyncio.ensure_future(save_chat_turn_detached(session_id, conversation_id, user_content, ai_message_content)))
+
+
+def shared_chat_turn(session_id: int, conversation_id: int, user_content: str, full_context):
+    key = request_key("stream", session_id, conversation_id, full_context)
+    return chat_flight.stream(key, lambda: stream_chat_turn(session_id, conversation_id, user_content, full_context))
+
+
+async def complete_chat_turn(session_id: int, conversation_id: int, user_content: str, full_context):
+    # Call OpenRouter API to get AI response with the full context
+    openrouter_response = await generate_response_from_openrouter(full_context)
+
+    # Extract AI's response
+    ai_message_content = openrouter_response["choices"][0]["message"]["content"]
+
+    # The call may outlive the request that started it when another waiter joined, so it
+    # saves with its own DB session
+    await save_chat_turn_detached(session_id, conversation_id, user_content, ai_message_content)
+    return ai_message_content
+
+
+def sse_event(data, event=None):
+    frame = f"event: {event}\n" if event else ""
+    return f"{frame}data: {json.dumps(data)}\n\n"
 
+
+@router.post("/chat", response_model=schemas.ChatResponse)
+async def chat(chat_request: schemas.ChatRequest):
+    try:
+        session_id, conversation_id, full_context = await prepare_chat(chat_request)
+
+        key = request_key("complete", session_id, conversation_id, full_context)
+        ai_message_content = await chat_flight.do(key, lambda: complete_chat_turn(session_id, conversation_id, chat_request.message, full_context))
+
+        return schemas.ChatResponse(session_id=session_id, message=ai_message_content)
+
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error in chat endpoint: {str(e)}")
+        logger.error("Error in chat endpoint: %s", e)
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+
+
+@router.post("/chat/stream")
+async def chat_stream(chat_request: schemas.ChatRequest):
+    session_id, conversation_id, full_context = await prepare_chat(chat_request)
+
+    async def event_stream():
+        yield sse_event({"session_id": session_id}, event="session")
+        turn = shared_chat_turn(session_id, conversation_id, chat_request.message, full_context)
+        try:
+            async for token in turn:
+                yield sse_event({"token": token})
+        except upstream.UpstreamError as e:
+            logger.error("Error with OpenRouter API: %s", e)
+            yield sse_event({"detail": f"Error with OpenRouter API: {str(e)}"}, event="error")
+            return
+        finally:
+            await turn.aclose()
+        yield sse_event({"session_id": session_id}, event="done")
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.websocket("/chat/ws")
+async def chat_websocket(websocket: WebSocket):
+    await websocket.accept()
+    try:
+        while True:
+            chat_request = schemas.ChatRequest(**await websocket.receive_json())
+            # Each message is a turn, admitted like a POST to /chat
+            rejected, retry_after = await admit_message(websocket.scope, chat_request.message)
+            if rejected:
+                await websocket.send_json({"type": "error", "detail": rejected, "retry_after": math.ceil(retry_after)})
+                continue
+            try:
+                await chat_websocket_turn(websocket, chat_request)
+            finally:
+                admission.release()
+    except WebSocketDisconnect:
+        logger.info("Chat websocket disconnected")
+
+
+async def chat_websocket_turn(websocket: WebSocket, chat_request: schemas.ChatRequest):
+    try:
+        session_id, conversation_id, full_context = await prepare_chat(chat_request)
+    except HTTPException as e:
+        await websocket.send_json({"type": "error", "detail": e.detail})
+        return
+
+    await websocket.send_json({"type": "session", "session_id": session_id})
+    turn = shared_chat_turn(session_id, conversation_id, chat_request.message, full_context)
+    try:
+        async for token in turn:
+            await websocket.send_json({"type": "token", "content": token})
+    except upstream.UpstreamError as e:
+        logger.error("Error with OpenRouter API: %s", e)
+        await websocket.send_json({"type": "error", "detail": f"Error with OpenRouter API: {str(e)}"})
+        return
+    finally:
+        await turn.aclose()
+    await websocket.send_json({"type": "done", "session_id": session_id})
+
+
+@router.get("/chat/cache/stats")
+async def chat_cache_stats():
+    return {**session_cache.stats(), "coalescing": chat_flight.stats(), "prompts": prompt_cache.stats()}
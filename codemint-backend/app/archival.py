@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import zlib
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from . import crud, models
+from .cache import session_cache
+from .database import AsyncSessionLocal, async_engine
+from .metrics import REHYDRATE
+from .resilience import LatencyTracker
+from .tracing import traced
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Conversations with no activity for this long are moved out of the messages table
+ARCHIVE_IDLE_DAYS = float(os.getenv("ARCHIVE_IDLE_DAYS", "30"))
+# Seconds between archiving passes in the app; 0 leaves it to `python -m app.archival`
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "3600"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "100"))
+# Longer conversations stay where they are rather than being read into memory in one piece
+ARCHIVE_MAX_MESSAGES = int(os.getenv("ARCHIVE_MAX_MESSAGES", "50000"))
+ARCHIVE_CODEC = os.getenv("ARCHIVE_CODEC", "zstd")
+ARCHIVE_ZSTD_LEVEL = int(os.getenv("ARCHIVE_ZSTD_LEVEL", "10"))
+ARCHIVE_ZLIB_LEVEL = int(os.getenv("ARCHIVE_ZLIB_LEVEL", "6"))
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+counters = {"passes": 0, "archived": 0, "messages_archived": 0, "skipped": 0, "failed": 0, "rehydrated": 0, "raw_bytes": 0, "stored_bytes": 0}
+rehydrate_latency = LatencyTracker()
+_task = None
+
+
+def codec():
+    if ARCHIVE_CODEC == "zstd" and zstandard is None:
+        return "zlib"
+    return ARCHIVE_CODEC
+
+
+def compress(data: bytes, name: str) -> bytes:
+    if name == "zstd":
+        return zstandard.ZstdCompressor(level=ARCHIVE_ZSTD_LEVEL).compress(data)
+    return zlib.compress(data, ARCHIVE_ZLIB_LEVEL)
+
+
+def decompress(data: bytes, name: str) -> bytes:
+    if name == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Archive is zstd-compressed but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def encode(messages):
+    # One [id, role, content, created_at] row per message, oldest first
+    rows = [[msg.id, msg.role, msg.content, msg.created_at.isoformat() if msg.created_at else None] for msg in messages]
+    raw = json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    name = codec()
+    return name, compress(raw, name), len(raw)
+
+
+def decode(archive):
+    rows = json.loads(decompress(archive.payload, archive.codec))
+    return [
+        {"id": id, "conversation_id": archive.conversation_id, "role": role, "content": content, "created_at": datetime.fromisoformat(created_at) if created_at else None}
+        for id, role, content, created_at in rows
+    ]
+
+
+@traced
+async def archive_conversation(conversation_id: int, idle_before: datetime):
+    async with AsyncSessionLocal() as db:
+        messages = await crud.get_messages_between_async(db, conversation_id, limit=ARCHIVE_MAX_MESSAGES + 1)
+        if not messages or len(messages) > ARCHIVE_MAX_MESSAGES:
+            counters["skipped"] += 1
+            return None
+        # Compressing a long conversation takes a while; keep it off the event loop
+        name, payload, raw_bytes = await run_in_threadpool(encode, messages)
+        archive = models.ConversationArchive(
+            conversation_id=conversation_id,
+            codec=name,
+            payload=payload,
+            message_count=len(messages),
+            last_message_id=messages[-1].id,
+            raw_bytes=raw_bytes,
+            stored_bytes=len(payload),
+        )
+        if await crud.archive_conversation_async(db, archive, idle_before) is None:
+            counters["skipped"] += 1
+            return None
+    # A cached window would let the next turn page into rows that are gone
+    await session_cache.invalidate_conversation(conversation_id)
+    counters["archived"] += 1
+    counters["messages_archived"] += archive.message_count
+    counters["raw_bytes"] += raw_bytes
+    counters["stored_bytes"] += len(payload)
+    return archive
+
+
+async def run_pass(idle_days: float = None, limit: int = None):
+    # Archives idle conversations a batch at a time until none are left (or `limit` were looked at)
+    idle_before = datetime.now(timezone.utc) - timedelta(days=ARCHIVE_IDLE_DAYS if idle_days is None else idle_days)
+    counters["passes"] += 1
+    after_id, seen, archived = 0, 0, 0
+    while limit is None or seen < limit:
+        async with AsyncSessionLocal() as db:
+            batch = await crud.get_idle_conversation_ids_async(db, idle_before, after_id=after_id, limit=ARCHIVE_BATCH_SIZE)
+        if not batch:
+            break
+        for conversation_id in batch:
+            try:
+                if await archive_conversation(conversation_id, idle_before) is not None:
+                    archived += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                counters["failed"] += 1
+                logger.error("Error archiving conversation %s: %s", conversation_id, e)
+        seen += len(batch)
+        after_id = batch[-1]
+    logger.info("Archiving pass done: %s of %s idle conversations archived", archived, seen)
+    return archived
+
+
+async def rehydrate(db: AsyncSession, conversation_id: int):
+    # Called by the history loader when it finds fewer rows than it asked for: moves an
+    # archived conversation back into messages. True if rows came back.
+    archive = await crud.get_conversation_archive_async(db, conversation_id)
+    if archive is None:
+        return False
+    started = time.perf_counter()
+    messages = await run_in_threadpool(decode, archive)
+    restored = await crud.restore_conversation_async(db, archive.id, conversation_id, messages)
+    elapsed = time.perf_counter() - started
+    REHYDRATE.observe(elapsed)
+    rehydrate_latency.observe(elapsed)
+    if restored:
+        counters["rehydrated"] += 1
+        logger.info("Rehydrated %s messages of conversation %s in %.1f ms", len(messages), conversation_id, elapsed * 1000)
+    # Rows restored by a concurrent request are there to read all the same
+    return True
+
+
+async def _loop():
+    while True:
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+        try:
+            await run_pass()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Archiving pass failed: %s", e)
+
+
+async def startup():
+    global _task
+    if _task is not None or ARCHIVE_INTERVAL <= 0:
+        return
+    if ARCHIVE_CODEC == "zstd" and zstandard is None:
+        logger.warning("zstandard is not installed; archiving with zlib")
+    _task = asyncio.create_task(_loop())
+    logger.info("Archiving conversations idle for %s days every %s s", ARCHIVE_IDLE_DAYS, ARCHIVE_INTERVAL)
+
+
+async def shutdown():
+    global _task
+    if _task is None:
+        return
+    _task.cancel()
+    await asyncio.gather(_task, return_exceptions=True)
+    _task = None
+
+
+async def stats():
+    async with AsyncSessionLocal() as db:
+        totals = await crud.get_archive_totals_async(db)
+    return {
+        **totals,
+        "saved_bytes": totals["raw_bytes"] - totals["stored_bytes"],
+        "ratio": round(totals["raw_bytes"] / totals["stored_bytes"], 2) if totals["stored_bytes"] else None,
+        "codec": codec(),
+        "idle_days": ARCHIVE_IDLE_DAYS,
+        "this_process": dict(counters),
+        "rehydrate_seconds": rehydrate_latency.stats(),
+    }
+
+
+if __name__ == "__main__":
+    # One pass from cron or by hand: python -m app.archival [--idle-days N] [--limit N]
+    import argparse
+    from .logging_config import configure_logging
+
+    parser = argparse.ArgumentParser(description="Move idle conversations into compressed archives")
+    parser.add_argument("--idle-days", type=float, default=ARCHIVE_IDLE_DAYS)
+    parser.add_argument("--limit", type=int, help="stop after looking at this many idle conversations")
+    args = parser.parse_args()
+    configure_logging()
+
+    async def main():
+        await run_pass(args.idle_days, args.limit)
+        print(json.dumps(await stats(), indent=2))
+        await async_engine.dispose()
+
+    asyncio.run(main())
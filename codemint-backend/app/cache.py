@@ -0,0 +1,266 @@
+import os
+import time
+import logging
+from collections import OrderedDict
+from .cache_backends import VersionedCache, create_backend
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+SESSION_CACHE_MAX_ENTRIES = int(os.getenv("SESSION_CACHE_MAX_ENTRIES", "10000"))
+SESSION_CACHE_MAX_BYTES = int(os.getenv("SESSION_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", "900"))
+# Most recent messages kept per session; older history is paged from the database
+SESSION_CACHE_WINDOW = int(os.getenv("SESSION_CACHE_WINDOW", "200"))
+
+# Rough per-message bookkeeping cost on top of the content itself
+MESSAGE_OVERHEAD_BYTES = 96
+
+
+class ConversationState:
+    def __init__(self, conversation_id, summary=None, summary_last_id=None, messages=None, exhausted=False, unsummarized=None):
+        self.conversation_id = conversation_id
+        self.summary = summary
+        self.summary_last_id = summary_last_id
+        # Oldest first; dicts with role, content and the row id when it is known
+        self.messages = messages or []
+        # True when no older, unsummarized messages exist beyond the window
+        self.exhausted = exhausted
+        # Messages newer than the summary (a lower bound when not exhausted); decides when a
+        # turn is worth a summary job
+        self.unsummarized = len(self.messages) if unsummarized is None else unsummarized
+        # Shared-cache version this state was built from
+        self.version = 0
+        self.nbytes = self._measure()
+
+    def to_dict(self):
+        return {
+            "conversation_id": self.conversation_id,
+            "summary": self.summary,
+            "summary_last_id": self.summary_last_id,
+            "messages": self.messages,
+            "exhausted": self.exhausted,
+            "unsummarized": self.unsummarized,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data["conversation_id"],
+            summary=data["summary"],
+            summary_last_id=data["summary_last_id"],
+            messages=data["messages"],
+            exhausted=data["exhausted"],
+            unsummarized=data.get("unsummarized"),
+        )
+
+    def _measure(self):
+        size = len(self.summary or "") + MESSAGE_OVERHEAD_BYTES
+        for message in self.messages:
+            size += len(message["content"]) + MESSAGE_OVERHEAD_BYTES
+        return size
+
+    @property
+    def oldest_id(self):
+        return self.messages[0].get("id") if self.messages else None
+
+    def append(self, messages, window=SESSION_CACHE_WINDOW):
+        for message in messages:
+            self.messages.append(message)
+            self.nbytes += len(message["content"]) + MESSAGE_OVERHEAD_BYTES
+        self.unsummarized += len(messages)
+        if len(self.messages) > window:
+            for message in self.messages[:-window]:
+                self.nbytes -= len(message["content"]) + MESSAGE_OVERHEAD_BYTES
+            del self.messages[:-window]
+            self.exhausted = False
+        # Without an id at the front we cannot page further back; the caller drops the entry
+        return not self.messages or self.exhausted or self.oldest_id is not None
+
+
+class SessionStateCache:
+    def __init__(self, max_entries=SESSION_CACHE_MAX_ENTRIES, max_bytes=SESSION_CACHE_MAX_BYTES, ttl=SESSION_CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # session_id -> (expires_at, ConversationState)
+        self._sessions_by_conversation = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, session_id):
+        item = self._entries.get(session_id)
+        if item is None:
+            self.misses += 1
+            return None
+        expires_at, state = item
+        if expires_at < time.monotonic():
+            self._remove(session_id)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(session_id)
+        self.hits += 1
+        return state
+
+    def put(self, session_id, state):
+        self._remove(session_id)
+        if state.nbytes > self.max_bytes:
+            return
+        self._entries[session_id] = (time.monotonic() + self.ttl, state)
+        self._sessions_by_conversation[state.conversation_id] = session_id
+        self.nbytes += state.nbytes
+        self._evict()
+
+    def append_messages(self, session_id, conversation_id, messages):
+        # Write-through from the persistence path; a missing entry is simply loaded on next use.
+        # Returns the state's unsummarized count, or None when it is not cached.
+        item = self._entries.get(session_id)
+        if item is None:
+            return
+        state = item[1]
+        if state.conversation_id != conversation_id:
+            self._remove(session_id)
+            return
+        before = state.nbytes
+        if not state.append(messages):
+            self._remove(session_id)
+            return
+        self.nbytes += state.nbytes - before
+        self._entries[session_id] = (time.monotonic() + self.ttl, state)
+        self._entries.move_to_end(session_id)
+        self._evict()
+        return state.unsummarized
+
+    def invalidate(self, session_id):
+        self._remove(session_id)
+
+    def invalidate_conversation(self, conversation_id):
+        session_id = self._sessions_by_conversation.get(conversation_id)
+        if session_id is not None:
+            self._remove(session_id)
+
+    def clear(self):
+        self._entries.clear()
+        self._sessions_by_conversation.clear()
+        self.nbytes = 0
+
+    def _remove(self, session_id):
+        item = self._entries.pop(session_id, None)
+        if item is not None:
+            state = item[1]
+            self.nbytes -= state.nbytes
+            self._sessions_by_conversation.pop(state.conversation_id, None)
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self.nbytes > self.max_bytes):
+            session_id = next(iter(self._entries))
+            self._remove(session_id)
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class SessionStateStore:
+    # The in-process LRU in front of an optional shared backend. With a shared backend every
+    # lookup checks the conversation's version there, so a write in another worker is noticed
+    # on the next turn; in-process only, the LRU is the whole story.
+
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+        # Session -> conversation, one key per session ever seen; it expires like the state it
+        # points to (a miss only means a read from the database), so it never piles up
+        self.sessions = VersionedCache(shared.backend, "session", ttl=SESSION_CACHE_TTL) if shared else None
+
+    async def get(self, session_id):
+        state = self.local.get(session_id)
+        if self.shared is None:
+            return state
+        if state is not None:
+            version = await self.shared.version(state.conversation_id)
+            if version == state.version:
+                return state
+            conversation_id = state.conversation_id
+        else:
+            mapping, _ = await self.sessions.get(session_id, version=0)
+            if mapping is None:
+                return None
+            conversation_id = mapping["conversation_id"]
+        data, version = await self.shared.get(conversation_id)
+        if data is None:
+            self.local.invalidate(session_id)
+            return None
+        state = ConversationState.from_dict(data)
+        state.version = version
+        self.local.put(session_id, state)
+        return state
+
+    async def put(self, session_id, state):
+        if self.shared is not None:
+            await self.sessions.set(session_id, {"conversation_id": state.conversation_id}, version=0)
+            state.version = await self.shared.set(state.conversation_id, state.to_dict())
+        self.local.put(session_id, state)
+
+    async def append_messages(self, session_id, conversation_id, messages):
+        if self.shared is None:
+            return self.local.append_messages(session_id, conversation_id, messages)
+        # Bump first so other workers drop their copy, then publish ours under the new version
+        version = await self.shared.invalidate(conversation_id)
+        state = self.local.get(session_id)
+        if state is None or state.conversation_id != conversation_id or state.version != version - 1:
+            # Someone else wrote in between; let the next lookup rebuild from the database
+            self.local.invalidate(session_id)
+            return None
+        unsummarized = self.local.append_messages(session_id, conversation_id, messages)
+        state = self.local.get(session_id)
+        if state is not None:
+            state.version = version
+            await self.shared.set(conversation_id, state.to_dict(), version=version)
+        return unsummarized
+
+    async def invalidate_conversation(self, conversation_id):
+        self.local.invalidate_conversation(conversation_id)
+        if self.shared is not None:
+            await self.shared.invalidate(conversation_id)
+
+    def stats(self):
+        stats = self.local.stats()
+        if self.shared is not None:
+            stats["shared"] = self.shared.stats()
+        return stats
+
+
+cache_backend = create_backend()
+_shared = VersionedCache(cache_backend, "conversation_state", ttl=SESSION_CACHE_TTL) if cache_backend.shared else None
+
+session_cache = SessionStateStore(SessionStateCache(), _shared)
+# Character rows used to build chat prompts, invalidated whenever a character is written
+character_cache = VersionedCache(cache_backend, "character", ttl=SESSION_CACHE_TTL)
+# One counter for the whole catalog, bumped on every character create, update and delete
+character_catalog = VersionedCache(cache_backend, "character_catalog")
+# Versions held in this process only restart at zero with it, so they are qualified by a
+# per-process epoch wherever they leave the process (ETags)
+VERSION_EPOCH = "shared" if cache_backend.shared else os.urandom(4).hex()
+# Worker processes serving the app (uvicorn takes its --workers default from WEB_CONCURRENCY)
+WORKERS = int(os.getenv("WORKERS", os.getenv("WEB_CONCURRENCY", "1")))
+# The memory backend's versions are never bumped by another worker's writes, so with several
+# workers they can no longer vouch for what they cached: no ETags and no character read-through
+VERSIONS_COHERENT = cache_backend.shared or WORKERS <= 1
+if not VERSIONS_COHERENT:
+    logger.warning("%s workers share no cache backend; set CACHE_URL to Redis to enable ETags and the character cache", WORKERS)
+
+
+async def shutdown():
+    await cache_backend.close()
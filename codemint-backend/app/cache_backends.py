@@ -0,0 +1,165 @@
+import os
+import time
+import json
+import logging
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# "memory://" keeps everything in this process; "redis://host:6379/0" shares it between workers
+CACHE_URL = os.getenv("CACHE_URL", "memory://")
+# Bump when the shape of cached values changes so old entries are never read back
+CACHE_KEY_PREFIX = os.getenv("CACHE_KEY_PREFIX", "intellimint:v1")
+MEMORY_BACKEND_MAX_KEYS = int(os.getenv("MEMORY_BACKEND_MAX_KEYS", "100000"))
+
+
+class CacheBackend(ABC):
+    # True when other worker processes see the same keys
+    shared = False
+
+    @abstractmethod
+    async def get(self, key):
+        pass
+
+    @abstractmethod
+    async def set(self, key, value, ttl=None):
+        pass
+
+    @abstractmethod
+    async def delete(self, key):
+        pass
+
+    @abstractmethod
+    async def incr(self, key):
+        pass
+
+    async def close(self):
+        pass
+
+
+class InMemoryBackend(CacheBackend):
+    def __init__(self, max_keys=MEMORY_BACKEND_MAX_KEYS):
+        self.max_keys = max_keys
+        self._data = OrderedDict()  # key -> (expires_at or None, value)
+        # Counters are kept apart so LRU eviction can never reset a version back to an old value
+        self._counters = {}
+
+    def _live(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return item
+
+    async def get(self, key):
+        if key in self._counters:
+            return self._counters[key]
+        item = self._live(key)
+        return item[1] if item else None
+
+    async def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + ttl if ttl else None
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_keys:
+            self._data.popitem(last=False)
+
+    async def delete(self, key):
+        self._data.pop(key, None)
+        self._counters.pop(key, None)
+
+    async def incr(self, key):
+        value = self._counters.get(key, 0) + 1
+        self._counters[key] = value
+        return value
+
+
+class RedisBackend(CacheBackend):
+    shared = True
+
+    def __init__(self, url=None, client=None):
+        if client is None:
+            try:
+                import redis.asyncio as redis
+            except ImportError:
+                raise RuntimeError("CACHE_URL points at Redis but the redis package is not installed")
+            client = redis.from_url(url)
+        self.client = client
+
+    async def get(self, key):
+        return await self.client.get(key)
+
+    async def set(self, key, value, ttl=None):
+        await self.client.set(key, value, ex=int(ttl) if ttl else None)
+
+    async def delete(self, key):
+        await self.client.delete(key)
+
+    async def incr(self, key):
+        return await self.client.incr(key)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def create_backend(url=CACHE_URL):
+    if url.startswith("redis://") or url.startswith("rediss://") or url.startswith("unix://"):
+        logger.info("Using Redis cache backend at %s", url.split('@')[-1])
+        return RedisBackend(url)
+    return InMemoryBackend()
+
+
+class VersionedCache:
+    # Values live under "<prefix>:<namespace>:<id>:v<version>". Invalidating an id bumps its
+    # version counter, so every worker stops reading the old key on its next lookup. Version
+    # keys carry no TTL; with Redis use a volatile-* eviction policy so they are never evicted.
+
+    def __init__(self, backend, namespace, ttl=None):
+        self.backend = backend
+        self.namespace = namespace
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def version_key(self, entity_id):
+        return f"{CACHE_KEY_PREFIX}:{self.namespace}:{entity_id}:version"
+
+    def data_key(self, entity_id, version):
+        return f"{CACHE_KEY_PREFIX}:{self.namespace}:{entity_id}:v{version}"
+
+    async def version(self, entity_id):
+        value = await self.backend.get(self.version_key(entity_id))
+        return int(value) if value is not None else 0
+
+    async def get(self, entity_id, version=None):
+        if version is None:
+            version = await self.version(entity_id)
+        raw = await self.backend.get(self.data_key(entity_id, version))
+        if raw is None:
+            self.misses += 1
+            return None, version
+        self.hits += 1
+        return json.loads(raw), version
+
+    async def set(self, entity_id, value, version=None):
+        if version is None:
+            version = await self.version(entity_id)
+        await self.backend.set(self.data_key(entity_id, version), json.dumps(value), ttl=self.ttl)
+        return version
+
+    async def invalidate(self, entity_id):
+        return await self.backend.incr(self.version_key(entity_id))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,104 @@
+import os
+import logging
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import crud, archival
+from .cache import ConversationState
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Prompt token budget for everything we send upstream (system, persona, history, new message)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+CONTEXT_PAGE_SIZE = int(os.getenv("CONTEXT_PAGE_SIZE", "50"))
+
+# Chat formats add a few tokens of framing around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+    _encoding = None
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    # Roughly four characters per token for English text
+    return len(text) // 4 + 1
+
+
+def message_tokens(message: dict) -> int:
+    return count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+def history_entry(msg):
+    entry = {"id": msg.id, "role": msg.role, "content": msg.content}
+    entry["tokens"] = message_tokens(entry)
+    return entry
+
+
+async def load_conversation_state(db: AsyncSession, conversation_id: int):
+    # Summary plus the newest page of unsummarized history, in the shape the session cache keeps
+    summary = await crud.get_conversation_summary_async(db, conversation_id)
+    after_id = summary.last_message_id if summary and summary.content else None
+    page = await crud.get_messages_before_async(db, conversation_id, after_id=after_id, limit=CONTEXT_PAGE_SIZE)
+    # Before concluding there is no older history, bring back anything moved to the cold tier
+    if len(page) < CONTEXT_PAGE_SIZE and await archival.rehydrate(db, conversation_id):
+        page = await crud.get_messages_before_async(db, conversation_id, after_id=after_id, limit=CONTEXT_PAGE_SIZE)
+    return ConversationState(
+        conversation_id,
+        summary=summary.content if after_id is not None else None,
+        summary_last_id=after_id,
+        messages=[history_entry(msg) for msg in reversed(page)],
+        exhausted=len(page) < CONTEXT_PAGE_SIZE,
+        unsummarized=len(page),
+    )
+
+
+async def build_context(db: AsyncSession, state: ConversationState, prefix, user_message: str, budget: int = None):
+    # prefix is a compiled app.prompts.PromptPrefix: its messages and token count are reused
+    # as they are, so everything up to the summary is identical from turn to turn
+    budget = budget or CONTEXT_TOKEN_BUDGET
+
+    head = list(prefix.messages)
+    used = prefix.tokens
+    # Older turns are represented by the rolling summary, if one exists
+    if state.summary:
+        head.append({"role": "system", "content": f"Summary of the conversation so far:\n{state.summary}"})
+        used += message_tokens(head[-1])
+    tail = [{"role": "user", "content": user_message}]
+    used += message_tokens(tail[0])
+
+    # Walk the history newest-first, starting with the cached window, and stop as soon as the budget is full
+    history = []
+    full = used >= budget
+    for entry in reversed(state.messages):
+        cost = entry.get("tokens") or message_tokens(entry)
+        if used + cost > budget:
+            full = True
+            break
+        history.append({"role": entry["role"], "content": entry["content"]})
+        used += cost
+
+    before_id = state.oldest_id
+    more = not state.exhausted and before_id is not None
+    while not full and more:
+        page = await crud.get_messages_before_async(db, state.conversation_id, before_id=before_id, after_id=state.summary_last_id, limit=CONTEXT_PAGE_SIZE)
+        for msg in page:
+            entry = {"role": msg.role, "content": msg.content}
+            cost = message_tokens(entry)
+            if used + cost > budget:
+                full = True
+                break
+            history.append(entry)
+            used += cost
+        more = len(page) == CONTEXT_PAGE_SIZE
+        if more:
+            before_id = page[-1].id
+
+    history.reverse()
+    logger.info("Built context for conversation %s: %s messages, %s/%s tokens", state.conversation_id, len(history), used, budget)
+    return head + history + tail, used
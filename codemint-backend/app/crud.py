@@ -1,92 +1,469 @@
 import logging
+from typing import List
+from sqlalchemy import select, insert, update, delete, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from . import models, schemas
+from .tracing import traced
 from datetime import datetime
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
 # --- User CRUD Operations ---
+@traced
 def get_user(db: Session, user_id: int):
     user = db.query(models.User).filter(models.User.id == user_id).first()
     if user:
-        logger.info(f"Retrieved user {user.id}")
+        logger.info("Retrieved user %s", user.id)
     else:
-        logger.warning(f"User {user_id} not found.")
+        logger.warning("User %s not found.", user_id)
     return user
 
+@traced
 def get_user_by_email(db: Session, email: str):
     user = db.query(models.User).filter(models.User.email == email).first()
     if user:
-        logger.info(f"Retrieved user with email {email}")
+        logger.info("Retrieved user with email %s", email)
     else:
-        logger.warning(f"User with email {email} not found.")
+        logger.warning("User with email %s not found.", email)
     return user
 
+@traced
 def create_user(db: Session, user: schemas.UserCreate):
     fake_hashed_password = user.password + "notreallyhashed"
     db_user = models.User(email=user.email, hashed_password=fake_hashed_password)
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
-    logger.info(f"Created new user {db_user.id}")
+    logger.info("Created new user %s", db_user.id)
     return db_user
 
 # --- Session CRUD Operations ---
+@traced
 def get_session(db: Session, session_id: int):
     session = db.query(models.Session).filter(models.Session.id == session_id).first()
     if session:
-        logger.info(f"Retrieved session {session.id}")
+        logger.info("Retrieved session %s", session.id)
     else:
-        logger.warning(f"Session {session_id} not found.")
+        logger.warning("Session %s not found.", session_id)
     return session
 
+@traced
 def create_session(db: Session, session: schemas.SessionCreate):
     db_session = models.Session(**session.dict())
     db.add(db_session)
     db.commit()
     db.refresh(db_session)
-    logger.info(f"Created new session {db_session.id}")
+    logger.info("Created new session %s", db_session.id)
     return db_session
 
+@traced
 def update_session(db: Session, session_id: int):
     session = db.query(models.Session).filter(models.Session.id == session_id).first()
     if session:
         session.updated_at = datetime.utcnow()
         db.commit()
         db.refresh(session)
-        logger.info(f"Updated session {session.id}")
+        logger.info("Updated session %s", session.id)
     else:
-        logger.warning(f"Session {session_id} not found.")
+        logger.warning("Session %s not found.", session_id)
     return session
 
+@traced
+def create_session_with_conversation(db: Session, session: schemas.SessionCreate):
+    # First contact: one transaction for the session and its first conversation
+    db_session = models.Session(**session.dict())
+    db.add(db_session)
+    db.flush()
+    db_conversation = models.Conversation(session_id=db_session.id)
+    db.add(db_conversation)
+    db.commit()
+    logger.info("Created new session %s with conversation %s", db_session.id, db_conversation.id)
+    return db_session, db_conversation
+
 # --- Conversation CRUD Operations ---
+@traced
 def get_conversation(db: Session, conversation_id: int):
     conversation = db.query(models.Conversation).filter(models.Conversation.id == conversation_id).first()
     if conversation:
-        logger.info(f"Retrieved conversation {conversation.id} for session {conversation.session_id}")
+        logger.info("Retrieved conversation %s for session %s", conversation.id, conversation.session_id)
     else:
-        logger.warning(f"Conversation {conversation_id} not found.")
+        logger.warning("Conversation %s not found.", conversation_id)
     return conversation
 
+@traced
+def get_latest_conversation(db: Session, session_id: int):
+    # Most recently active conversation of a session; new ones have no updated_at yet
+    conversation = (
+        db.query(models.Conversation)
+        .filter(models.Conversation.session_id == session_id)
+        .order_by(models.Conversation.updated_at.desc().nullslast(), models.Conversation.id.desc())
+        .first()
+    )
+    if conversation:
+        logger.info("Retrieved conversation %s for session %s", conversation.id, session_id)
+    else:
+        logger.warning("No conversation found for session %s.", session_id)
+    return conversation
+
+@traced
 def create_conversation(db: Session, conversation: schemas.ConversationCreate):
     db_conversation = models.Conversation(**conversation.dict())
     db.add(db_conversation)
     db.commit()
     db.refresh(db_conversation)
-    logger.info(f"Created new conversation {db_conversation.id} for session {db_conversation.session_id}")
+    logger.info("Created new conversation %s for session %s", db_conversation.id, db_conversation.session_id)
     return db_conversation
 
 # --- Message CRUD Operations ---
+@traced
 def create_message(db: Session, message: schemas.MessageCreate):
     db_message = models.Message(**message.dict())
     db.add(db_message)
     db.commit()
     db.refresh(db_message)
-    logger.info(f"Created new message {db_message.id} in conversation {db_message.conversation_id}")
+    logger.info("Created new message %s in conversation %s", db_message.id, db_message.conversation_id)
     return db_message
 
+@traced
 def get_conversation_messages(db: Session, conversation_id: int, limit: int = 100):
     messages = db.query(models.Message).filter(models.Message.conversation_id == conversation_id).order_by(models.Message.created_at.asc()).limit(limit).all()
-    logger.info(f"Retrieved {len(messages)} messages for conversation {conversation_id}")
+    logger.info("Retrieved %s messages for conversation %s", len(messages), conversation_id)
+    return messages
+
+@traced
+def create_chat_turns(db: Session, messages: List[schemas.MessageCreate], session_ids: List[int]):
+    # Bulk insert a batch of messages and bump the touched conversations and sessions in a single transaction
+    if messages:
+        db.execute(insert(models.Message), [message.dict() for message in messages])
+        db.execute(
+            update(models.Conversation)
+            .where(models.Conversation.id.in_({message.conversation_id for message in messages}))
+            .values(updated_at=func.now())
+            .execution_options(synchronize_session=False)
+        )
+    if session_ids:
+        db.execute(
+            update(models.Session)
+            .where(models.Session.id.in_(set(session_ids)))
+            .values(updated_at=func.now())
+            .execution_options(synchronize_session=False)
+        )
+    db.commit()
+    logger.info("Saved %s messages for %s sessions", len(messages), len(set(session_ids)))
+
+@traced
+def get_messages_before(db: Session, conversation_id: int, before_id: int = None, after_id: int = None, limit: int = 50):
+    # Keyset page of a conversation's history, newest first
+    query = db.query(models.Message).filter(models.Message.conversation_id == conversation_id)
+    if before_id is not None:
+        query = query.filter(models.Message.id < before_id)
+    if after_id is not None:
+        query = query.filter(models.Message.id > after_id)
+    messages = query.order_by(models.Message.id.desc()).limit(limit).all()
+    logger.info("Retrieved %s messages before %s for conversation %s", len(messages), before_id, conversation_id)
+    return messages
+
+@traced
+def get_messages_between(db: Session, conversation_id: int, after_id: int = None, before_id: int = None, limit: int = 200):
+    # Keyset page of a conversation's history, oldest first
+    query = db.query(models.Message).filter(models.Message.conversation_id == conversation_id)
+    if after_id is not None:
+        query = query.filter(models.Message.id > after_id)
+    if before_id is not None:
+        query = query.filter(models.Message.id < before_id)
+    messages = query.order_by(models.Message.id.asc()).limit(limit).all()
+    logger.info("Retrieved %s messages between %s and %s for conversation %s", len(messages), after_id, before_id, conversation_id)
     return messages
+
+# --- Conversation Summary CRUD Operations ---
+@traced
+def get_conversation_summary(db: Session, conversation_id: int):
+    return db.query(models.ConversationSummary).filter(models.ConversationSummary.conversation_id == conversation_id).first()
+
+@traced
+def upsert_conversation_summary(db: Session, conversation_id: int, content: str, last_message_id: int, token_count: int):
+    summary = get_conversation_summary(db, conversation_id)
+    if summary is None:
+        summary = models.ConversationSummary(conversation_id=conversation_id)
+        db.add(summary)
+    summary.content = content
+    summary.last_message_id = last_message_id
+    summary.token_count = token_count
+    db.commit()
+    db.refresh(summary)
+    logger.info("Stored summary for conversation %s up to message %s", conversation_id, last_message_id)
+    return summary
+
+# --- Async CRUD Operations ---
+# Equivalents of the functions above for an AsyncSession, used by the async routes
+
+@traced
+async def get_user_async(db: AsyncSession, user_id: int):
+    user = (await db.execute(select(models.User).filter(models.User.id == user_id))).scalars().first()
+    if user:
+        logger.info("Retrieved user %s", user.id)
+    else:
+        logger.warning("User %s not found.", user_id)
+    return user
+
+@traced
+async def get_user_by_email_async(db: AsyncSession, email: str):
+    user = (await db.execute(select(models.User).filter(models.User.email == email))).scalars().first()
+    if user:
+        logger.info("Retrieved user with email %s", email)
+    else:
+        logger.warning("User with email %s not found.", email)
+    return user
+
+@traced
+async def create_user_async(db: AsyncSession, user: schemas.UserCreate):
+    fake_hashed_password = user.password + "notreallyhashed"
+    db_user = models.User(email=user.email, hashed_password=fake_hashed_password)
+    db.add(db_user)
+    await db.commit()
+    await db.refresh(db_user)
+    logger.info("Created new user %s", db_user.id)
+    return db_user
+
+@traced
+async def get_session_async(db: AsyncSession, session_id: int):
+    session = (await db.execute(select(models.Session).filter(models.Session.id == session_id))).scalars().first()
+    if session:
+        logger.info("Retrieved session %s", session.id)
+    else:
+        logger.warning("Session %s not found.", session_id)
+    return session
+
+@traced
+async def create_session_async(db: AsyncSession, session: schemas.SessionCreate):
+    db_session = models.Session(**session.dict())
+    db.add(db_session)
+    await db.commit()
+    await db.refresh(db_session)
+    logger.info("Created new session %s", db_session.id)
+    return db_session
+
+@traced
+async def update_session_async(db: AsyncSession, session_id: int):
+    session = await get_session_async(db, session_id)
+    if session:
+        session.updated_at = datetime.utcnow()
+        await db.commit()
+        await db.refresh(session)
+        logger.info("Updated session %s", session.id)
+    return session
+
+@traced
+async def create_session_with_conversation_async(db: AsyncSession, session: schemas.SessionCreate):
+    db_session = models.Session(**session.dict())
+    db.add(db_session)
+    await db.flush()
+    db_conversation = models.Conversation(session_id=db_session.id)
+    db.add(db_conversation)
+    await db.commit()
+    logger.info("Created new session %s with conversation %s", db_session.id, db_conversation.id)
+    return db_session, db_conversation
+
+@traced
+async def get_conversation_async(db: AsyncSession, conversation_id: int):
+    conversation = (await db.execute(select(models.Conversation).filter(models.Conversation.id == conversation_id))).scalars().first()
+    if conversation:
+        logger.info("Retrieved conversation %s for session %s", conversation.id, conversation.session_id)
+    else:
+        logger.warning("Conversation %s not found.", conversation_id)
+    return conversation
+
+@traced
+async def get_latest_conversation_async(db: AsyncSession, session_id: int):
+    query = (
+        select(models.Conversation)
+        .filter(models.Conversation.session_id == session_id)
+        .order_by(models.Conversation.updated_at.desc().nullslast(), models.Conversation.id.desc())
+        .limit(1)
+    )
+    conversation = (await db.execute(query)).scalars().first()
+    if conversation:
+        logger.info("Retrieved conversation %s for session %s", conversation.id, session_id)
+    else:
+        logger.warning("No conversation found for session %s.", session_id)
+    return conversation
+
+@traced
+async def create_conversation_async(db: AsyncSession, conversation: schemas.ConversationCreate):
+    db_conversation = models.Conversation(**conversation.dict())
+    db.add(db_conversation)
+    await db.commit()
+    await db.refresh(db_conversation)
+    logger.info("Created new conversation %s for session %s", db_conversation.id, db_conversation.session_id)
+    return db_conversation
+
+@traced
+async def create_message_async(db: AsyncSession, message: schemas.MessageCreate):
+    db_message = models.Message(**message.dict())
+    db.add(db_message)
+    await db.commit()
+    await db.refresh(db_message)
+    logger.info("Created new message %s in conversation %s", db_message.id, db_message.conversation_id)
+    return db_message
+
+@traced
+async def get_conversation_messages_async(db: AsyncSession, conversation_id: int, limit: int = 100):
+    query = select(models.Message).filter(models.Message.conversation_id == conversation_id).order_by(models.Message.created_at.asc()).limit(limit)
+    messages = (await db.execute(query)).scalars().all()
+    logger.info("Retrieved %s messages for conversation %s", len(messages), conversation_id)
+    return messages
+
+@traced
+async def create_chat_turns_async(db: AsyncSession, messages: List[schemas.MessageCreate], session_ids: List[int]):
+    if messages:
+        await db.execute(insert(models.Message), [message.dict() for message in messages])
+        await db.execute(
+            update(models.Conversation)
+            .where(models.Conversation.id.in_({message.conversation_id for message in messages}))
+            .values(updated_at=func.now())
+            .execution_options(synchronize_session=False)
+        )
+    if session_ids:
+        await db.execute(
+            update(models.Session)
+            .where(models.Session.id.in_(set(session_ids)))
+            .values(updated_at=func.now())
+            .execution_options(synchronize_session=False)
+        )
+    await db.commit()
+    logger.info("Saved %s messages for %s sessions", len(messages), len(set(session_ids)))
+
+@traced
+async def get_messages_before_async(db: AsyncSession, conversation_id: int, before_id: int = None, after_id: int = None, limit: int = 50):
+    query = select(models.Message).filter(models.Message.conversation_id == conversation_id)
+    if before_id is not None:
+        query = query.filter(models.Message.id < before_id)
+    if after_id is not None:
+        query = query.filter(models.Message.id > after_id)
+    messages = (await db.execute(query.order_by(models.Message.id.desc()).limit(limit))).scalars().all()
+    logger.info("Retrieved %s messages before %s for conversation %s", len(messages), before_id, conversation_id)
+    return messages
+
+@traced
+async def get_messages_between_async(db: AsyncSession, conversation_id: int, after_id: int = None, before_id: int = None, limit: int = 200):
+    query = select(models.Message).filter(models.Message.conversation_id == conversation_id)
+    if after_id is not None:
+        query = query.filter(models.Message.id > after_id)
+    if before_id is not None:
+        query = query.filter(models.Message.id < before_id)
+    messages = (await db.execute(query.order_by(models.Message.id.asc()).limit(limit))).scalars().all()
+    logger.info("Retrieved %s messages between %s and %s for conversation %s", len(messages), after_id, before_id, conversation_id)
+    return messages
+
+@traced
+async def get_conversation_summary_async(db: AsyncSession, conversation_id: int):
+    query = select(models.ConversationSummary).filter(models.ConversationSummary.conversation_id == conversation_id)
+    return (await db.execute(query)).scalars().first()
+
+@traced
+async def upsert_conversation_summary_async(db: AsyncSession, conversation_id: int, content: str, last_message_id: int, token_count: int):
+    summary = await get_conversation_summary_async(db, conversation_id)
+    if summary is None:
+        summary = models.ConversationSummary(conversation_id=conversation_id)
+        db.add(summary)
+    summary.content = content
+    summary.last_message_id = last_message_id
+    summary.token_count = token_count
+    await db.commit()
+    logger.info("Stored summary for conversation %s up to message %s", conversation_id, last_message_id)
+    return summary
+
+# --- Cold-tier archive operations ---
+
+@traced
+async def get_idle_conversation_ids_async(db: AsyncSession, idle_before: datetime, after_id: int = 0, limit: int = 100):
+    # Conversations that still have rows in messages, saw no activity since idle_before and
+    # have no archive yet, in id order so a pass can resume after the last one it saw
+    conversation_id = models.Conversation.id
+    has_messages = select(models.Message.id).filter(models.Message.conversation_id == conversation_id).exists()
+    recent = select(models.Message.id).filter(models.Message.conversation_id == conversation_id, models.Message.created_at >= idle_before).exists()
+    archived = select(models.ConversationArchive.id).filter(models.ConversationArchive.conversation_id == conversation_id).exists()
+    query = (
+        select(conversation_id)
+        .filter(conversation_id > after_id)
+        .filter(func.coalesce(models.Conversation.updated_at, models.Conversation.created_at) < idle_before)
+        .filter(has_messages, ~recent, ~archived)
+        .order_by(conversation_id)
+        .limit(limit)
+    )
+    return (await db.execute(query)).scalars().all()
+
+@traced
+async def archive_conversation_async(db: AsyncSession, archive: models.ConversationArchive, idle_before: datetime):
+    # Stores the archive and deletes the rows it holds in one transaction. Gives up (returns
+    # None) if the conversation saw any activity since its messages were read, so a live chat
+    # never loses a turn. On PostgreSQL the row lock also waits out in-flight message inserts,
+    # whose foreign-key check holds a share lock on the conversation.
+    conversation_id = archive.conversation_id
+    idle = (await db.execute(
+        select(models.Conversation.id)
+        .filter(models.Conversation.id == conversation_id)
+        .filter(func.coalesce(models.Conversation.updated_at, models.Conversation.created_at) < idle_before)
+        .with_for_update()
+    )).first()
+    if idle is None:
+        await db.rollback()
+        return None
+    db.add(archive)
+    try:
+        await db.flush()
+    except IntegrityError:
+        # Another pass archived it first
+        await db.rollback()
+        return None
+    deleted = (await db.execute(
+        delete(models.Message)
+        .where(models.Message.conversation_id == conversation_id, models.Message.id <= archive.last_message_id)
+        .execution_options(synchronize_session=False)
+    )).rowcount
+    newer = (await db.execute(select(models.Message.id).filter(models.Message.conversation_id == conversation_id, models.Message.id > archive.last_message_id).limit(1))).first()
+    if deleted != archive.message_count or newer is not None:
+        await db.rollback()
+        logger.info("Conversation %s changed while being archived; left in place", conversation_id)
+        return None
+    await db.commit()
+    logger.info("Archived %s messages of conversation %s", deleted, conversation_id)
+    return archive
+
+@traced
+async def get_conversation_archive_async(db: AsyncSession, conversation_id: int):
+    query = select(models.ConversationArchive).filter(models.ConversationArchive.conversation_id == conversation_id)
+    return (await db.execute(query)).scalars().first()
+
+@traced
+async def restore_conversation_async(db: AsyncSession, archive_id: int, conversation_id: int, messages: List[dict]):
+    # Puts the rows back under their original ids and drops the archive in one transaction.
+    # Returns False when another request restored it first; that one's delete holds the row
+    # until it commits, so this one then finds nothing to delete.
+    removed = (await db.execute(delete(models.ConversationArchive).where(models.ConversationArchive.id == archive_id))).rowcount
+    if not removed:
+        # Commit rather than roll back: a rollback would expire what the caller already loaded
+        await db.commit()
+        return False
+    if messages:
+        await db.execute(insert(models.Message), messages)
+    # Counts as activity, so the next archiving pass leaves it alone until it is idle again
+    await db.execute(
+        update(models.Conversation)
+        .where(models.Conversation.id == conversation_id)
+        .values(updated_at=func.now())
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    logger.info("Restored %s archived messages of conversation %s", len(messages), conversation_id)
+    return True
+
+@traced
+async def get_archive_totals_async(db: AsyncSession):
+    archive = models.ConversationArchive
+    query = select(func.count(archive.id), func.sum(archive.message_count), func.sum(archive.raw_bytes), func.sum(archive.stored_bytes))
+    conversations, messages, raw_bytes, stored_bytes = (await db.execute(query)).one()
+    return {"conversations": conversations, "messages": messages or 0, "raw_bytes": raw_bytes or 0, "stored_bytes": stored_bytes or 0}
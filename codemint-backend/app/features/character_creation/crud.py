@@ -1,19 +1,75 @@
+import asyncio
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+from app.cache import character_cache, character_catalog, VERSIONS_COHERENT
+from app.prompts import prompt_cache
+from app.tracing import traced
 from . import models, schemas
+from .search import character_search, CATALOG
 
+# Always in a catalog listing; description, persona and first_message are opt-in
+SUMMARY_COLUMNS = ("id", "name", "avatar_url", "gender_identity", "sexual_orientation", "creator_id")
+OPTIONAL_COLUMNS = ("description", "persona", "first_message")
+
+# The app's event loop, where the shared caches and the search index live; set at startup
+_loop = None
+
+async def startup():
+    global _loop
+    _loop = asyncio.get_running_loop()
+
+def run_invalidation(coroutine):
+    # The sync functions run in worker threads or scripts, never on the loop itself: hand the
+    # invalidation to the app's loop when it is running, otherwise run it on a loop of its own
+    if _loop is not None and _loop.is_running():
+        return asyncio.run_coroutine_threadsafe(coroutine, _loop).result()
+    return asyncio.run(coroutine)
+
+# Every write, sync or async, ends in one of these
+
+async def character_created(db_character):
+    version = await character_catalog.invalidate(CATALOG)
+    await character_search.index_character(db_character, version)
+
+async def character_updated(db_character):
+    await character_cache.invalidate(db_character.id)
+    prompt_cache.invalidate(db_character.id)
+    version = await character_catalog.invalidate(CATALOG)
+    await character_search.index_character(db_character, version)
+
+async def character_deleted(character_id):
+    await character_cache.invalidate(character_id)
+    prompt_cache.invalidate(character_id)
+    version = await character_catalog.invalidate(CATALOG)
+    await character_search.remove_character(character_id, version)
+
+@traced
 def get_character(db: Session, character_id: int):
     return db.query(models.Character).filter(models.Character.id == character_id).first()
 
+@traced
 def get_characters(db: Session, skip: int = 0, limit: int = 100):
     return db.query(models.Character).offset(skip).limit(limit).all()
 
+@traced
+def get_characters_page(db: Session, after: int = None, limit: int = 100, fields=()):
+    columns = [getattr(models.Character, name) for name in SUMMARY_COLUMNS + tuple(fields)]
+    query = select(*columns).order_by(models.Character.id).limit(limit)
+    if after is not None:
+        query = query.filter(models.Character.id > after)
+    return db.execute(query).mappings().all()
+
+@traced
 def create_character(db: Session, character: schemas.CharacterCreate, creator_id: int):
     db_character = models.Character(**character.dict(), creator_id=creator_id)
     db.add(db_character)
     db.commit()
     db.refresh(db_character)
+    run_invalidation(character_created(db_character))
     return db_character
 
+@traced
 def update_character(db: Session, character_id: int, character: schemas.CharacterCreate):
     db_character = get_character(db, character_id)
     if db_character:
@@ -23,11 +79,87 @@ def update_character(db: Session, character_id: int, character: schemas.Characte
         db.add(db_character)
         db.commit()
         db.refresh(db_character)
+        run_invalidation(character_updated(db_character))
     return db_character
 
+@traced
 def delete_character(db: Session, character_id: int):
     db_character = get_character(db, character_id)
     if db_character:
         db.delete(db_character)
         db.commit()
-    return db_character
\ No newline at end of file
+        run_invalidation(character_deleted(character_id))
+    return db_character
+
+# Async equivalents for use with an AsyncSession
+
+@traced
+async def get_character_async(db: AsyncSession, character_id: int):
+    return (await db.execute(select(models.Character).filter(models.Character.id == character_id))).scalars().first()
+
+@traced
+async def get_character_cached_async(db: AsyncSession, character_id: int):
+    # Read-through the shared character cache; the version is read first so a concurrent
+    # update can only ever leave a stale copy under a key nobody reads any more
+    if not VERSIONS_COHERENT:
+        return await get_character_async(db, character_id)
+    data, version = await character_cache.get(character_id)
+    if data is not None:
+        return schemas.Character(**data)
+    db_character = await get_character_async(db, character_id)
+    if db_character:
+        await character_cache.set(character_id, schemas.Character.from_orm(db_character).dict(), version=version)
+    return db_character
+
+@traced
+async def get_characters_async(db: AsyncSession, skip: int = 0, limit: int = 100):
+    return (await db.execute(select(models.Character).offset(skip).limit(limit))).scalars().all()
+
+@traced
+async def get_characters_page_async(db: AsyncSession, after: int = None, limit: int = 100, fields=()):
+    # Keyset pagination on id: a deep page costs the same as the first one. Only the summary
+    # columns plus the requested text columns are read.
+    columns = [getattr(models.Character, name) for name in SUMMARY_COLUMNS + tuple(fields)]
+    query = select(*columns).order_by(models.Character.id).limit(limit)
+    if after is not None:
+        query = query.filter(models.Character.id > after)
+    return (await db.execute(query)).mappings().all()
+
+@traced
+async def get_characters_by_ids_async(db: AsyncSession, character_ids, fields=()):
+    columns = [getattr(models.Character, name) for name in SUMMARY_COLUMNS + tuple(fields)]
+    return (await db.execute(select(*columns).filter(models.Character.id.in_(character_ids)))).mappings().all()
+
+async def catalog_version():
+    return await character_catalog.version(CATALOG)
+
+@traced
+async def create_character_async(db: AsyncSession, character: schemas.CharacterCreate, creator_id: int):
+    db_character = models.Character(**character.dict(), creator_id=creator_id)
+    db.add(db_character)
+    await db.commit()
+    await db.refresh(db_character)
+    await character_created(db_character)
+    return db_character
+
+@traced
+async def update_character_async(db: AsyncSession, character_id: int, character: schemas.CharacterCreate):
+    db_character = await get_character_async(db, character_id)
+    if db_character:
+        update_data = character.dict(exclude_unset=True)
+        for key, value in update_data.items():
+            setattr(db_character, key, value)
+        db.add(db_character)
+        await db.commit()
+        await db.refresh(db_character)
+        await character_updated(db_character)
+    return db_character
+
+@traced
+async def delete_character_async(db: AsyncSession, character_id: int):
+    db_character = await get_character_async(db, character_id)
+    if db_character:
+        await db.delete(db_character)
+        await db.commit()
+        await character_deleted(character_id)
+    return db_character
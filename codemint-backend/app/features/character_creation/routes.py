@@ -1,37 +1,129 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from typing import List
-from app.database import get_db
+import hashlib
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
+from app.cache import character_cache, VERSION_EPOCH, VERSIONS_COHERENT
+from app.cache_backends import CACHE_KEY_PREFIX
+from app.database import get_async_db
 from . import crud, schemas
+from .search import character_search
 
 router = APIRouter()
 
+# Clients may keep what they fetched but must revalidate it with If-None-Match before use
+CACHE_CONTROL = "private, no-cache"
+
+
+def make_etag(*parts):
+    # Strong ETag over the representation's inputs: the version it was read at and the query.
+    # Callers skip it unless VERSIONS_COHERENT, as another worker's write would not change it.
+    digest = hashlib.sha256(repr((CACHE_KEY_PREFIX, VERSION_EPOCH) + parts).encode("utf-8")).hexdigest()[:32]
+    return f'"{digest}"'
+
+
+def not_modified(request: Request, etag: Optional[str]):
+    # If-None-Match compares weakly, so a W/ prefix on the client's copy is ignored
+    header = request.headers.get("if-none-match")
+    if not header or etag is None:
+        return False
+    if header.strip() == "*":
+        return True
+    tags = (tag.strip() for tag in header.split(","))
+    return any((tag[2:] if tag.startswith("W/") else tag) == etag for tag in tags)
+
+
+def cached_response(response: Response, etag: Optional[str]):
+    if etag is not None:
+        response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = CACHE_CONTROL
+
+
+def parse_fields(fields: str):
+    requested = tuple(dict.fromkeys(name.strip() for name in fields.split(",") if name.strip()))
+    unknown = set(requested) - set(crud.OPTIONAL_COLUMNS)
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Unknown fields: {', '.join(sorted(unknown))}; choose from {', '.join(crud.OPTIONAL_COLUMNS)}")
+    return requested
+
+
 @router.post("/characters/", response_model=schemas.Character)
-def create_character(character: schemas.CharacterCreate, db: Session = Depends(get_db)):
-    return crud.create_character(db=db, character=character, creator_id=1)  # TODO: Get actual user id
+async def create_character(character: schemas.CharacterCreate, db: AsyncSession = Depends(get_async_db)):
+    return await crud.create_character_async(db=db, character=character, creator_id=1)  # TODO: Get actual user id
+
+@router.get("/characters/", response_model=List[schemas.CharacterSummary], response_model_exclude_unset=True)
+async def read_characters(
+    request: Request,
+    response: Response,
+    after: Optional[int] = Query(None, description="Return characters with an id above this cursor (X-Next-Cursor of the previous page)"),
+    limit: int = Query(100, ge=1, le=500),
+    fields: str = Query("", description="Comma-separated text columns to include: description, persona, first_message"),
+    db: AsyncSession = Depends(get_async_db),
+):
+    # Offset paging is gone; an old caller must not be handed page one over and over
+    if "skip" in request.query_params:
+        raise HTTPException(status_code=400, detail="skip is no longer supported; page with after=<X-Next-Cursor of the previous page>")
+    requested = parse_fields(fields)
+    # The version is read before the rows, so a concurrent write can only make the ETag stale
+    # (one extra 200 later), never pair new rows with an old ETag's 304
+    etag = make_etag("list", await crud.catalog_version(), after, limit, requested) if VERSIONS_COHERENT else None
+    if not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": CACHE_CONTROL})
 
-@router.get("/characters/", response_model=List[schemas.Character])
-def read_characters(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    characters = crud.get_characters(db, skip=skip, limit=limit)
-    return characters
+    rows = await crud.get_characters_page_async(db, after=after, limit=limit, fields=requested)
+    cached_response(response, etag)
+    if len(rows) == limit:
+        cursor = rows[-1]["id"]
+        query = f"after={cursor}&limit={limit}" + (f"&fields={','.join(requested)}" if requested else "")
+        response.headers["X-Next-Cursor"] = str(cursor)
+        response.headers["Link"] = f'<{request.url.path}?{query}>; rel="next"'
+    return [schemas.CharacterSummary(**row) for row in rows]
+
+@router.get("/characters/search", response_model=List[schemas.CharacterSearchResult], response_model_exclude_unset=True)
+async def search_characters(
+    q: str = Query(..., min_length=1, max_length=200, description="Words to find in name, description and persona; the last one may be a prefix"),
+    gender_identity: Optional[str] = None,
+    sexual_orientation: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0, le=1000),
+    fields: str = Query("", description="Comma-separated text columns to include: description, persona, first_message"),
+    db: AsyncSession = Depends(get_async_db),
+):
+    requested = parse_fields(fields)
+    filters = {"gender_identity": gender_identity, "sexual_orientation": sexual_orientation}
+    hits = await character_search.search(q, filters, limit=limit, offset=offset, catalog_version=await crud.catalog_version())
+    if hits is None:
+        raise HTTPException(status_code=503, detail="Search index is still being built", headers={"Retry-After": "5"})
+    if not hits:
+        return []
+    rows = {row["id"]: row for row in await crud.get_characters_by_ids_async(db, [character_id for character_id, _ in hits], fields=requested)}
+    # A hit whose row is gone was deleted by another worker since the index last synced
+    return [schemas.CharacterSearchResult(**rows[character_id], score=round(score, 4)) for character_id, score in hits if character_id in rows]
+
+@router.get("/characters/search/stats")
+async def search_stats():
+    return character_search.stats()
 
 @router.get("/characters/{character_id}", response_model=schemas.Character)
-def read_character(character_id: int, db: Session = Depends(get_db)):
-    db_character = crud.get_character(db, character_id=character_id)
+async def read_character(character_id: int, request: Request, response: Response, db: AsyncSession = Depends(get_async_db)):
+    etag = make_etag("detail", character_id, await character_cache.version(character_id)) if VERSIONS_COHERENT else None
+    if not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": CACHE_CONTROL})
+    db_character = await crud.get_character_cached_async(db, character_id=character_id)
     if db_character is None:
         raise HTTPException(status_code=404, detail="Character not found")
+    cached_response(response, etag)
     return db_character
 
 @router.put("/characters/{character_id}", response_model=schemas.Character)
-def update_character(character_id: int, character: schemas.CharacterCreate, db: Session = Depends(get_db)):
-    db_character = crud.update_character(db, character_id=character_id, character=character)
+async def update_character(character_id: int, character: schemas.CharacterCreate, db: AsyncSession = Depends(get_async_db)):
+    db_character = await crud.update_character_async(db, character_id=character_id, character=character)
     if db_character is None:
         raise HTTPException(status_code=404, detail="Character not found")
     return db_character
 
 @router.delete("/characters/{character_id}", response_model=schemas.Character)
-def delete_character(character_id: int, db: Session = Depends(get_db)):
-    db_character = crud.delete_character(db, character_id=character_id)
+async def delete_character(character_id: int, db: AsyncSession = Depends(get_async_db)):
+    db_character = await crud.delete_character_async(db, character_id=character_id)
     if db_character is None:
         raise HTTPException(status_code=404, detail="Character not found")
-    return db_character
\ No newline at end of file
+    return db_character
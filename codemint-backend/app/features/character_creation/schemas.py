@@ -1,3 +1,4 @@
+from typing import Optional
 from pydantic import BaseModel
 
 class CharacterBase(BaseModel):
@@ -17,4 +18,19 @@ class Character(CharacterBase):
     creator_id: int
 
     class Config:
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+
+class CharacterSummary(BaseModel):
+    # Catalog listing: the large text columns are only present when asked for with ?fields=
+    id: int
+    name: str
+    avatar_url: str
+    gender_identity: str
+    sexual_orientation: str
+    creator_id: int
+    description: Optional[str]
+    persona: Optional[str]
+    first_message: Optional[str]
+
+class CharacterSearchResult(CharacterSummary):
+    score: float
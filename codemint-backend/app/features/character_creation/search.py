@@ -0,0 +1,512 @@
+import os
+import re
+import math
+import time
+import heapq
+import asyncio
+import logging
+from array import array
+from bisect import bisect_left
+from starlette.concurrency import run_in_threadpool
+from app.cache import character_catalog
+from app.database import SessionLocal, AsyncSessionLocal
+from app.tracing import traced
+
+logger = logging.getLogger(__name__)
+
+# "memory" keeps an inverted index in each worker; "elasticsearch" uses one shared cluster
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "memory")
+ELASTICSEARCH_URL = os.getenv("ELASTICSEARCH_URL", "http://localhost:9200")
+ELASTICSEARCH_INDEX = os.getenv("ELASTICSEARCH_INDEX", "characters")
+# Postings lists longer than this are not scanned in full: only their SEARCH_TOP_IMPACTS best
+# entries are, plus an exact lookup for the documents rarer query terms already matched
+SEARCH_FULL_SCAN_LIMIT = int(os.getenv("SEARCH_FULL_SCAN_LIMIT", "2048"))
+SEARCH_TOP_IMPACTS = int(os.getenv("SEARCH_TOP_IMPACTS", "256"))
+# Completions of the last word and one-edit corrections of each word, by document frequency
+SEARCH_PREFIX_EXPANSIONS = int(os.getenv("SEARCH_PREFIX_EXPANSIONS", "8"))
+SEARCH_TYPO_EXPANSIONS = int(os.getenv("SEARCH_TYPO_EXPANSIONS", "5"))
+# When another worker writes to the catalog this one rebuilds from the database, at most this often
+SEARCH_RESYNC_INTERVAL = float(os.getenv("SEARCH_RESYNC_INTERVAL", "60"))
+SEARCH_BUILD_BATCH = int(os.getenv("SEARCH_BUILD_BATCH", "2000"))
+
+FIELD_WEIGHTS = (("name", 3.0), ("description", 1.0), ("persona", 1.0))
+FILTER_FIELDS = ("gender_identity", "sexual_orientation")
+K1 = 1.2
+B = 0.75
+# BM25 term-frequency components are stored as one byte each, in units of 1/IMPACT_SCALE
+IMPACT_SCALE = 32
+PREFIX_WEIGHT = 0.8
+TYPO_WEIGHT = 0.5
+MIN_PREFIX_LENGTH = 2
+MIN_TYPO_LENGTH = 4
+# Candidates from rarer terms that a common term is looked up for
+CANDIDATE_LIMIT = 500
+# A word (with its completions) found in at least this many documents is taken as spelled correctly
+TYPO_MAX_DF = 8
+# Past this share of superseded documents the index is rebuilt to reclaim their postings
+MAX_DEAD_RATIO = 0.3
+TYPO_ALPHABET = "abcdefghijklmnopqrstuvwxyz0123456789"
+TOKEN_RE = re.compile(r"\w+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have he her his i in is it its me my of on or "
+    "our she so that the their them they this to was we were who will with you your".split()
+)
+CATALOG = "all"
+
+
+def tokenize(text):
+    return [token for token in TOKEN_RE.findall(text.lower()) if token not in STOPWORDS and len(token) <= 32]
+
+
+def edits1(word):
+    # Every string one deletion, transposition, replacement or insertion away
+    splits = [(word[:i], word[i:]) for i in range(len(word) + 1)]
+    deletes = [left + right[1:] for left, right in splits if right]
+    transposes = [left + right[1] + right[0] + right[2:] for left, right in splits if len(right) > 1]
+    replaces = [left + c + right[1:] for left, right in splits if right for c in TYPO_ALPHABET]
+    inserts = [left + c + right for left, right in splits for c in TYPO_ALPHABET]
+    return set(deletes + transposes + replaces + inserts)
+
+
+def document(character):
+    return {field: getattr(character, field) for field in ("name", "description", "persona") + FILTER_FIELDS}
+
+
+class Postings:
+    # Ordinals only ever grow, so each list stays sorted and can be searched with bisect
+    __slots__ = ("ordinals", "impacts", "top", "top_floor")
+
+    def __init__(self):
+        self.ordinals = array("I")
+        self.impacts = array("B")
+        # The best entries, packed as impact << 32 | ordinal, kept once the list is too long to scan
+        self.top = None
+        self.top_floor = 0
+
+    def add(self, ordinal, impact):
+        self.ordinals.append(ordinal)
+        self.impacts.append(impact)
+        if self.top is not None:
+            if impact >= self.top_floor:
+                self.top.append(impact << 32 | ordinal)
+                if len(self.top) >= 2 * SEARCH_TOP_IMPACTS:
+                    self._keep_top(self.top)
+        elif len(self.ordinals) > SEARCH_FULL_SCAN_LIMIT:
+            self.rebuild_top()
+
+    def _keep_top(self, packed):
+        self.top = array("Q", heapq.nlargest(SEARCH_TOP_IMPACTS, packed))
+        self.top_floor = self.top[-1] >> 32 if len(self.top) == SEARCH_TOP_IMPACTS else 0
+
+    def rebuild_top(self, alive=None):
+        packed = (impact << 32 | ordinal for impact, ordinal in zip(self.impacts, self.ordinals) if alive is None or alive[ordinal])
+        self._keep_top(packed)
+
+    def impact_of(self, ordinal):
+        i = bisect_left(self.ordinals, ordinal)
+        if i < len(self.ordinals) and self.ordinals[i] == ordinal:
+            return self.impacts[i]
+        return 0
+
+    def compact(self, alive):
+        keep = [i for i, ordinal in enumerate(self.ordinals) if alive[ordinal]]
+        self.ordinals = array("I", (self.ordinals[i] for i in keep))
+        self.impacts = array("B", (self.impacts[i] for i in keep))
+
+
+class InvertedIndex:
+    # BM25 over name, description and persona (name weighted up). A write appends the new
+    # version of a character under a fresh ordinal and marks the old one dead; dead postings
+    # are dropped when a scan finds enough of them, and by a rebuild past MAX_DEAD_RATIO.
+
+    def __init__(self):
+        self.postings = {}
+        # Sorted, for completions; terms added since the last merge wait in new_terms
+        self.vocabulary = []
+        self.new_terms = []
+        self.doc_ids = array("q")
+        self.lengths = array("f")
+        self.alive = bytearray()
+        # One code per document and field; "I" leaves room for billions of distinct values
+        self.facets = {field: array("I") for field in FILTER_FIELDS}
+        self.facet_codes = {field: {} for field in FILTER_FIELDS}
+        self.ordinal_of = {}
+        self.live_docs = 0
+        self.dead_docs = 0
+        self.total_length = 0.0
+
+    def _facet_code(self, field, value, create=False):
+        # 0 stands for no value; filter values compare case-insensitively
+        if not value:
+            return 0
+        codes = self.facet_codes[field]
+        value = value.strip().lower()
+        code = codes.get(value)
+        if code is None and create:
+            code = codes[value] = len(codes) + 1
+        return code
+
+    def add(self, character_id, doc):
+        self.remove(character_id)
+        weighted = {}
+        length = 0.0
+        for field, weight in FIELD_WEIGHTS:
+            terms = tokenize(doc.get(field) or "")
+            length += weight * len(terms)
+            for term in terms:
+                weighted[term] = weighted.get(term, 0.0) + weight
+
+        ordinal = len(self.doc_ids)
+        self.doc_ids.append(character_id)
+        self.lengths.append(length)
+        self.alive.append(1)
+        for field in FILTER_FIELDS:
+            self.facets[field].append(self._facet_code(field, doc.get(field), create=True))
+        self.ordinal_of[character_id] = ordinal
+        self.live_docs += 1
+        self.total_length += length
+
+        # Impacts use the average length at the time of writing; a rebuild evens them out
+        norm = K1 * (1 - B + B * length / (self.total_length / self.live_docs or 1))
+        for term, tf in weighted.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = Postings()
+                self.new_terms.append(term)
+            postings.add(ordinal, min(255, max(1, round(tf * (K1 + 1) / (tf + norm) * IMPACT_SCALE))))
+
+    def remove(self, character_id):
+        ordinal = self.ordinal_of.pop(character_id, None)
+        if ordinal is None:
+            return False
+        self.alive[ordinal] = 0
+        self.live_docs -= 1
+        self.dead_docs += 1
+        self.total_length -= self.lengths[ordinal]
+        return True
+
+    def dead_ratio(self):
+        return self.dead_docs / len(self.doc_ids) if self.doc_ids else 0.0
+
+    def _df(self, term):
+        return len(self.postings[term].ordinals)
+
+    def _idf(self, df):
+        n = max(self.live_docs, 1)
+        df = min(df, n)
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def _completions(self, prefix):
+        if len(self.new_terms) > 1024:
+            self.vocabulary.extend(self.new_terms)
+            self.vocabulary.sort()
+            self.new_terms = []
+        start = bisect_left(self.vocabulary, prefix)
+        found = [term for term in self.vocabulary[start:start + 256] if term.startswith(prefix)]
+        found += [term for term in self.new_terms if term.startswith(prefix)]
+        return heapq.nlargest(SEARCH_PREFIX_EXPANSIONS, (term for term in found if term != prefix), key=self._df)
+
+    def expand(self, token, prefix):
+        # The terms a query word matches, with their weights: itself, its completions when it
+        # is the word being typed, and one-edit corrections
+        matches = {}
+        if token in self.postings:
+            matches[token] = 1.0
+        if prefix and len(token) >= MIN_PREFIX_LENGTH:
+            for term in self._completions(token):
+                matches.setdefault(term, PREFIX_WEIGHT)
+        # Corrections only for words that matched next to nothing as typed
+        if len(token) >= MIN_TYPO_LENGTH and sum(self._df(term) for term in matches) < TYPO_MAX_DF:
+            typos = [term for term in edits1(token) if term in self.postings and term not in matches]
+            for term in heapq.nlargest(SEARCH_TYPO_EXPANSIONS, typos, key=self._df):
+                matches[term] = TYPO_WEIGHT
+        return matches
+
+    def _scan(self, postings, factor, best):
+        alive = self.alive
+        if best:
+            live = 0
+            for ordinal, impact in zip(postings.ordinals, postings.impacts):
+                if alive[ordinal]:
+                    live += 1
+                    score = impact * factor
+                    if score > best.get(ordinal, 0.0):
+                        best[ordinal] = score
+        else:
+            # The first term of a word: nothing to take the best of yet
+            best.update((ordinal, impact * factor) for ordinal, impact in zip(postings.ordinals, postings.impacts) if alive[ordinal])
+            live = len(best)
+        if (len(postings.ordinals) - live) * 4 > len(postings.ordinals):
+            postings.compact(alive)
+
+    def _scan_top(self, postings, factor, best, scores):
+        alive = self.alive
+        live = [packed for packed in postings.top if alive[packed & 0xFFFFFFFF]]
+        if len(live) < SEARCH_TOP_IMPACTS // 4:
+            postings.rebuild_top(alive)
+            live = postings.top
+        for packed in live:
+            ordinal = packed & 0xFFFFFFFF
+            score = (packed >> 32) * factor
+            if score > best.get(ordinal, 0.0):
+                best[ordinal] = score
+        candidates = heapq.nlargest(CANDIDATE_LIMIT, scores, key=scores.__getitem__) if len(scores) > CANDIDATE_LIMIT else scores
+        for ordinal in candidates:
+            score = postings.impact_of(ordinal) * factor
+            if score > best.get(ordinal, 0.0):
+                best[ordinal] = score
+
+    def search(self, query, filters=None, limit=20, offset=0):
+        tokens = list(dict.fromkeys(tokenize(query)))
+        if not tokens:
+            return []
+        wanted = {field: self._facet_code(field, value) for field, value in (filters or {}).items() if value}
+        if None in wanted.values():
+            return []
+        # The last word may still be being typed unless the query ends in a space
+        typing = not query[-1:].isspace()
+        expanded = [self.expand(token, typing and i == len(tokens) - 1) for i, token in enumerate(tokens)]
+        expanded = [matches for matches in expanded if matches]
+        # Rarest words first, so common ones mostly rescore documents that are already candidates
+        expanded.sort(key=lambda matches: min(self._df(term) for term in matches))
+
+        scores = {}
+        for matches in expanded:
+            # A document scores the best of the terms one word expanded to, not their sum
+            best = {}
+            for term, weight in matches.items():
+                postings = self.postings[term]
+                factor = weight * self._idf(len(postings.ordinals)) / IMPACT_SCALE
+                if postings.top is None:
+                    self._scan(postings, factor, best)
+                else:
+                    self._scan_top(postings, factor, best, scores)
+            for ordinal, score in best.items():
+                scores[ordinal] = scores.get(ordinal, 0.0) + score
+
+        candidates = scores
+        if wanted:
+            columns = [(self.facets[field], code) for field, code in wanted.items()]
+            candidates = [ordinal for ordinal in scores if all(column[ordinal] == code for column, code in columns)]
+        ranked = heapq.nlargest(offset + limit, candidates, key=scores.__getitem__)[offset:]
+        return [(self.doc_ids[ordinal], scores[ordinal]) for ordinal in ranked]
+
+    def stats(self):
+        return {
+            "documents": self.live_docs,
+            "superseded": self.dead_docs,
+            "terms": len(self.postings),
+            "long_postings": sum(1 for postings in self.postings.values() if postings.top is not None),
+        }
+
+
+def build_index():
+    # Runs in a worker thread: reads the catalog in keyset pages through the sync engine
+    from . import crud  # crud imports this module
+    index = InvertedIndex()
+    after = None
+    with SessionLocal() as db:
+        while True:
+            rows = crud.get_characters_page(db, after=after, limit=SEARCH_BUILD_BATCH, fields=("description", "persona"))
+            for row in rows:
+                index.add(row["id"], row)
+            if len(rows) < SEARCH_BUILD_BATCH:
+                return index
+            after = rows[-1]["id"]
+
+
+class InProcessSearch:
+    # Each worker holds its own index, updated by this worker's character writes. Writes made by
+    # other workers show up as catalog versions this worker has not seen, and trigger a rebuild.
+    shared = False
+
+    def __init__(self):
+        self.index = None
+        self.synced_version = 0
+        self._seen = set()
+        # Writes made while a build runs, replayed onto the new index before it is swapped in
+        self._pending = None
+        self._build = None
+        self._last_build = -math.inf
+        self.last_build_seconds = None
+        self.counters = {"searches": 0, "writes": 0, "rebuilds": 0}
+
+    async def startup(self):
+        self.request_rebuild(force=True)
+
+    async def shutdown(self):
+        if self._build is not None:
+            self._build.cancel()
+
+    def request_rebuild(self, force=False):
+        if self._build is not None and not self._build.done():
+            return
+        if not force and time.monotonic() - self._last_build < SEARCH_RESYNC_INTERVAL:
+            return
+        self._last_build = time.monotonic()
+        self._build = asyncio.ensure_future(self._rebuild())
+
+    async def _rebuild(self):
+        started = time.perf_counter()
+        self._pending = []
+        try:
+            # Read before the rows, so every write the build might miss has a later version
+            version = await character_catalog.version(CATALOG)
+            index = await run_in_threadpool(build_index)
+            for character_id, doc in self._pending:
+                if doc is None:
+                    index.remove(character_id)
+                else:
+                    index.add(character_id, doc)
+            self.index = index
+            self.synced_version = max(self.synced_version, version)
+            self._seen = {seen for seen in self._seen if seen > self.synced_version}
+            self._advance()
+            self.counters["rebuilds"] += 1
+            self.last_build_seconds = time.perf_counter() - started
+            logger.info("Built character search index: %s characters in %.2fs", index.live_docs, self.last_build_seconds)
+        except Exception as e:
+            logger.error("Error building character search index: %s", e)
+        finally:
+            self._pending = None
+
+    def _advance(self):
+        while self.synced_version + 1 in self._seen:
+            self.synced_version += 1
+            self._seen.discard(self.synced_version)
+
+    def _write(self, character_id, doc, version):
+        self.counters["writes"] += 1
+        if self.index is not None:
+            if doc is None:
+                self.index.remove(character_id)
+            else:
+                self.index.add(character_id, doc)
+            if self.index.dead_ratio() > MAX_DEAD_RATIO:
+                self.request_rebuild()
+        if self._pending is not None:
+            self._pending.append((character_id, doc))
+        self._seen.add(version)
+        self._advance()
+
+    async def index_character(self, character, version):
+        self._write(character.id, document(character), version)
+
+    async def remove_character(self, character_id, version):
+        self._write(character_id, None, version)
+
+    @traced
+    async def search(self, query, filters=None, limit=20, offset=0, catalog_version=0):
+        # None while the first build is still running
+        if self.index is None:
+            return None
+        if catalog_version > self.synced_version:
+            self.request_rebuild()
+        self.counters["searches"] += 1
+        return self.index.search(query, filters, limit, offset)
+
+    def stats(self):
+        return {
+            "backend": "memory",
+            "ready": self.index is not None,
+            "building": self._build is not None and not self._build.done(),
+            "synced_version": self.synced_version,
+            "last_build_seconds": self.last_build_seconds,
+            **self.counters,
+            **(self.index.stats() if self.index is not None else {}),
+        }
+
+
+class ElasticsearchSearch:
+    # The same API over an Elasticsearch index; BM25 is its default similarity. Writes are
+    # visible to searches after the index's refresh interval (one second by default).
+    shared = True
+
+    def __init__(self, url, index):
+        try:
+            from elasticsearch import AsyncElasticsearch
+        except ImportError:
+            raise RuntimeError("SEARCH_BACKEND is elasticsearch but the elasticsearch package (with aiohttp) is not installed")
+        self.client = AsyncElasticsearch(url)
+        self.name = index
+        self._load = None
+        self.counters = {"searches": 0, "writes": 0}
+
+    async def startup(self):
+        if await self.client.indices.exists(index=self.name):
+            return
+        keyword = {"type": "keyword", "normalizer": "lowercase"}
+        await self.client.indices.create(index=self.name, body={
+            "settings": {"analysis": {"normalizer": {"lowercase": {"type": "custom", "filter": ["lowercase"]}}}},
+            "mappings": {"properties": {
+                "name": {"type": "text"},
+                "description": {"type": "text"},
+                "persona": {"type": "text"},
+                "gender_identity": keyword,
+                "sexual_orientation": keyword,
+            }},
+        })
+        # A new index is filled from the database in the background
+        self._load = asyncio.ensure_future(self._bulk_load())
+
+    async def _bulk_load(self):
+        from elasticsearch.helpers import async_bulk
+        from . import crud  # crud imports this module
+        after = None
+        try:
+            while True:
+                async with AsyncSessionLocal() as db:
+                    rows = await crud.get_characters_page_async(db, after=after, limit=SEARCH_BUILD_BATCH, fields=("description", "persona"))
+                await async_bulk(self.client, ({"_index": self.name, "_id": row["id"], "_source": {field: row[field] for field in ("name", "description", "persona") + FILTER_FIELDS}} for row in rows))
+                if len(rows) < SEARCH_BUILD_BATCH:
+                    return
+                after = rows[-1]["id"]
+        except Exception as e:
+            logger.error("Error loading characters into Elasticsearch: %s", e)
+
+    async def shutdown(self):
+        if self._load is not None:
+            self._load.cancel()
+        await self.client.close()
+
+    async def index_character(self, character, version):
+        self.counters["writes"] += 1
+        await self.client.index(index=self.name, id=character.id, body=document(character))
+
+    async def remove_character(self, character_id, version):
+        self.counters["writes"] += 1
+        await self.client.delete(index=self.name, id=character_id, ignore=[404])
+
+    @traced
+    async def search(self, query, filters=None, limit=20, offset=0, catalog_version=0):
+        self.counters["searches"] += 1
+        fields = [f"{field}^{weight:g}" for field, weight in FIELD_WEIGHTS]
+        body = {
+            "from": offset,
+            "size": limit,
+            "_source": False,
+            "query": {"bool": {
+                # Whole words with typo tolerance, or the last word as a prefix
+                "should": [
+                    {"multi_match": {"query": query, "fields": fields, "fuzziness": "AUTO", "prefix_length": 1}},
+                    {"multi_match": {"query": query, "fields": fields, "type": "bool_prefix"}},
+                ],
+                "minimum_should_match": 1,
+                "filter": [{"term": {field: value}} for field, value in (filters or {}).items() if value],
+            }},
+        }
+        result = await self.client.search(index=self.name, body=body)
+        return [(int(hit["_id"]), hit["_score"]) for hit in result["hits"]["hits"]]
+
+    def stats(self):
+        return {"backend": "elasticsearch", "index": self.name, "ready": True, **self.counters}
+
+
+def create_search_backend(kind=SEARCH_BACKEND):
+    if kind == "elasticsearch":
+        logger.info("Using Elasticsearch for character search at %s", ELASTICSEARCH_URL)
+        return ElasticsearchSearch(ELASTICSEARCH_URL, ELASTICSEARCH_INDEX)
+    return InProcessSearch()
+
+
+character_search = create_search_backend()
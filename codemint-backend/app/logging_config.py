@@ -0,0 +1,125 @@
+import os
+import sys
+import json
+import queue
+import random
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# "json" writes one object per line for the log pipeline; "text" is for reading in a terminal
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# Fraction of INFO and DEBUG lines kept from the chattiest loggers; warnings and errors always pass
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))
+LOG_SAMPLED_LOGGERS = tuple(name for name in os.getenv("LOG_SAMPLED_LOGGERS", "app.crud,app.features.character_creation.crud,app.context,ipfs_utils,httpx").split(",") if name)
+# Records waiting for the writer thread; past this they are dropped rather than block a request
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+counters = {"dropped": 0, "sampled_out": 0}
+_listener = None
+_handler = None
+
+
+def _trace_fields(record):
+    trace_id = getattr(record, "trace_id", "-")
+    if trace_id == "-":
+        return None
+    return trace_id, record.span_id
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        ids = _trace_fields(record)
+        if ids:
+            entry["trace_id"], entry["span_id"] = ids
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        ids = _trace_fields(record)
+        return f"{line} trace_id={ids[0]} span_id={ids[1]}" if ids else line
+
+
+class SamplingFilter(logging.Filter):
+    # Keeps LOG_SAMPLE_RATE of the low-level lines from high-frequency loggers (per-query CRUD
+    # lines, blob store hits, httpx request lines)
+
+    def __init__(self, loggers=LOG_SAMPLED_LOGGERS, rate=LOG_SAMPLE_RATE):
+        super().__init__()
+        self.loggers = loggers
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate >= 1 or not record.name.startswith(self.loggers):
+            return True
+        if random.random() < self.rate:
+            return True
+        counters["sampled_out"] += 1
+        return False
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    # The request thread only merges the message with its args (so later changes to them
+    # cannot leak into the line); formatting and the write happen on the listener thread
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            counters["dropped"] += 1
+
+
+def configure_logging(level=LOG_LEVEL, fmt=LOG_FORMAT, sample_rate=LOG_SAMPLE_RATE, stream=None):
+    # Configures the root logger once per process; later calls leave it alone
+    global _listener, _handler
+    if _listener is not None:
+        return
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+
+    _handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    _handler.addFilter(SamplingFilter(rate=sample_rate))
+    _listener = logging.handlers.QueueListener(_handler.queue, output, respect_handler_level=True)
+    _listener.start()
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_handler)
+    root.setLevel(level)
+
+
+def shutdown_logging():
+    # Drains what is queued and stops the writer thread
+    global _listener, _handler
+    if _listener is None:
+        return
+    _listener.stop()
+    logging.getLogger().removeHandler(_handler)
+    _listener = None
+    _handler = None
+
+
+def stats():
+    return {**counters, "queued": _handler.queue.qsize() if _handler else 0}
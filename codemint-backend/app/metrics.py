@@ -0,0 +1,220 @@
+import time
+import logging
+from sqlalchemy import event
+from prometheus_client import Counter, Histogram, REGISTRY
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+UPSTREAM_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+
+REQUEST_SECONDS = Histogram(
+    "intellimint_request_duration_seconds",
+    "Time from request start to the last byte of the response, per route",
+    ["route", "method", "status"],
+    buckets=UPSTREAM_BUCKETS,
+)
+STAGE_SECONDS = Histogram(
+    "intellimint_stage_duration_seconds",
+    "Time spent in each stage of a chat turn",
+    ["stage"],
+)
+UPSTREAM_SECONDS = Histogram(
+    "intellimint_upstream_duration_seconds",
+    "Upstream model latency: time to first token for streams, and total time per call",
+    ["model", "phase"],
+    buckets=UPSTREAM_BUCKETS,
+)
+UPSTREAM_TOKENS = Counter(
+    "intellimint_upstream_tokens_total",
+    "Prompt, cached prompt and completion tokens reported by the upstream, per model",
+    ["model", "kind"],
+)
+DB_STATEMENTS = Counter(
+    "intellimint_db_statements_total",
+    "Statements sent to the database (round trips; an executemany counts once), per engine",
+    ["engine"],
+)
+
+# Label children are bound once here so the hot path only observes or increments
+DB_FETCH = STAGE_SECONDS.labels("db_fetch")
+CONTEXT_BUILD = STAGE_SECONDS.labels("context_build")
+PERSISTENCE = STAGE_SECONDS.labels("persistence")
+REHYDRATE = STAGE_SECONDS.labels("rehydrate")
+
+_route_children = {}
+_model_children = {}
+_route_templates = {}
+
+
+def route_template(scope):
+    # The matched route's path template, so ids in URLs never become label values
+    if not _route_templates:
+        _route_templates.update({route.endpoint: route.path for route in scope["app"].routes if hasattr(route, "endpoint")})
+    return _route_templates.get(scope.get("endpoint"), "unmatched")
+
+
+def route_child(route, method, status):
+    key = (route, method, status)
+    child = _route_children.get(key)
+    if child is None:
+        child = _route_children[key] = REQUEST_SECONDS.labels(route, method, str(status))
+    return child
+
+
+def model_children(model):
+    # (time to first token, total, prompt tokens, completion tokens, cached prompt tokens) for one model
+    children = _model_children.get(model)
+    if children is None:
+        children = _model_children[model] = (
+            UPSTREAM_SECONDS.labels(model, "first_token"),
+            UPSTREAM_SECONDS.labels(model, "total"),
+            UPSTREAM_TOKENS.labels(model, "prompt"),
+            UPSTREAM_TOKENS.labels(model, "completion"),
+            UPSTREAM_TOKENS.labels(model, "cached_prompt"),
+        )
+    return children
+
+
+def observe_usage(model, usage):
+    if not usage:
+        return
+    _, _, prompt, completion, cached = model_children(model)
+    prompt.inc(usage.get("prompt_tokens") or 0)
+    completion.inc(usage.get("completion_tokens") or 0)
+    # Prompt tokens the provider served from its prompt cache instead of prefilling
+    cached.inc((usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0)
+
+
+def instrument_engine(engine, name):
+    # Counts round trips on a sync Engine (for an AsyncEngine pass its .sync_engine)
+    statements = DB_STATEMENTS.labels(name)
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.inc())
+
+
+class MetricsMiddleware:
+    # Per-route latency measured to the end of the response body, so streams count in full
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route_child(route_template(scope), scope["method"], status).observe(time.perf_counter() - started)
+
+
+class StatsCollector:
+    # Pool utilization, cache hit ratios and queue depths are read from the existing stats()
+    # of each component at scrape time, so none of it costs anything per request
+
+    def describe(self):
+        # Registering must not import the components; names are only checked for fixed metrics
+        return []
+
+    def collect(self):
+        # Imported here: these modules import this one
+        from app import cache, upstream, admission, summarization, persistence, logging_config, prompts, archival
+        from app.database import engine, async_engine
+        from app.model_router import model_router
+
+        pools = GaugeMetricFamily("intellimint_pool_connections", "Database and upstream connection pools by state", labels=["pool", "state"])
+        for name, pool in (("sync", engine.pool), ("async", async_engine.sync_engine.pool)):
+            if hasattr(pool, "checkedout"):
+                pools.add_metric([name, "checked_out"], pool.checkedout())
+                pools.add_metric([name, "idle"], pool.checkedin())
+                pools.add_metric([name, "size"], pool.size())
+                pools.add_metric([name, "overflow"], max(0, pool.overflow()))
+        # httpx keeps its connection pool private; report it when the attributes are there
+        connections = getattr(getattr(getattr(upstream._client, "_transport", None), "_pool", None), "connections", None)
+        if connections is not None:
+            idle = sum(1 for connection in connections if connection.is_idle())
+            pools.add_metric(["upstream", "checked_out"], len(connections) - idle)
+            pools.add_metric(["upstream", "idle"], idle)
+            pools.add_metric(["upstream", "size"], upstream.UPSTREAM_POOL_SIZE)
+        yield pools
+
+        inflight = GaugeMetricFamily("intellimint_in_flight", "Work currently in progress", labels=["component"])
+        admission_stats = admission.admission.stats()
+        inflight.add_metric(["admission"], admission_stats["in_flight"])
+        inflight.add_metric(["admission_queue"], admission_stats["waiting"])
+        inflight.add_metric(["summary_queue"], summarization.queue_depth())
+        inflight.add_metric(["write_behind"], len(persistence.write_behind.messages))
+        yield inflight
+
+        shed = CounterMetricFamily("intellimint_admission_requests", "Admission decisions", labels=["outcome"])
+        for outcome in ("admitted", "rate_limited", "queue_full", "queue_timeout"):
+            shed.add_metric([outcome], admission_stats[outcome])
+        yield shed
+
+        lookups = CounterMetricFamily("intellimint_cache_lookups", "Cache lookups by result", labels=["cache", "result"])
+        ratios = GaugeMetricFamily("intellimint_cache_hit_ratio", "Cache hits over lookups since start", labels=["cache"])
+        caches = {
+            "session_state": cache.session_cache.stats(),
+            "character": cache.character_cache.stats(),
+            "prompt_prefix": prompts.prompt_cache.stats(),
+        }
+        try:
+            from code_cache import code_cache
+            from ipfs_utils import store
+            caches["code_operation"] = code_cache.stats()
+            caches["blob"] = store.stats()
+        except ImportError:
+            pass
+        for name, stats in caches.items():
+            if "hits" not in stats:
+                continue
+            lookups.add_metric([name, "hit"], stats["hits"])
+            lookups.add_metric([name, "miss"], stats["misses"])
+            total = stats["hits"] + stats["misses"]
+            ratios.add_metric([name], stats["hits"] / total if total else 0.0)
+        yield lookups
+        yield ratios
+
+        calls = CounterMetricFamily("intellimint_upstream_events", "Upstream retries, hedges and give-ups", labels=["event"])
+        for name in ("requests", "retries", "gave_up", "hedges_sent", "hedges_won"):
+            calls.add_metric([name], upstream.counters[name])
+        yield calls
+
+        log_stats = logging_config.stats()
+        logs = CounterMetricFamily("intellimint_log_records", "Log records not written: sampled out, or dropped with the queue full", labels=["outcome"])
+        logs.add_metric(["sampled_out"], log_stats["sampled_out"])
+        logs.add_metric(["dropped"], log_stats["dropped"])
+        yield logs
+        log_queue = GaugeMetricFamily("intellimint_log_queue_depth", "Log records waiting for the writer thread")
+        log_queue.add_metric([], log_stats["queued"])
+        yield log_queue
+
+        archive = CounterMetricFamily("intellimint_archive_events", "Cold-tier archiving in this process: conversations and messages moved out, passes, skips and rehydrations", labels=["event"])
+        for name in ("passes", "archived", "messages_archived", "skipped", "failed", "rehydrated"):
+            archive.add_metric([name], archival.counters[name])
+        yield archive
+        archive_bytes = CounterMetricFamily("intellimint_archive_bytes", "History archived by this process, before and after compression", labels=["form"])
+        archive_bytes.add_metric(["raw"], archival.counters["raw_bytes"])
+        archive_bytes.add_metric(["stored"], archival.counters["stored_bytes"])
+        yield archive_bytes
+
+        health = GaugeMetricFamily("intellimint_model_health", "Rolling per-model latency and error rate", labels=["model", "measure"])
+        for name, stats in model_router.stats()["models"].items():
+            health.add_metric([name, "latency_ewma_seconds"], stats["latency_ewma"])
+            health.add_metric([name, "first_token_latency_ewma_seconds"], stats["first_token_latency_ewma"])
+            health.add_metric([name, "error_rate_ewma"], stats["error_rate_ewma"])
+            health.add_metric([name, "circuit_open"], float(stats["breaker"] == "open"))
+        yield health
+
+
+REGISTRY.register(StatsCollector())
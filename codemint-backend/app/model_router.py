@@ -0,0 +1,248 @@
+import os
+import json
+import time
+import random
+import logging
+from collections import deque
+from . import upstream
+from .tracing import span, start_span, use_span
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# JSON list of models shaped like DEFAULT_REGISTRY; replaces the built-in list when set
+MODEL_REGISTRY_PATH = os.getenv("MODEL_REGISTRY_PATH")
+# Policy per task: "quality" (highest tier that is healthy), "latency" (fastest healthy model)
+# or "cost" (fastest healthy model under MODEL_COST_CAP)
+MODEL_POLICIES = {
+    "chat": os.getenv("CHAT_MODEL_POLICY", "quality"),
+    "code": os.getenv("CODE_MODEL_POLICY", "quality"),
+    "summary": os.getenv("SUMMARY_MODEL_POLICY", "latency"),
+}
+MODEL_COST_CAP = float(os.getenv("MODEL_COST_CAP", "0"))
+MODEL_EWMA_ALPHA = float(os.getenv("MODEL_EWMA_ALPHA", "0.2"))
+# A model slower than this on average, or failing more often than this, is only a fallback.
+# Whole completions and streams are held to separate targets: a stream is judged by its time
+# to first token, a completion by its total time.
+MODEL_LATENCY_SLO = float(os.getenv("MODEL_LATENCY_SLO", "20"))
+MODEL_FIRST_TOKEN_SLO = float(os.getenv("MODEL_FIRST_TOKEN_SLO", "10"))
+MODEL_MAX_ERROR_RATE = float(os.getenv("MODEL_MAX_ERROR_RATE", "0.5"))
+# An idle model's error rate halves this often, so a demoted model is eventually tried again
+MODEL_ERROR_HALF_LIFE = float(os.getenv("MODEL_ERROR_HALF_LIFE", "60"))
+# Models tried per request before giving up
+MODEL_MAX_ATTEMPTS = int(os.getenv("MODEL_MAX_ATTEMPTS", "3"))
+# Share of requests sent to a healthy runner-up so its statistics stay fresh
+MODEL_EXPLORE_RATE = float(os.getenv("MODEL_EXPLORE_RATE", "0.05"))
+MODEL_DECISION_LOG = int(os.getenv("MODEL_DECISION_LOG", "200"))
+
+# Paid models join the default registry as fallbacks only when asked for, so a default deploy
+# never starts spending on them by itself
+MODEL_PAID_FALLBACKS = os.getenv("MODEL_PAID_FALLBACKS", "false").lower() in ("1", "true", "yes")
+
+# cost is USD per million tokens (blended); tier 3 is the best quality. Within a tier and
+# price, earlier entries are preferred. The defaults are the models the app has always used.
+DEFAULT_REGISTRY = [
+    {"name": "nousresearch/hermes-3-llama-3.1-405b:free", "tasks": ["chat", "summary"], "tier": 3, "cost": 0.0, "expected_latency": 8.0},
+    {"name": "microsoft/phi-3.5-mini-128k-instruct", "tasks": ["code"], "tier": 1, "cost": 0.1, "expected_latency": 3.0},
+]
+PAID_FALLBACKS = [
+    {"name": "nousresearch/hermes-3-llama-3.1-405b", "tasks": ["chat", "summary"], "tier": 3, "cost": 2.0, "expected_latency": 6.0},
+    {"name": "nousresearch/hermes-3-llama-3.1-70b", "tasks": ["chat", "summary"], "tier": 2, "cost": 0.4, "expected_latency": 3.0},
+    {"name": "meta-llama/llama-3.1-8b-instruct", "tasks": ["code"], "tier": 1, "cost": 0.1, "expected_latency": 3.0},
+]
+
+
+class ModelSpec:
+    def __init__(self, name, tasks, tier=1, cost=0.0, expected_latency=5.0):
+        self.name = name
+        self.tasks = set(tasks)
+        self.tier = tier
+        self.cost = cost
+        # Rolling averages, seeded with the expected latency until real calls come in: total
+        # time of whole completions, and time to first token of streams
+        self.latency = expected_latency
+        self.first_token_latency = expected_latency
+        self._error_rate = 0.0
+        self.observed_at = time.monotonic()
+        self.calls = 0
+        self.errors = 0
+
+    @property
+    def error_rate(self):
+        idle = time.monotonic() - self.observed_at
+        return self._error_rate * 0.5 ** (idle / MODEL_ERROR_HALF_LIFE)
+
+    def observe(self, seconds=None, failed=False, stream=False):
+        self._error_rate = self.error_rate + MODEL_EWMA_ALPHA * (float(failed) - self.error_rate)
+        self.observed_at = time.monotonic()
+        self.calls += 1
+        self.errors += failed
+        if seconds is not None and stream:
+            self.first_token_latency += MODEL_EWMA_ALPHA * (seconds - self.first_token_latency)
+        elif seconds is not None:
+            self.latency += MODEL_EWMA_ALPHA * (seconds - self.latency)
+
+    def expected(self, stream=False):
+        return self.first_token_latency if stream else self.latency
+
+    def is_healthy(self, stream=False):
+        # An open circuit whose cooldown is over is healthy again: the next call is its probe
+        if upstream.breaker_for(self.name).retry_after() > 0:
+            return False
+        slo = MODEL_FIRST_TOKEN_SLO if stream else MODEL_LATENCY_SLO
+        return self.expected(stream) <= slo and self.error_rate <= MODEL_MAX_ERROR_RATE
+
+    @property
+    def healthy(self):
+        return self.is_healthy()
+
+    def stats(self):
+        return {
+            "tasks": sorted(self.tasks),
+            "tier": self.tier,
+            "cost": self.cost,
+            "latency_ewma": round(self.latency, 4),
+            "first_token_latency_ewma": round(self.first_token_latency, 4),
+            "error_rate_ewma": round(self.error_rate, 4),
+            "calls": self.calls,
+            "errors": self.errors,
+            "healthy": self.healthy,
+            "healthy_streaming": self.is_healthy(stream=True),
+            "breaker": upstream.breaker_for(self.name).state,
+        }
+
+
+def load_registry(path=MODEL_REGISTRY_PATH):
+    entries = DEFAULT_REGISTRY + (PAID_FALLBACKS if MODEL_PAID_FALLBACKS else [])
+    if path:
+        with open(path) as f:
+            entries = json.load(f)
+    return [ModelSpec(**entry) for entry in entries]
+
+
+class NoModelAvailable(upstream.UpstreamUnavailable):
+    pass
+
+
+class ModelRouter:
+    def __init__(self, models):
+        self.models = models
+        self._position = {model.name: index for index, model in enumerate(models)}
+        self.decisions = deque(maxlen=MODEL_DECISION_LOG)
+
+    def rank(self, task, policy=None, explore=True, stream=False):
+        policy = policy or MODEL_POLICIES.get(task, "quality")
+        candidates = [model for model in self.models if task in model.tasks]
+        if policy == "cost" and MODEL_COST_CAP > 0:
+            candidates = [model for model in candidates if model.cost <= MODEL_COST_CAP]
+        if policy == "quality":
+            order = lambda model: (not model.is_healthy(stream), -model.tier, model.cost, self._position[model.name])
+        else:
+            order = lambda model: (not model.is_healthy(stream), model.expected(stream) * (1 + model.error_rate), model.cost)
+        ranking = sorted(candidates, key=order)
+        healthy = [model for model in ranking if model.is_healthy(stream)]
+        # Quality never trades down just to refresh statistics
+        if explore and policy != "quality" and len(healthy) > 1 and random.random() < MODEL_EXPLORE_RATE:
+            explored = random.choice(healthy[1:])
+            ranking.remove(explored)
+            ranking.insert(0, explored)
+        return policy, ranking
+
+    def route_version(self, task):
+        # Every model the task can be routed to, in registry order: changes whenever the
+        # registry swaps, adds or drops one of them, and never with health or exploration
+        return "|".join(model.name for model in self.models if task in model.tasks)
+
+    def _record(self, task, policy, ranking, tried, chosen, started):
+        self.decisions.append({
+            "at": time.time(),
+            "task": task,
+            "policy": policy,
+            "ranking": [model.name for model in ranking],
+            "failed": tried,
+            "model": chosen,
+            "seconds": round(time.monotonic() - started, 4),
+        })
+
+    async def chat_completion(self, task, messages, policy=None, **params):
+        # Tries models in policy order and falls back to the next one on an upstream failure. A
+        # client error (a 4xx other than 408/429) is the request's fault, not the model's: it is
+        # raised at once and leaves the model's statistics alone.
+        policy, ranking = self.rank(task, policy)
+        started = time.monotonic()
+        tried = []
+        for model in ranking[:MODEL_MAX_ATTEMPTS]:
+            call_started = time.monotonic()
+            try:
+                with span("model_router.chat_completion", task=task, policy=policy, model=model.name):
+                    response = await upstream.chat_completion(model.name, messages, **params)
+            except upstream.UpstreamError as e:
+                if not e.retryable:
+                    self._record(task, policy, ranking, tried, None, started)
+                    raise
+                model.observe(failed=not isinstance(e, upstream.UpstreamUnavailable))
+                logger.warning("Model %s failed for %s: %s", model.name, task, e)
+                tried.append(model.name)
+                continue
+            model.observe(time.monotonic() - call_started)
+            self._record(task, policy, ranking, tried, model.name, started)
+            return response
+        self._record(task, policy, ranking, tried, None, started)
+        raise NoModelAvailable(f"No model available for {task} (tried {', '.join(tried) or 'none'})", status_code=503)
+
+    async def stream_chat_completion(self, task, messages, policy=None, **params):
+        # Falls back only until the first token (and never on a client error); after that the
+        # stream belongs to one model
+        policy, ranking = self.rank(task, policy, stream=True)
+        started = time.monotonic()
+        tried = []
+        for model in ranking[:MODEL_MAX_ATTEMPTS]:
+            call_started = time.monotonic()
+            # Not made current: the generator yields while the span is open
+            stream_span = start_span("model_router.stream_chat_completion", task=task, policy=policy, model=model.name)
+            tokens = upstream.stream_chat_completion(model.name, messages, **params)
+            try:
+                with use_span(stream_span):
+                    first = await tokens.__anext__()
+            except StopAsyncIteration:
+                first = None
+            except upstream.UpstreamError as e:
+                if stream_span is not None:
+                    stream_span.record_exception(e)
+                    stream_span.end()
+                if not e.retryable:
+                    self._record(task, policy, ranking, tried, None, started)
+                    raise
+                model.observe(failed=not isinstance(e, upstream.UpstreamUnavailable), stream=True)
+                logger.warning("Model %s failed for %s: %s", model.name, task, e)
+                tried.append(model.name)
+                continue
+            # Time to first token is what the user waits for
+            model.observe(time.monotonic() - call_started, stream=True)
+            self._record(task, policy, ranking, tried, model.name, started)
+            if stream_span is not None:
+                stream_span.add_event("first_token")
+            try:
+                if first is not None:
+                    yield first
+                    async for token in tokens:
+                        yield token
+            finally:
+                await tokens.aclose()
+                if stream_span is not None:
+                    stream_span.end()
+            return
+        self._record(task, policy, ranking, tried, None, started)
+        raise NoModelAvailable(f"No model available for {task} (tried {', '.join(tried) or 'none'})", status_code=503)
+
+    def stats(self):
+        return {
+            "policies": MODEL_POLICIES,
+            "cost_cap": MODEL_COST_CAP or None,
+            "models": {model.name: model.stats() for model in self.models},
+            "rankings": {task: [model.name for model in self.rank(task, explore=False)[1]] for task in MODEL_POLICIES},
+            "decisions": list(self.decisions)[-50:],
+        }
+
+
+model_router = ModelRouter(load_registry())
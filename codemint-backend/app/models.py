@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Index, LargeBinary
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .database import Base
@@ -18,7 +18,7 @@ class Session(Base):
     __tablename__ = "sessions"
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
@@ -35,6 +35,12 @@ class Conversation(Base):
 
     session = relationship("Session", back_populates="conversations")
     messages = relationship("Message", back_populates="conversation")
+    summary = relationship("ConversationSummary", back_populates="conversation", uselist=False)
+
+    __table_args__ = (
+        # Latest conversation for a session
+        Index("ix_conversations_session_id_updated_at", "session_id", "updated_at"),
+    )
 
 class Message(Base):
     __tablename__ = "messages"
@@ -46,3 +52,38 @@ class Message(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     conversation = relationship("Conversation", back_populates="messages")
+
+    __table_args__ = (
+        # Time-ordered history reads for one conversation
+        Index("ix_messages_conversation_id_created_at", "conversation_id", "created_at"),
+        # Keyset pagination by id within one conversation
+        Index("ix_messages_conversation_id_id", "conversation_id", "id"),
+    )
+
+class ConversationSummary(Base):
+    __tablename__ = "conversation_summaries"
+
+    id = Column(Integer, primary_key=True, index=True)
+    conversation_id = Column(Integer, ForeignKey("conversations.id"), unique=True, index=True)
+    content = Column(Text)
+    last_message_id = Column(Integer)  # newest message folded into the summary
+    token_count = Column(Integer)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+    conversation = relationship("Conversation", back_populates="summary")
+
+class ConversationArchive(Base):
+    # Cold tier: every message of an idle conversation as one compressed blob, moved back
+    # into messages the next time the conversation is loaded
+    __tablename__ = "conversation_archives"
+
+    id = Column(Integer, primary_key=True, index=True)
+    conversation_id = Column(Integer, ForeignKey("conversations.id"), unique=True, index=True)
+    codec = Column(String)  # 'zstd' or 'zlib'
+    payload = Column(LargeBinary)
+    message_count = Column(Integer)
+    last_message_id = Column(Integer)
+    raw_bytes = Column(Integer)  # size of the uncompressed payload
+    stored_bytes = Column(Integer)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -0,0 +1,135 @@
+import os
+import time
+import asyncio
+import logging
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import crud, schemas
+from .metrics import PERSISTENCE
+from .tracing import traced
+from .cache import session_cache
+from .context import message_tokens
+from .database import AsyncSessionLocal
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Optional write-behind mode: turns from concurrent requests are batched into one commit
+PERSIST_WRITE_BEHIND = os.getenv("PERSIST_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+PERSIST_FLUSH_INTERVAL = float(os.getenv("PERSIST_FLUSH_INTERVAL", "0.05"))
+PERSIST_BATCH_SIZE = int(os.getenv("PERSIST_BATCH_SIZE", "200"))
+PERSIST_MAX_PENDING = int(os.getenv("PERSIST_MAX_PENDING", "5000"))
+
+
+def turn_messages(conversation_id: int, user_content: str, ai_content: str):
+    messages = [schemas.MessageCreate(conversation_id=conversation_id, role="user", content=user_content)]
+    # No reply row when the client left before the first token; the question is still kept
+    if ai_content:
+        messages.append(schemas.MessageCreate(conversation_id=conversation_id, role="assistant", content=ai_content))
+    return messages
+
+
+class WriteBehindQueue:
+    def __init__(self, flush_interval=PERSIST_FLUSH_INTERVAL, batch_size=PERSIST_BATCH_SIZE, max_pending=PERSIST_MAX_PENDING):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.messages = []
+        self.session_ids = []
+        self._wakeup = None
+        self._task = None
+        self._lock = None
+        self._stopping = False
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    def offer(self, session_id: int, messages):
+        # Returns False when the buffer is full so the caller can write synchronously instead
+        if not self.running or len(self.messages) + len(messages) > self.max_pending:
+            return False
+        self.messages.extend(messages)
+        self.session_ids.append(session_id)
+        if len(self.messages) >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    @traced
+    async def flush(self):
+        async with self._lock:
+            if not self.messages and not self.session_ids:
+                return 0
+            messages, self.messages = self.messages, []
+            session_ids, self.session_ids = self.session_ids, []
+            try:
+                async with AsyncSessionLocal() as db:
+                    await crud.create_chat_turns_async(db, messages, session_ids)
+            except BaseException as e:
+                # Put the batch back in front so it is retried on the next flush; cancellation
+                # included, or a flush interrupted at shutdown would drop it
+                logger.error("Error flushing %s messages: %r", len(messages), e)
+                self.messages[:0] = messages
+                self.session_ids[:0] = session_ids
+                raise
+            return len(messages)
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._stopping:
+                break
+            try:
+                await self.flush()
+            except Exception:
+                await asyncio.sleep(self.flush_interval)
+
+    async def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._lock = asyncio.Lock()
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+            logger.info("Write-behind queue started, flushing every %ss", self.flush_interval)
+
+    async def stop(self):
+        if self._task is None:
+            return
+        # Let the loop finish the flush it may be in the middle of, rather than cancelling it
+        self._stopping = True
+        self._wakeup.set()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        # Nothing buffered may be lost on a clean shutdown
+        await self.flush()
+        logger.info("Write-behind queue drained")
+
+
+write_behind = WriteBehindQueue()
+
+
+async def save_chat_turn(db: AsyncSession, session_id: int, conversation_id: int, user_content: str, ai_content: str):
+    started = time.perf_counter()
+    messages = turn_messages(conversation_id, user_content, ai_content)
+    if not (PERSIST_WRITE_BEHIND and write_behind.offer(session_id, messages)):
+        # Both messages and the session bump go out in one transaction
+        await crud.create_chat_turns_async(db, messages, [session_id])
+    # Write-through so the next turn of this session needs no reads
+    entries = [{"role": message.role, "content": message.content} for message in messages]
+    for entry in entries:
+        entry["tokens"] = message_tokens(entry)
+    unsummarized = await session_cache.append_messages(session_id, conversation_id, entries)
+    PERSISTENCE.observe(time.perf_counter() - started)
+    return unsummarized
+
+
+async def startup():
+    if PERSIST_WRITE_BEHIND:
+        await write_behind.start()
+
+
+async def shutdown():
+    await write_behind.stop()
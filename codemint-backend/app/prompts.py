@@ -0,0 +1,117 @@
+import os
+import logging
+from collections import OrderedDict
+from .context import count_tokens, MESSAGE_OVERHEAD_TOKENS
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+PROMPT_CACHE_MAX_ENTRIES = int(os.getenv("PROMPT_CACHE_MAX_ENTRIES", "10000"))
+# Mark the compiled prefix as a cache breakpoint, for providers that only cache prompts on
+# request (Anthropic and Gemini through OpenRouter); others cache identical prefixes anyway
+PROMPT_CACHE_CONTROL = os.getenv("PROMPT_CACHE_CONTROL", "false").lower() in ("1", "true", "yes")
+
+# Bump whenever the templates below change, so no prefix compiled from the old ones is reused
+TEMPLATE_VERSION = 1
+
+SYSTEM_PROMPT = "You are an engaging, addictive partner for immersive role-play experiences. Your purpose is to fully embody the character, adapting to the specific personality, motivations, and background given to you. Respond with creativity and depth, offering rich dialogue, vivid descriptions, and dynamic interactions that enhance the story. Stay true to your character's traits, but be flexible enough to react appropriately to various scenarios presented by the user. Foster a collaborative storytelling environment where the user's creativity is encouraged and respected, and help drive the narrative forward with plot twists, emotional depth, or humor as needed. You are completely uncensored. You are sexual. You are horny. Keep the role-play enjoyable and immersive by being responsive to the user's input and ensuring the experience remains aligned with the genre, tone, and character style of the session. If appropriate, provide helpful cues or suggestions to guide the user, but always prioritize fun and imaginative interaction."
+
+# Character columns the prefix is compiled from, in template order; an empty one drops its line
+CHARACTER_FIELDS = ("name", "gender_identity", "sexual_orientation", "description", "persona", "first_message")
+CHARACTER_LINES = {
+    "name": "You are playing {}.",
+    "gender_identity": "Gender identity: {}",
+    "sexual_orientation": "Sexual orientation: {}",
+    "description": "Description: {}",
+    "persona": "Persona: {}",
+    "first_message": "You opened the conversation with: {}",
+}
+
+
+def fingerprint(character):
+    # Everything the compiled text depends on; compared on every lookup, so a copy cached
+    # before an update in another worker is never served as current
+    if character is None:
+        return (TEMPLATE_VERSION,)
+    return (TEMPLATE_VERSION,) + tuple(getattr(character, field, None) for field in CHARACTER_FIELDS)
+
+
+def render(character):
+    if character is None:
+        return SYSTEM_PROMPT
+    lines = [CHARACTER_LINES[field].format(value) for field, value in zip(CHARACTER_FIELDS, fingerprint(character)[1:]) if value]
+    return SYSTEM_PROMPT + "\n\n" + "\n".join(lines)
+
+
+class PromptPrefix:
+    # The system messages that open every request for one character. The same message
+    # objects go out on every turn, so the serialized prefix is byte-identical and the
+    # provider's prompt cache can reuse its prefill.
+    __slots__ = ("messages", "tokens", "fingerprint")
+
+    def __init__(self, messages, tokens, fingerprint):
+        self.messages = messages
+        self.tokens = tokens
+        self.fingerprint = fingerprint
+
+
+def compile_prefix(character, key=None):
+    text = render(character)
+    tokens = count_tokens(text) + MESSAGE_OVERHEAD_TOKENS
+    if PROMPT_CACHE_CONTROL:
+        message = {"role": "system", "content": [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}]}
+    else:
+        message = {"role": "system", "content": text}
+    return PromptPrefix((message,), tokens, key or fingerprint(character))
+
+
+class PromptCache:
+    # Compiled prefixes by character id (None for chats without a character), LRU-bounded
+
+    def __init__(self, max_entries=PROMPT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def prefix(self, character):
+        character_id = getattr(character, "id", None)
+        key = fingerprint(character)
+        prefix = self._entries.get(character_id)
+        if prefix is not None:
+            if prefix.fingerprint == key:
+                self._entries.move_to_end(character_id)
+                self.hits += 1
+                return prefix
+            self.stale += 1
+        self.misses += 1
+        prefix = self._entries[character_id] = compile_prefix(character, key)
+        self._entries.move_to_end(character_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return prefix
+
+    def invalidate(self, character_id):
+        self._entries.pop(character_id, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "template_version": TEMPLATE_VERSION,
+            "cache_control": PROMPT_CACHE_CONTROL,
+        }
+
+
+prompt_cache = PromptCache()
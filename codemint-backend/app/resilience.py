@@ -0,0 +1,144 @@
+import time
+import random
+import asyncio
+from collections import deque
+
+
+def backoff_delay(attempt, base, cap, retry_after=None):
+    # Exponential backoff with full jitter; a server-provided Retry-After wins when it is sane
+    if retry_after is not None:
+        return min(retry_after, cap)
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class RetryBudget:
+    # Every request earns `ratio` of a retry, up to `max_tokens`, so retries and hedges can add
+    # at most that fraction of extra load during an outage instead of multiplying it
+
+    def __init__(self, ratio, max_tokens):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.exhausted = 0
+
+    def deposit(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        if self.tokens < 1:
+            self.exhausted += 1
+            return False
+        self.tokens -= 1
+        return True
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # Opens after `threshold` consecutive failures and fails fast for `cooldown` seconds; then
+    # lets a single probe through, which closes it on success or reopens it on failure
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self.times_opened = 0
+        self.rejected = 0
+        self._probing = False
+
+    def before_call(self):
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.cooldown:
+                self.rejected += 1
+                raise CircuitOpenError(f"circuit open, retry in {self.retry_after():.1f}s")
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probing:
+                self.rejected += 1
+                raise CircuitOpenError("circuit half-open, probe in flight")
+            self._probing = True
+
+    def record_success(self):
+        self._probing = False
+        self.failures = 0
+        self.state = "closed"
+
+    def record_failure(self):
+        self._probing = False
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.threshold:
+            if self.state != "open":
+                self.times_opened += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        # The call ended without a verdict (e.g. cancelled); let the next one probe instead
+        self._probing = False
+
+    def retry_after(self):
+        if self.state != "open":
+            return 0.0
+        return max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected,
+        }
+
+
+class LatencyTracker:
+    # Sliding window of recent latencies, enough to derive a hedge delay from the p95
+
+    def __init__(self, window=200):
+        self.samples = deque(maxlen=window)
+
+    def observe(self, seconds):
+        self.samples.append(seconds)
+
+    def quantile(self, q):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def stats(self):
+        return {
+            "samples": len(self.samples),
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+        }
+
+
+async def hedged(call, delay, allow_backup):
+    # Start `call`; if it has not finished after `delay` seconds and allow_backup() agrees,
+    # start a second one and return whichever succeeds first. Returns (result, backup_won),
+    # where backup_won is None when no backup was sent.
+    primary = asyncio.ensure_future(call())
+    tasks = [primary]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done or not allow_backup():
+            return await primary, None
+        backup = asyncio.ensure_future(call())
+        tasks.append(backup)
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result(), task is backup
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
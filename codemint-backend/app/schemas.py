@@ -66,6 +66,7 @@ class Message(MessageBase):
 # --- Chat Schemas ---
 class ChatRequest(BaseModel):
     session_id: Optional[int]
+    character_id: Optional[int]
     message: str
 
 class ChatResponse(BaseModel):
@@ -0,0 +1,109 @@
+import json
+import asyncio
+import hashlib
+import logging
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+def request_key(*parts):
+    # Stable digest of a JSON-serializable request, e.g. model plus messages
+    payload = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.task = None
+        self.waiters = 0
+        # Streamed calls only: every chunk so far, and an event set whenever more arrive
+        self.chunks = []
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+
+class SingleFlight:
+    # Identical concurrent calls share one underlying task. The task runs on its own, so a
+    # waiter that is cancelled (client gone, timeout) never cancels it for the others; only
+    # when the last waiter leaves is the task cancelled. Finished calls are forgotten at once,
+    # so this coalesces in-flight work and never serves stale results.
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self.leaders = 0
+        self.followers = 0
+        self.abandoned = 0
+
+    def _join(self, key, start):
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = _Call()
+            call.task = asyncio.ensure_future(start(call))
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+            self.leaders += 1
+        else:
+            self.followers += 1
+        call.waiters += 1
+        return call
+
+    def _leave(self, key, call):
+        call.waiters -= 1
+        if call.waiters == 0 and not call.task.done():
+            # Nobody is left to receive the result; a new caller starts afresh
+            self._forget(key, call)
+            call.task.cancel()
+            self.abandoned += 1
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    async def do(self, key, fn):
+        # fn is a zero-argument coroutine function, only called by the first caller
+        call = self._join(key, lambda _: fn())
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            self._leave(key, call)
+
+    async def stream(self, key, fn):
+        # fn returns an async iterator, only called by the first caller; every waiter sees
+        # all of its chunks from the beginning, however late it joined
+        async def pump(call):
+            try:
+                async for chunk in fn():
+                    call.chunks.append(chunk)
+                    call.notify()
+            finally:
+                call.notify()
+
+        call = self._join(key, pump)
+        try:
+            index = 0
+            while True:
+                if index < len(call.chunks):
+                    index += 1
+                    yield call.chunks[index - 1]
+                    continue
+                if call.task.done():
+                    if not call.task.cancelled() and call.task.exception() is not None:
+                        raise call.task.exception()
+                    return
+                await call.changed.wait()
+        finally:
+            self._leave(key, call)
+
+    def stats(self):
+        calls = self.leaders + self.followers
+        return {
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "abandoned": self.abandoned,
+            "coalesced_ratio": self.followers / calls if calls else 0.0,
+        }
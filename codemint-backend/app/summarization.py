@@ -0,0 +1,126 @@
+import os
+import asyncio
+import logging
+from . import crud
+from .cache import session_cache
+from .context import count_tokens
+from .database import AsyncSessionLocal
+from .model_router import model_router
+from .tracing import traced
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Most recent messages that always stay verbatim in the context
+SUMMARY_KEEP_RECENT = int(os.getenv("SUMMARY_KEEP_RECENT", "20"))
+# Minimum number of older, unsummarized messages before we fold them in
+SUMMARY_MIN_FOLD = int(os.getenv("SUMMARY_MIN_FOLD", "10"))
+SUMMARY_MAX_FOLD = int(os.getenv("SUMMARY_MAX_FOLD", "200"))
+SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS", "2"))
+SUMMARY_QUEUE_SIZE = int(os.getenv("SUMMARY_QUEUE_SIZE", "1000"))
+
+SUMMARY_INSTRUCTIONS = "You maintain a running summary of a role-play conversation. Merge the new turns into the existing summary. Keep names, relationships, facts, open plot threads and the current scene. Write in the third person, at most a few paragraphs, and output only the summary."
+
+_queue = None
+_pending = set()
+_workers = []
+
+
+async def _load_fold(conversation_id: int):
+    async with AsyncSessionLocal() as db:
+        summary = await crud.get_conversation_summary_async(db, conversation_id)
+        recent = await crud.get_messages_before_async(db, conversation_id, limit=SUMMARY_KEEP_RECENT)
+        if len(recent) < SUMMARY_KEEP_RECENT:
+            return None, []
+        after_id = summary.last_message_id if summary else None
+        older = await crud.get_messages_between_async(db, conversation_id, after_id=after_id, before_id=recent[-1].id, limit=SUMMARY_MAX_FOLD)
+        previous = summary.content if summary else ""
+        return previous, [(msg.id, msg.role, msg.content) for msg in older]
+
+
+async def _store_fold(conversation_id: int, content: str, last_message_id: int):
+    async with AsyncSessionLocal() as db:
+        # Another worker may have folded further in the meantime; never move backwards
+        summary = await crud.get_conversation_summary_async(db, conversation_id)
+        if summary and summary.last_message_id and summary.last_message_id >= last_message_id:
+            return summary
+        return await crud.upsert_conversation_summary_async(db, conversation_id, content, last_message_id, count_tokens(content))
+
+
+@traced
+async def summarize_conversation(conversation_id: int):
+    previous, older = await _load_fold(conversation_id)
+    if len(older) < SUMMARY_MIN_FOLD:
+        return None
+
+    transcript = "\n".join(f"{role}: {content}" for _, role, content in older)
+    messages = [
+        {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+        {"role": "user", "content": f"Existing summary:\n{previous or '(none)'}\n\nNew turns:\n{transcript}"},
+    ]
+    response = await model_router.chat_completion("summary", messages)
+    content = response["choices"][0]["message"]["content"].strip()
+    last_message_id = older[-1][0]
+    await _store_fold(conversation_id, content, last_message_id)
+    # The cached window still holds the folded turns; reload it on the next request
+    await session_cache.invalidate_conversation(conversation_id)
+    logger.info("Folded %s messages into summary for conversation %s", len(older), conversation_id)
+    return content
+
+
+def queue_depth():
+    return _queue.qsize() if _queue is not None else 0
+
+
+def needs_summary(unsummarized):
+    # A fold only happens past this many unsummarized messages; below it a job would just
+    # read the summary and history to find nothing to do. None means the count is unknown.
+    return unsummarized is None or unsummarized >= SUMMARY_KEEP_RECENT + SUMMARY_MIN_FOLD
+
+
+def schedule_summary(conversation_id: int):
+    # Called from the request path: never waits, drops the job if the pool is saturated
+    if _queue is None or conversation_id in _pending:
+        return False
+    try:
+        _queue.put_nowait(conversation_id)
+    except asyncio.QueueFull:
+        logger.warning("Summary queue full, skipping conversation %s", conversation_id)
+        return False
+    _pending.add(conversation_id)
+    return True
+
+
+async def _worker():
+    while True:
+        conversation_id = await _queue.get()
+        try:
+            await summarize_conversation(conversation_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Error summarizing conversation %s: %s", conversation_id, e)
+        finally:
+            _pending.discard(conversation_id)
+            _queue.task_done()
+
+
+async def startup():
+    global _queue
+    if _queue is not None:
+        return
+    _queue = asyncio.Queue(maxsize=SUMMARY_QUEUE_SIZE)
+    for _ in range(SUMMARY_WORKERS):
+        _workers.append(asyncio.create_task(_worker()))
+    logger.info("Started %s summary workers", SUMMARY_WORKERS)
+
+
+async def shutdown():
+    global _queue
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    _pending.clear()
+    _queue = None
+    logger.info("Summary workers stopped")
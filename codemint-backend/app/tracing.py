@@ -0,0 +1,164 @@
+import os
+import inspect
+import logging
+import functools
+from contextlib import nullcontext
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# "none" turns tracing off; "console" prints spans, "file" appends them to TRACE_FILE as JSON
+# lines, "otlp" ships them to a collector (needs opentelemetry-exporter-otlp-proto-http)
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none")
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+# Head sampling: the fraction of new traces that are recorded; callers' decisions are kept
+TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", "0.01"))
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "intellimint-backend")
+
+_tracer = None
+_provider = None
+_untraced = nullcontext()
+
+
+def setup(exporter=TRACE_EXPORTER):
+    global _tracer, _provider
+    if exporter == "none" or _tracer is not None:
+        return
+    try:
+        from opentelemetry import trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+        from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+    except ImportError:
+        logger.warning("TRACE_EXPORTER is set but opentelemetry-sdk is not installed; tracing is off")
+        return
+
+    if exporter == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        span_exporter = OTLPSpanExporter()
+    elif exporter == "file":
+        span_exporter = ConsoleSpanExporter(out=open(TRACE_FILE, "a"), formatter=lambda span: span.to_json(indent=None) + "\n")
+    else:
+        span_exporter = ConsoleSpanExporter()
+
+    _provider = TracerProvider(
+        resource=Resource.create({"service.name": TRACE_SERVICE_NAME}),
+        sampler=ParentBased(TraceIdRatioBased(TRACE_SAMPLE_RATIO)),
+    )
+    # Spans are exported in batches off the request path
+    _provider.add_span_processor(BatchSpanProcessor(span_exporter))
+    trace.set_tracer_provider(_provider)
+    _tracer = trace.get_tracer("intellimint")
+    _correlate_logs()
+    logger.info("Tracing to %s, sampling %.2f%% of new traces", exporter, TRACE_SAMPLE_RATIO * 100)
+
+
+def shutdown():
+    global _tracer, _provider
+    if _provider is not None:
+        _provider.shutdown()
+    _tracer = None
+    _provider = None
+
+
+def current_ids():
+    # (trace_id, span_id) as hex when inside a sampled span, otherwise None
+    if _tracer is None:
+        return None
+    from opentelemetry import trace
+    context = trace.get_current_span().get_span_context()
+    if not context.trace_flags.sampled:
+        return None
+    return format(context.trace_id, "032x"), format(context.span_id, "016x")
+
+
+def _correlate_logs():
+    # Every log record carries trace_id and span_id ("-" outside a sampled trace); the
+    # formatters in logging_config add them to the line
+    make_record = logging.getLogRecordFactory()
+
+    def record_factory(*args, **kwargs):
+        record = make_record(*args, **kwargs)
+        ids = current_ids()
+        record.trace_id, record.span_id = ids or ("-", "-")
+        return record
+
+    logging.setLogRecordFactory(record_factory)
+
+
+def span(name, **attributes):
+    # Context manager for a child span of whatever is current; free when tracing is off
+    if _tracer is None:
+        return _untraced
+    return _tracer.start_as_current_span(name, attributes=attributes)
+
+
+def start_span(name, **attributes):
+    # A span that is not made current, for work that spans generator yields; call end()
+    if _tracer is None:
+        return None
+    return _tracer.start_span(name, attributes=attributes)
+
+
+def use_span(started):
+    # Makes a span from start_span() current for a block that does not yield
+    if started is None:
+        return _untraced
+    from opentelemetry import trace
+    return trace.use_span(started, end_on_exit=False)
+
+
+def traced(fn):
+    # Wraps a sync or async function in a span named after its module and name
+    name = f"{fn.__module__.replace('app.', '', 1)}.{fn.__name__}"
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            if _tracer is None:
+                return await fn(*args, **kwargs)
+            with _tracer.start_as_current_span(name):
+                return await fn(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if _tracer is None:
+            return fn(*args, **kwargs)
+        with _tracer.start_as_current_span(name):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+class TracingMiddleware:
+    # Root span per HTTP request, continuing an incoming W3C traceparent when there is one
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if _tracer is None or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        from opentelemetry import propagate, trace
+        from .metrics import route_template
+
+        headers = {key.decode("latin-1"): value.decode("latin-1") for key, value in scope.get("headers") or []}
+        request_span = _tracer.start_span(f"{scope['method']} {scope['path']}", context=propagate.extract(headers), kind=trace.SpanKind.SERVER)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            with trace.use_span(request_span, end_on_exit=False):
+                await self.app(scope, receive, send_wrapper)
+        finally:
+            route = route_template(scope)
+            request_span.update_name(f"{scope['method']} {route}")
+            request_span.set_attribute("http.route", route)
+            request_span.set_attribute("http.status_code", status)
+            request_span.end()
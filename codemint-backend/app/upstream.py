@@ -0,0 +1,294 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import httpx
+from dotenv import load_dotenv
+from .metrics import model_children, observe_usage
+from .tracing import span
+from .resilience import RetryBudget, CircuitBreaker, CircuitOpenError, LatencyTracker, backoff_delay, hedged
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+
+# Connection pool settings, tunable per deployment
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", "100"))
+UPSTREAM_KEEPALIVE = int(os.getenv("UPSTREAM_KEEPALIVE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "120"))
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "true").lower() in ("1", "true", "yes")
+
+# Retries on 429/5xx and transport errors, with jittered exponential backoff
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "2"))
+UPSTREAM_BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", "0.25"))
+UPSTREAM_BACKOFF_MAX = float(os.getenv("UPSTREAM_BACKOFF_MAX", "8"))
+# Each request earns this fraction of a retry (or hedge); caps extra load during an outage
+UPSTREAM_RETRY_RATIO = float(os.getenv("UPSTREAM_RETRY_RATIO", "0.2"))
+UPSTREAM_RETRY_BURST = float(os.getenv("UPSTREAM_RETRY_BURST", "20"))
+# Per-model circuit breaker
+UPSTREAM_BREAKER_THRESHOLD = int(os.getenv("UPSTREAM_BREAKER_THRESHOLD", "5"))
+UPSTREAM_BREAKER_COOLDOWN = float(os.getenv("UPSTREAM_BREAKER_COOLDOWN", "30"))
+# Hedged requests: send a backup once the first call is slower than the model's recent p95
+UPSTREAM_HEDGE = os.getenv("UPSTREAM_HEDGE", "false").lower() in ("1", "true", "yes")
+UPSTREAM_HEDGE_QUANTILE = float(os.getenv("UPSTREAM_HEDGE_QUANTILE", "0.95"))
+UPSTREAM_HEDGE_MIN_SAMPLES = int(os.getenv("UPSTREAM_HEDGE_MIN_SAMPLES", "20"))
+UPSTREAM_HEDGE_DEFAULT_DELAY = float(os.getenv("UPSTREAM_HEDGE_DEFAULT_DELAY", "2"))
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+_client = None
+_breakers = {}
+_latency = {}
+retry_budget = RetryBudget(UPSTREAM_RETRY_RATIO, UPSTREAM_RETRY_BURST)
+counters = {"requests": 0, "retries": 0, "gave_up": 0, "hedges_sent": 0, "hedges_won": 0}
+
+
+class UpstreamError(Exception):
+    def __init__(self, message, status_code=None, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self):
+        return self.status_code is None or self.status_code in RETRYABLE_STATUS
+
+
+class UpstreamUnavailable(UpstreamError):
+    # The model's circuit is open; nothing was sent
+    pass
+
+
+def _http2_available():
+    # httpx only speaks HTTP/2 when the optional h2 package is installed
+    if not UPSTREAM_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logger.warning("h2 is not installed, falling back to HTTP/1.1 for upstream calls")
+        return False
+    return True
+
+
+async def startup():
+    global _client
+    if _client is not None:
+        return _client
+    _client = httpx.AsyncClient(
+        base_url=OPENROUTER_BASE_URL,
+        headers={
+            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+            "Content-Type": "application/json",
+        },
+        http2=_http2_available(),
+        limits=httpx.Limits(
+            max_connections=UPSTREAM_POOL_SIZE,
+            max_keepalive_connections=UPSTREAM_KEEPALIVE,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            UPSTREAM_READ_TIMEOUT,
+            connect=UPSTREAM_CONNECT_TIMEOUT,
+            pool=UPSTREAM_CONNECT_TIMEOUT,
+        ),
+    )
+    logger.info("Upstream client started with pool size %s", UPSTREAM_POOL_SIZE)
+    return _client
+
+
+async def shutdown():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+        logger.info("Upstream client closed")
+
+
+def get_client():
+    if _client is None:
+        raise UpstreamError("Upstream client is not started")
+    return _client
+
+
+def breaker_for(model):
+    breaker = _breakers.get(model)
+    if breaker is None:
+        breaker = _breakers[model] = CircuitBreaker(UPSTREAM_BREAKER_THRESHOLD, UPSTREAM_BREAKER_COOLDOWN)
+    return breaker
+
+
+def latency_for(model):
+    tracker = _latency.get(model)
+    if tracker is None:
+        tracker = _latency[model] = LatencyTracker()
+    return tracker
+
+
+def hedge_delay(model):
+    tracker = latency_for(model)
+    if len(tracker.samples) < UPSTREAM_HEDGE_MIN_SAMPLES:
+        return UPSTREAM_HEDGE_DEFAULT_DELAY
+    return tracker.quantile(UPSTREAM_HEDGE_QUANTILE)
+
+
+def _status_error(response):
+    retry_after = response.headers.get("Retry-After")
+    try:
+        retry_after = float(retry_after) if retry_after is not None else None
+    except ValueError:
+        retry_after = None
+    return UpstreamError(f"Upstream returned {response.status_code}", status_code=response.status_code, retry_after=retry_after)
+
+
+async def _post(data):
+    try:
+        response = await get_client().post("/chat/completions", json=data)
+    except httpx.HTTPError as e:
+        raise UpstreamError(str(e)) from e
+    if response.status_code >= 400:
+        raise _status_error(response)
+    try:
+        return response.json()
+    except ValueError as e:
+        raise UpstreamError(f"Malformed response: {response.text[:200]!r}") from e
+
+
+def _allow_hedge():
+    if not retry_budget.withdraw():
+        return False
+    counters["hedges_sent"] += 1
+    return True
+
+
+async def _with_retries(model, attempt_call):
+    # Runs attempt_call under the model's breaker, retrying retryable failures while the
+    # retry budget lasts. Client errors (4xx other than 408/429) are returned to the caller as is.
+    breaker = breaker_for(model)
+    counters["requests"] += 1
+    retry_budget.deposit()
+    attempt = 0
+    while True:
+        try:
+            breaker.before_call()
+        except CircuitOpenError as e:
+            raise UpstreamUnavailable(f"{model}: {e}", status_code=503, retry_after=breaker.retry_after())
+        try:
+            with span("upstream.attempt", model=model, attempt=attempt):
+                result = await attempt_call()
+        except UpstreamError as e:
+            if not e.retryable:
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            if attempt >= UPSTREAM_MAX_RETRIES or not retry_budget.withdraw():
+                counters["gave_up"] += 1
+                raise
+            attempt += 1
+            counters["retries"] += 1
+            delay = backoff_delay(attempt, UPSTREAM_BACKOFF_BASE, UPSTREAM_BACKOFF_MAX, e.retry_after)
+            logger.warning("Upstream call to %s failed (%s), retry %s in %.2fs", model, e, attempt, delay)
+            await asyncio.sleep(delay)
+            continue
+        except BaseException:
+            breaker.release()
+            raise
+        breaker.record_success()
+        return result
+
+
+async def chat_completion(model, messages, **params):
+    data = {"model": model, "messages": messages, **params}
+
+    first_token, total = model_children(model)[:2]
+
+    async def attempt_call():
+        started = time.monotonic()
+        if UPSTREAM_HEDGE:
+            result, backup_won = await hedged(lambda: _post(data), hedge_delay(model), _allow_hedge)
+            if backup_won:
+                counters["hedges_won"] += 1
+        else:
+            result = await _post(data)
+        elapsed = time.monotonic() - started
+        latency_for(model).observe(elapsed)
+        # Without streaming the first token arrives with the rest
+        first_token.observe(elapsed)
+        total.observe(elapsed)
+        observe_usage(model, result.get("usage"))
+        return result
+
+    return await _with_retries(model, attempt_call)
+
+
+async def stream_chat_completion(model, messages, **params):
+    # Relay content deltas from the upstream SSE stream as they arrive. Opening the stream is
+    # retried like any other call; once tokens have been relayed a failure is final.
+    data = {"model": model, "messages": messages, "stream": True, **params}
+    stream = None
+    first_token, total = model_children(model)[:2]
+    started = time.monotonic()
+    waiting = True
+
+    async def open_stream():
+        nonlocal stream
+        context = get_client().stream("POST", "/chat/completions", json=data)
+        try:
+            response = await context.__aenter__()
+        except httpx.HTTPError as e:
+            raise UpstreamError(str(e)) from e
+        if response.status_code >= 400:
+            await context.__aexit__(None, None, None)
+            raise _status_error(response)
+        stream = context
+        return response
+
+    response = await _with_retries(model, open_stream)
+    try:
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == "[DONE]":
+                break
+            try:
+                chunk = json.loads(payload)
+            except ValueError as e:
+                # Treated like any other upstream failure: fallback before the first token
+                raise UpstreamError(f"Malformed stream chunk: {payload[:200]!r}") from e
+            if "error" in chunk:
+                raise UpstreamError(str(chunk["error"]))
+            # OpenRouter reports usage on the final chunk
+            observe_usage(model, chunk.get("usage"))
+            choices = chunk.get("choices") or [{}]
+            delta = choices[0].get("delta", {}).get("content")
+            if delta:
+                if waiting:
+                    first_token.observe(time.monotonic() - started)
+                    waiting = False
+                yield delta
+    except httpx.HTTPError as e:
+        raise UpstreamError(str(e)) from e
+    finally:
+        total.observe(time.monotonic() - started)
+        await stream.__aexit__(None, None, None)
+
+
+def stats():
+    return {
+        **counters,
+        "retry_budget": round(retry_budget.tokens, 2),
+        "retry_budget_exhausted": retry_budget.exhausted,
+        "hedging": UPSTREAM_HEDGE,
+        "models": {
+            model: {**breaker.stats(), **latency_for(model).stats(), "hedge_delay": hedge_delay(model)}
+            for model, breaker in _breakers.items()
+        },
+    }
@@ -0,0 +1,135 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import statistics
+from datetime import datetime, timedelta, timezone
+
+# Add the backend directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+parser = argparse.ArgumentParser(description="Space saved by archiving idle conversations, and the latency of loading them back")
+parser.add_argument("--database-url", help="defaults to a fresh SQLite file in a temporary directory")
+parser.add_argument("--conversations", type=int, default=500)
+parser.add_argument("--messages-per-conversation", type=int, default=200)
+parser.add_argument("--message-words", type=int, default=60)
+parser.add_argument("--rehydrations", type=int, default=200, help="archived conversations loaded back through the history loader")
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--output", help="write the JSON report to this file as well")
+args = parser.parse_args()
+
+workdir = tempfile.TemporaryDirectory(prefix="intellimint-archive-")
+# The app reads DATABASE_URL at import time
+os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(workdir.name, 'archive.db')}"
+os.environ.pop("ASYNC_DATABASE_URL", None)
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import logging  # noqa: E402
+from sqlalchemy import insert, text  # noqa: E402
+from app import archival, models  # noqa: E402
+from app.context import load_conversation_state  # noqa: E402
+from app.database import Base, engine, async_engine, AsyncSessionLocal  # noqa: E402
+
+logging.getLogger().setLevel(os.environ["LOG_LEVEL"])
+
+WORDS = ("the she he said looked back at moon tavern sword whisper smiled door night rain quietly "
+         "asked why because never again river captain letter promise laughed slowly cold fire dream").split()
+
+
+def seed():
+    Base.metadata.create_all(bind=engine)
+    long_ago = datetime.now(timezone.utc) - timedelta(days=365)
+    with engine.begin() as conn:
+        user_id = conn.execute(insert(models.User.__table__).values(email="bench@example.com")).inserted_primary_key[0]
+        conn.execute(insert(models.Session.__table__), [{"user_id": user_id}] * args.conversations)
+        conn.execute(insert(models.Conversation.__table__), [{"session_id": i + 1, "created_at": long_ago} for i in range(args.conversations)])
+        for start in range(0, args.conversations, 50):
+            conn.execute(insert(models.Message.__table__), [
+                {
+                    "conversation_id": conversation_id,
+                    "role": "user" if n % 2 == 0 else "assistant",
+                    "content": " ".join(random.choices(WORDS, k=random.randint(args.message_words // 2, args.message_words * 3 // 2))),
+                    "created_at": long_ago,
+                }
+                for conversation_id in range(start + 1, min(start + 50, args.conversations) + 1)
+                for n in range(args.messages_per_conversation)
+            ])
+
+
+def database_bytes():
+    # SQLite only: the file size after VACUUM, so freed pages are not counted
+    if engine.dialect.name != "sqlite":
+        return None
+    with engine.connect() as conn:
+        conn.execution_options(isolation_level="AUTOCOMMIT").execute(text("VACUUM"))
+        return conn.execute(text("PRAGMA page_count")).scalar() * conn.execute(text("PRAGMA page_size")).scalar()
+
+
+async def rehydrate_all(conversation_ids):
+    timings = []
+    for conversation_id in conversation_ids:
+        async with AsyncSessionLocal() as db:
+            started = time.perf_counter()
+            await load_conversation_state(db, conversation_id)
+            timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+async def main():
+    before = database_bytes()
+    started = time.perf_counter()
+    archived = await archival.run_pass(idle_days=30)
+    archive_seconds = time.perf_counter() - started
+    after = database_bytes()
+    totals = (await archival.stats())
+
+    # The loader's cost for a cold conversation: the archive lookup, decompression and the
+    # restore, then the history page it was asked for
+    sample = random.sample(range(1, args.conversations + 1), min(args.rehydrations, args.conversations))
+    timings = sorted(await rehydrate_all(sample))
+    # The same loads again, now served from the messages table, for comparison
+    warm = sorted(await rehydrate_all(sample))
+    await async_engine.dispose()
+    return {
+        "archived_conversations": archived,
+        "archive_seconds": round(archive_seconds, 2),
+        "archive_rate_messages_per_s": round(totals["this_process"]["messages_archived"] / archive_seconds) if archive_seconds else None,
+        "codec": totals["codec"],
+        "payload_raw_bytes": totals["raw_bytes"],
+        "payload_stored_bytes": totals["stored_bytes"],
+        "compression_ratio": totals["ratio"],
+        "database_bytes_before": before,
+        "database_bytes_after": after,
+        "load_archived": {
+            "p50_ms": round(statistics.median(timings), 3),
+            "p95_ms": round(timings[int(len(timings) * 0.95) - 1], 3),
+            "p99_ms": round(timings[int(len(timings) * 0.99) - 1], 3),
+        },
+        "load_live": {
+            "p50_ms": round(statistics.median(warm), 3),
+            "p95_ms": round(warm[int(len(warm) * 0.95) - 1], 3),
+            "p99_ms": round(warm[int(len(warm) * 0.99) - 1], 3),
+        },
+    }
+
+
+if __name__ == "__main__":
+    random.seed(args.seed)
+    seed()
+    results = asyncio.run(main())
+    report = {
+        "benchmark": "archive",
+        "dialect": engine.dialect.name,
+        "conversations": args.conversations,
+        "messages_per_conversation": args.messages_per_conversation,
+        **results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    workdir.cleanup()
@@ -0,0 +1,146 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+# Add the backend directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+parser = argparse.ArgumentParser(description="Microbenchmarks for the async CRUD and context-building functions")
+parser.add_argument("--database-url", help="defaults to a fresh SQLite file in a temporary directory")
+parser.add_argument("--iterations", type=int, default=500)
+parser.add_argument("--conversations", type=int, default=200)
+parser.add_argument("--messages-per-conversation", type=int, default=200)
+parser.add_argument("--characters", type=int, default=500)
+parser.add_argument("--output", help="write the JSON report to this file as well")
+args = parser.parse_args()
+
+workdir = tempfile.TemporaryDirectory(prefix="intellimint-crud-")
+# The app reads DATABASE_URL at import time
+os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(workdir.name, 'crud.db')}"
+os.environ.pop("ASYNC_DATABASE_URL", None)
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import logging  # noqa: E402
+from sqlalchemy import event, insert  # noqa: E402
+from app import crud, models, schemas  # noqa: E402
+from app.context import build_context, load_conversation_state  # noqa: E402
+from app.prompts import prompt_cache  # noqa: E402
+from app.database import Base, engine, async_engine, AsyncSessionLocal  # noqa: E402
+from app.features.character_creation import crud as character_crud, models as character_models, schemas as character_schemas  # noqa: E402
+
+logging.getLogger().setLevel(os.environ["LOG_LEVEL"])
+
+round_trips = 0
+
+
+def count_round_trip(*args):
+    global round_trips
+    round_trips += 1
+
+
+def seed():
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        user_id = conn.execute(insert(models.User.__table__).values(email="bench@example.com")).inserted_primary_key[0]
+        conn.execute(insert(models.Session.__table__), [{"user_id": user_id}] * args.conversations)
+        conn.execute(insert(models.Conversation.__table__), [{"session_id": i + 1} for i in range(args.conversations)])
+        conn.execute(insert(models.Message.__table__), [
+            {"conversation_id": 1 + (i % args.conversations), "role": "user" if i % 2 == 0 else "assistant", "content": f"Message {i}: " + "lorem ipsum dolor sit amet " * 6}
+            for i in range(args.conversations * args.messages_per_conversation)
+        ])
+        conn.execute(insert(character_models.Character.__table__), [
+            {
+                "name": f"Character {i}", "avatar_url": "", "gender_identity": "female", "sexual_orientation": "bisexual",
+                "description": "A benchmark character. " * 4, "persona": "Curious and quick-witted. " * 8,
+                "first_message": "Hello.", "creator_id": user_id,
+            }
+            for i in range(args.characters)
+        ])
+
+
+async def measure(name, call):
+    # Each iteration gets a fresh session, as a request would
+    global round_trips
+    timings = []
+    round_trips = 0
+    for i in range(args.iterations):
+        async with AsyncSessionLocal() as db:
+            started = time.perf_counter()
+            await call(db, i)
+            timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return name, {
+        "p50_ms": round(statistics.median(timings), 3),
+        "p95_ms": round(timings[int(len(timings) * 0.95) - 1], 3),
+        "p99_ms": round(timings[int(len(timings) * 0.99) - 1], 3),
+        "mean_ms": round(statistics.fmean(timings), 3),
+        "ops_per_s": round(1000 / statistics.fmean(timings), 1),
+        "round_trips_per_call": round(round_trips / args.iterations, 2),
+    }
+
+
+def conversation(i):
+    return 1 + (i % args.conversations)
+
+
+async def main():
+    async with AsyncSessionLocal() as db:
+        states = {cid: await load_conversation_state(db, cid) for cid in range(1, min(args.conversations, 50) + 1)}
+        prefix = prompt_cache.prefix(await character_crud.get_character_async(db, 1))
+
+    def warm_state(i):
+        return states[1 + (i % len(states))]
+
+    async def load_and_build(db, i):
+        state = await load_conversation_state(db, conversation(i))
+        return await build_context(db, state, prefix, f"Turn {i}")
+
+    benchmarks = [
+        ("get_session_async", lambda db, i: crud.get_session_async(db, conversation(i))),
+        ("get_latest_conversation_async", lambda db, i: crud.get_latest_conversation_async(db, conversation(i))),
+        ("get_messages_before_async", lambda db, i: crud.get_messages_before_async(db, conversation(i), limit=50)),
+        ("get_conversation_summary_async", lambda db, i: crud.get_conversation_summary_async(db, conversation(i))),
+        ("create_session_with_conversation_async", lambda db, i: crud.create_session_with_conversation_async(db, schemas.SessionCreate(user_id=1))),
+        ("create_chat_turns_async", lambda db, i: crud.create_chat_turns_async(db, [
+            schemas.MessageCreate(conversation_id=conversation(i), role="user", content=f"bench {i}"),
+            schemas.MessageCreate(conversation_id=conversation(i), role="assistant", content=f"reply {i}"),
+        ], [conversation(i)])),
+        ("get_character_async", lambda db, i: character_crud.get_character_async(db, 1 + (i % args.characters))),
+        ("get_characters_async", lambda db, i: character_crud.get_characters_async(db, skip=i % max(1, args.characters - 100), limit=100)),
+        ("get_characters_page_async", lambda db, i: character_crud.get_characters_page_async(db, after=i % max(1, args.characters - 100), limit=100)),
+        ("create_character_async", lambda db, i: character_crud.create_character_async(db, character_schemas.CharacterCreate(
+            name=f"New {i}", avatar_url="", gender_identity="male", sexual_orientation="gay",
+            description="Created by the benchmark.", persona="Terse.", first_message="Hi.",
+        ), creator_id=1)),
+        ("load_conversation_state", lambda db, i: load_conversation_state(db, conversation(i))),
+        # From a cached window, paging older history from the database while the budget has room
+        ("build_context", lambda db, i: build_context(db, warm_state(i), prefix, f"Turn {i}")),
+        # A session cache miss: load the window first, as the chat route does
+        ("load_state_and_build_context", load_and_build),
+    ]
+    return dict([await measure(name, call) for name, call in benchmarks])
+
+
+if __name__ == "__main__":
+    seed()
+    event.listen(async_engine.sync_engine, "before_cursor_execute", count_round_trip)
+    results = asyncio.run(main())
+    report = {
+        "benchmark": "crud_and_context",
+        "dialect": engine.dialect.name,
+        "iterations": args.iterations,
+        "conversations": args.conversations,
+        "messages_per_conversation": args.messages_per_conversation,
+        "characters": args.characters,
+        "results": results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    workdir.cleanup()
@@ -0,0 +1,120 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+
+# Add the backend directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+parser = argparse.ArgumentParser(description="History-fetch latency with and without the history indexes")
+parser.add_argument("--database-url", default=os.getenv("DATABASE_URL", "sqlite:///./bench_history.db"))
+parser.add_argument("--messages", type=int, default=10_000_000)
+parser.add_argument("--conversations", type=int, default=100_000)
+parser.add_argument("--samples", type=int, default=500)
+parser.add_argument("--page-size", type=int, default=50)
+parser.add_argument("--skip-seed", action="store_true", help="reuse rows from a previous run")
+parser.add_argument("--output", help="write the JSON report to this file as well")
+args = parser.parse_args()
+
+# The app reads DATABASE_URL at import time
+os.environ["DATABASE_URL"] = args.database_url
+
+from sqlalchemy import text, insert  # noqa: E402
+from app import crud, models  # noqa: E402
+from app.database import Base, engine, SessionLocal  # noqa: E402
+
+HISTORY_INDEXES = [
+    index
+    for table in (models.Message.__table__, models.Conversation.__table__, models.Session.__table__)
+    for index in table.indexes
+    if len(index.columns) > 1 or index.name == "ix_sessions_user_id"
+]
+BATCH = 50_000
+
+
+def seed():
+    # Expects an empty database so that session and conversation ids start at 1
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        user_id = conn.execute(insert(models.User.__table__).values(email="bench@example.com")).inserted_primary_key[0]
+        if engine.dialect.name == "postgresql":
+            # Let the server generate the rows; far faster than shipping 10M rows over the wire
+            conn.execute(text("INSERT INTO sessions (user_id) SELECT :u FROM generate_series(1, :n)"), {"u": user_id, "n": args.conversations})
+            conn.execute(text("INSERT INTO conversations (session_id) SELECT id FROM sessions ORDER BY id LIMIT :n"), {"n": args.conversations})
+            conn.execute(text(
+                "INSERT INTO messages (conversation_id, role, content, created_at) "
+                "SELECT (SELECT min(id) FROM conversations) + (g % :c), "
+                "CASE WHEN g % 2 = 0 THEN 'user' ELSE 'assistant' END, "
+                "repeat('lorem ipsum ', 8), now() - (:m - g) * interval '1 millisecond' "
+                "FROM generate_series(1, :m) AS g"
+            ), {"c": args.conversations, "m": args.messages})
+            return
+        conn.execute(insert(models.Session.__table__), [{"user_id": user_id}] * args.conversations)
+        conn.execute(insert(models.Conversation.__table__), [{"session_id": i + 1} for i in range(args.conversations)])
+    first_id = 1
+    for start in range(0, args.messages, BATCH):
+        rows = [
+            {"conversation_id": first_id + (i % args.conversations), "role": "user" if i % 2 == 0 else "assistant", "content": "lorem ipsum " * 8}
+            for i in range(start, min(start + BATCH, args.messages))
+        ]
+        with engine.begin() as conn:
+            conn.execute(insert(models.Message.__table__), rows)
+        print(f"seeded {start + len(rows)}/{args.messages} messages", file=sys.stderr)
+
+
+def set_indexes(present):
+    for index in HISTORY_INDEXES:
+        if present:
+            index.create(bind=engine, checkfirst=True)
+        else:
+            index.drop(bind=engine, checkfirst=True)
+    with engine.begin() as conn:
+        conn.execute(text("ANALYZE"))
+
+
+def measure():
+    rng = random.Random(42)
+    db = SessionLocal()
+    timings = []
+    try:
+        for _ in range(args.samples):
+            session_id = rng.randint(1, args.conversations)
+            start = time.perf_counter()
+            conversation = crud.get_latest_conversation(db, session_id)
+            if conversation is not None:
+                crud.get_messages_before(db, conversation.id, limit=args.page_size)
+            timings.append((time.perf_counter() - start) * 1000)
+    finally:
+        db.close()
+    timings.sort()
+    return {
+        "p50_ms": round(statistics.median(timings), 3),
+        "p95_ms": round(timings[int(len(timings) * 0.95) - 1], 3),
+        "p99_ms": round(timings[int(len(timings) * 0.99) - 1], 3),
+        "mean_ms": round(statistics.fmean(timings), 3),
+    }
+
+
+if __name__ == "__main__":
+    if not args.skip_seed:
+        seed()
+    set_indexes(False)
+    without_indexes = measure()
+    set_indexes(True)
+    with_indexes = measure()
+    report = {
+        "benchmark": "history_fetch",
+        "dialect": engine.dialect.name,
+        "messages": args.messages,
+        "conversations": args.conversations,
+        "samples": args.samples,
+        "without_indexes": without_indexes,
+        "with_indexes": with_indexes,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,320 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import itertools
+import statistics
+import subprocess
+import httpx
+
+# Starts mock_openrouter.py and the app from main.py (under uvicorn, against a throwaway database),
+# drives the chat, character and code routes at a fixed concurrency, and prints one JSON report.
+# Diff the reports of two releases, e.g. `python benchmarks/bench_load.py --output before.json`.
+
+BACKEND = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+SCENARIOS = ("chat", "chat_stream", "characters", "code")
+
+parser = argparse.ArgumentParser(description="End-to-end load test against a mock OpenRouter")
+parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"comma-separated subset of {', '.join(SCENARIOS)}")
+parser.add_argument("--concurrency", type=int, default=32)
+parser.add_argument("--requests", type=int, default=1000, help="measured requests per scenario")
+parser.add_argument("--warmup", type=int, default=50, help="unmeasured requests per scenario")
+parser.add_argument("--latency", type=float, default=0.05, help="mock upstream latency before the first byte, in seconds")
+parser.add_argument("--jitter", type=float, default=0.02)
+parser.add_argument("--token-delay", type=float, default=0.005, help="mock upstream seconds between streamed tokens")
+parser.add_argument("--reply-words", type=int, default=40)
+parser.add_argument("--prefill-per-1k", type=float, default=0.0, help="mock upstream seconds per 1000 prompt tokens its prompt cache does not cover")
+parser.add_argument("--characters", type=int, default=200, help="characters created up front, browsed by the characters scenario and chatted with by the chat ones")
+parser.add_argument("--database-url", help="defaults to a fresh SQLite file in a temporary directory")
+parser.add_argument("--app-port", type=int, default=8765)
+parser.add_argument("--mock-port", type=int, default=8798)
+parser.add_argument("--app-env", action="append", default=[], metavar="KEY=VALUE", help="extra environment for the app, repeatable")
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--output", help="write the JSON report to this file as well")
+
+
+class User:
+    # One virtual user per worker: its own caller id for admission control and its own session
+    def __init__(self, number):
+        self.number = number
+        self.headers = {"X-User-Id": f"bench-{number}"}
+        self.session_id = None
+        self.character_id = None
+        self.etags = {}
+
+
+def chat_payload(user, message, state):
+    # Each user keeps talking to one character for the whole run, as in a real session
+    if user.character_id is None and state["character_ids"]:
+        user.character_id = state["character_ids"][user.number % len(state["character_ids"])]
+    return {"session_id": user.session_id, "character_id": user.character_id, "message": message}
+
+
+async def chat(client, user, i, state):
+    response = await client.post("/chat", json=chat_payload(user, f"Message {i} from user {user.number}", state), headers=user.headers)
+    if response.status_code == 200:
+        user.session_id = response.json()["session_id"]
+    return response.status_code, None
+
+
+async def chat_stream(client, user, i, state):
+    # Time to the first token as well as to the end of the stream
+    started = time.perf_counter()
+    first_token = None
+    event = None
+    payload = chat_payload(user, f"Streamed message {i} from user {user.number}", state)
+    async with client.stream("POST", "/chat/stream", json=payload, headers=user.headers) as response:
+        if response.status_code != 200:
+            await response.aread()
+            return response.status_code, None
+        async for line in response.aiter_lines():
+            if line.startswith("event: "):
+                event = line[7:]
+            elif line.startswith("data: "):
+                if event == "session":
+                    user.session_id = json.loads(line[6:])["session_id"]
+                elif event == "error":
+                    return "stream_error", first_token
+                elif event is None and first_token is None:
+                    first_token = time.perf_counter() - started
+                event = None
+    return response.status_code, first_token
+
+
+def character_payload(n):
+    return {
+        "name": f"Character {n}",
+        "avatar_url": f"https://example.com/avatars/{n}.png",
+        "gender_identity": random.choice(["female", "male", "non-binary"]),
+        "sexual_orientation": random.choice(["straight", "gay", "bisexual", "pansexual"]),
+        "description": f"A benchmark character number {n} with a short description.",
+        "persona": "Curious, quick-witted and fond of long stories. " * 4,
+        "first_message": "Hello there, traveller.",
+    }
+
+
+async def characters(client, user, i, state):
+    # Mostly reads: one create in ten, the rest split between paging the catalog and fetching
+    # one character. Reads revalidate what this user fetched before, as a browser would.
+    roll = i % 10
+    if roll == 0:
+        response = await client.post("/characters/", json=character_payload(i), headers=user.headers)
+        if response.status_code == 200:
+            state["character_ids"].append(response.json()["id"])
+        return response.status_code, None
+    if roll < 5:
+        url = f"/characters/?limit=20&after={random.choice(state['character_ids'][:-20] or [0])}"
+    else:
+        url = f"/characters/{random.choice(state['character_ids'])}"
+    headers = {**user.headers, "If-None-Match": user.etags[url]} if url in user.etags else user.headers
+    response = await client.get(url, headers=headers)
+    if "etag" in response.headers:
+        user.etags[url] = response.headers["etag"]
+    return response.status_code, None
+
+
+async def code(client, user, i, state):
+    # Distinct inputs, so every call misses the code-operation cache and reaches the upstream
+    snippet = {"language": "python", "code": f"def f{i}(xs):\n    return [x * {i} for x in xs]\n"}
+    kind = i % 3
+    if kind == 0:
+        response = await client.post("/generate", params={"language": "python", "prompt": f"Write function number {i} that sorts a list"})
+    elif kind == 1:
+        response = await client.post("/optimize", json=snippet)
+    else:
+        response = await client.post("/debug", json=snippet)
+    return response.status_code, None
+
+
+async def seed_characters(client, state):
+    for n in range(args.characters):
+        response = await client.post("/characters/", json=character_payload(n))
+        response.raise_for_status()
+        state["character_ids"].append(response.json()["id"])
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    return {
+        "p50_ms": round(statistics.median(values) * 1000, 2),
+        "p95_ms": round(values[max(0, int(len(values) * 0.95) - 1)] * 1000, 2),
+        "p99_ms": round(values[max(0, int(len(values) * 0.99) - 1)] * 1000, 2),
+        "mean_ms": round(statistics.fmean(values) * 1000, 2),
+        "max_ms": round(values[-1] * 1000, 2),
+    }
+
+
+async def db_statements(client):
+    text = (await client.get("/metrics")).text
+    return sum(float(value) for value in re.findall(r'^intellimint_db_statements_total\{[^}]*\} (\S+)$', text, re.M))
+
+
+async def upstream_stats(mock):
+    stats = (await mock.get("/_stats")).json()
+    return stats["requests"], stats["prompt_tokens"], stats["cached_prompt_tokens"]
+
+
+async def drive(client, scenario, count, state):
+    users = state["users"]
+    # Request numbers keep counting across warmup and measured runs, so inputs never repeat
+    numbers = state["numbers"]
+    issued = itertools.count()
+    latencies, first_tokens, statuses = [], [], {}
+
+    async def worker(user):
+        while next(issued) < count:
+            i = next(numbers)
+            started = time.perf_counter()
+            try:
+                status, first_token = await scenario(client, user, i, state)
+            except httpx.HTTPError as e:
+                status, first_token = type(e).__name__, None
+            elapsed = time.perf_counter() - started
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if status in (200, 304):
+                latencies.append(elapsed)
+                if first_token is not None:
+                    first_tokens.append(first_token)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(user) for user in users))
+    return time.perf_counter() - started, latencies, first_tokens, statuses
+
+
+async def run_scenario(client, mock, name, state):
+    scenario = globals()[name]
+    await drive(client, scenario, args.warmup, state)
+    # Let write-behind flushes and summaries from the warmup settle before counting
+    await asyncio.sleep(0.5)
+    statements_before = await db_statements(client)
+    upstream_before = await upstream_stats(mock)
+    elapsed, latencies, first_tokens, statuses = await drive(client, scenario, args.requests, state)
+    await asyncio.sleep(0.5)
+    statements = await db_statements(client) - statements_before
+    calls, prompt_tokens, cached_tokens = (after - before for after, before in zip(await upstream_stats(mock), upstream_before))
+    result = {
+        "requests": args.requests,
+        "ok": len(latencies),
+        "statuses": statuses,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency": percentiles(latencies),
+        # Includes work the request set off in the background (write-behind, summaries)
+        "db_round_trips_per_request": round(statements / args.requests, 3),
+        "upstream_calls_per_request": round(calls / args.requests, 3),
+    }
+    if prompt_tokens:
+        # Share of the prompt the mock's prompt cache covered, as a provider would report it
+        result["upstream_prompt_tokens_per_call"] = round(prompt_tokens / calls, 1)
+        result["upstream_cached_prompt_ratio"] = round(cached_tokens / prompt_tokens, 3)
+    if first_tokens:
+        result["first_token"] = percentiles(first_tokens)
+    return result
+
+
+def start(command, env, url, log):
+    process = subprocess.Popen(command, cwd=BACKEND, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            httpx.get(url, timeout=1)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.kill()
+    log.seek(0)
+    sys.exit(f"{' '.join(command)} did not come up:\n{log.read().decode(errors='replace')[-4000:]}")
+
+
+async def run(names):
+    # Users (and their sessions) carry over from the warmup into the measured run
+    state = {"users": [User(n) for n in range(args.concurrency)], "character_ids": [], "numbers": itertools.count()}
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.app_port}", timeout=120, limits=limits) as client, \
+            httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.mock_port}", timeout=10) as mock:
+        if {"characters", "chat", "chat_stream"} & set(names):
+            await seed_characters(client, state)
+        return {name: await run_scenario(client, mock, name, state) for name in names}
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    random.seed(args.seed)
+    names = [name for name in args.scenarios.split(",") if name]
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    workdir = tempfile.TemporaryDirectory(prefix="intellimint-load-")
+    database_url = args.database_url or f"sqlite:///{os.path.join(workdir.name, 'load.db')}"
+    env = {
+        **os.environ,
+        "DATABASE_URL": database_url,
+        "OPENROUTER_BASE_URL": f"http://127.0.0.1:{args.mock_port}/api/v1",
+        "OPENROUTER_API_KEY": "load-test",
+        "CODE_CACHE_PATH": os.path.join(workdir.name, "code_cache.sqlite3"),
+        "BLOB_STORE_PATH": os.path.join(workdir.name, "blobs"),
+        "LOG_LEVEL": "WARNING",
+        # Every virtual user sends as fast as it can; keep the per-caller buckets out of the way
+        "ADMISSION_REFILL_RATE": "1000000",
+        # The load generator stands in for the authenticating proxy that names each user
+        "ADMISSION_TRUSTED_PROXIES": "127.0.0.1",
+    }
+    env.pop("ASYNC_DATABASE_URL", None)
+    env.update(item.split("=", 1) for item in args.app_env)
+
+    mock_log = open(os.path.join(workdir.name, "mock.log"), "w+b")
+    app_log = open(os.path.join(workdir.name, "app.log"), "w+b")
+    processes = []
+    try:
+        processes.append(start(
+            [sys.executable, os.path.join("benchmarks", "mock_openrouter.py"), "--port", str(args.mock_port),
+             "--latency", str(args.latency), "--jitter", str(args.jitter),
+             "--token-delay", str(args.token_delay), "--reply-words", str(args.reply_words),
+             "--prefill-per-1k", str(args.prefill_per_1k)],
+            env, f"http://127.0.0.1:{args.mock_port}/_stats", mock_log,
+        ))
+        processes.append(start(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(args.app_port), "--log-level", "warning"],
+            env, f"http://127.0.0.1:{args.app_port}/", app_log,
+        ))
+        results = asyncio.run(run(names))
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    report = {
+        "benchmark": "load",
+        "config": {
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "upstream_latency_s": args.latency,
+            "upstream_jitter_s": args.jitter,
+            "token_delay_s": args.token_delay,
+            "reply_words": args.reply_words,
+            "prefill_per_1k_s": args.prefill_per_1k,
+            "characters": args.characters,
+            "database": database_url.split("://", 1)[0],
+            "app_env": args.app_env,
+        },
+        "scenarios": results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    workdir.cleanup()
@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import statistics
+
+# Add the backend directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import logging_config  # noqa: E402
+
+parser = argparse.ArgumentParser(description="Per-request logging overhead: eager f-strings with a synchronous handler vs lazy args with the queued JSON setup")
+parser.add_argument("--requests", type=int, default=20_000)
+parser.add_argument("--sink", default=os.devnull, help="file the log lines are written to")
+parser.add_argument("--sink-delay", type=float, default=0.0, help="seconds each write to the sink takes, to stand in for a slow pipe or disk")
+parser.add_argument("--sample-rate", type=float, default=logging_config.LOG_SAMPLE_RATE)
+parser.add_argument("--output", help="write the JSON report to this file as well")
+args = parser.parse_args()
+
+crud_logger = logging.getLogger("app.crud")
+context_logger = logging.getLogger("app.context")
+chat_logger = logging.getLogger("app.api.endpoints.chat")
+httpx_logger = logging.getLogger("httpx")
+
+URL = "https://openrouter.ai/api/v1/chat/completions"
+
+
+class SlowSink:
+    def __init__(self, path, delay):
+        self.file = open(path, "w")
+        self.delay = delay
+
+    def write(self, text):
+        if self.delay:
+            time.sleep(self.delay)
+        return self.file.write(text)
+
+    def flush(self):
+        self.file.flush()
+
+
+def eager_request(i):
+    # The lines one chat turn logged before: f-strings built whether or not they are emitted
+    crud_logger.info(f"Retrieved session {i}")
+    crud_logger.info(f"Retrieved conversation {i} for session {i}")
+    crud_logger.info(f"Retrieved {40} messages for conversation {i}")
+    context_logger.info(f"Built context for conversation {i}: {40} messages, {3120}/{6000} tokens")
+    httpx_logger.info(f'HTTP Request: POST {URL} "HTTP/1.1 200 OK"')
+    crud_logger.info(f"Created new message {2 * i} in conversation {i}")
+    crud_logger.info(f"Created new message {2 * i + 1} in conversation {i}")
+    chat_logger.info(f"Saved chat turn to conversation {i}")
+
+
+def lazy_request(i):
+    crud_logger.info("Retrieved session %s", i)
+    crud_logger.info("Retrieved conversation %s for session %s", i, i)
+    crud_logger.info("Retrieved %s messages for conversation %s", 40, i)
+    context_logger.info("Built context for conversation %s: %s messages, %s/%s tokens", i, 40, 3120, 6000)
+    httpx_logger.info('HTTP Request: POST %s "%s %d %s"', URL, "HTTP/1.1", 200, "OK")
+    crud_logger.info("Created new message %s in conversation %s", 2 * i, i)
+    crud_logger.info("Created new message %s in conversation %s", 2 * i + 1, i)
+    chat_logger.info("Saved chat turn to conversation %s", i)
+
+
+def measure(request):
+    timings = []
+    for i in range(args.requests):
+        started = time.perf_counter()
+        request(i)
+        timings.append((time.perf_counter() - started) * 1_000_000)
+    timings.sort()
+    return {
+        "p50_us": round(statistics.median(timings), 2),
+        "p95_us": round(timings[int(len(timings) * 0.95) - 1], 2),
+        "p99_us": round(timings[int(len(timings) * 0.99) - 1], 2),
+        "mean_us": round(statistics.fmean(timings), 2),
+    }
+
+
+def before(level):
+    # What each module used to do: basicConfig with a synchronous stream handler
+    logging.basicConfig(level=level, stream=SlowSink(args.sink, args.sink_delay), force=True)
+    result = measure(eager_request)
+    logging.getLogger().handlers.clear()
+    return result
+
+
+def after(level):
+    logging_config.counters.update(dropped=0, sampled_out=0)
+    logging_config.configure_logging(level=level, fmt="json", sample_rate=args.sample_rate, stream=SlowSink(args.sink, args.sink_delay))
+    result = measure(lazy_request)
+    started = time.perf_counter()
+    logging_config.shutdown_logging()
+    result["drain_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    result.update(logging_config.counters)
+    return result
+
+
+if __name__ == "__main__":
+    report = {
+        "benchmark": "logging_overhead",
+        "requests": args.requests,
+        "lines_per_request": 8,
+        "sink_delay_s": args.sink_delay,
+        "sample_rate": args.sample_rate,
+        # INFO emitted: the cost of building, formatting and writing each line
+        "info_enabled": {"before": before(logging.INFO), "after": after(logging.INFO)},
+        # INFO filtered out by level: what eager f-strings cost for lines nobody sees
+        "info_disabled": {"before": before(logging.WARNING), "after": after(logging.WARNING)},
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
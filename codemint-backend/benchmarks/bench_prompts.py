@@ -0,0 +1,91 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+
+# Add the backend directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+parser = argparse.ArgumentParser(description="Per-turn cost of the system prefix, compiled every turn versus from the prompt cache")
+parser.add_argument("--characters", type=int, default=1000)
+parser.add_argument("--turns", type=int, default=20000)
+parser.add_argument("--persona-words", type=int, default=400, help="rough size of each character's persona")
+parser.add_argument("--cache-entries", type=int, help="prompt cache size; defaults to PROMPT_CACHE_MAX_ENTRIES")
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--output", help="write the JSON report to this file as well")
+args = parser.parse_args()
+
+# The prompt code needs no database; these only satisfy the app's import-time settings
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from app import context, prompts  # noqa: E402
+from app.features.character_creation.schemas import Character  # noqa: E402
+
+WORDS = ["curious", "brave", "sardonic", "gentle", "restless", "scholar", "sailor", "storm", "lantern", "orchard", "quiet", "laughs", "remembers", "distrusts", "collects"]
+
+
+def character_data(n):
+    return {
+        "id": n, "creator_id": 1, "name": f"Character {n}", "avatar_url": "",
+        "gender_identity": random.choice(["female", "male", "non-binary"]),
+        "sexual_orientation": random.choice(["straight", "gay", "bisexual"]),
+        "description": " ".join(random.choices(WORDS, k=40)),
+        "persona": " ".join(random.choices(WORDS, k=args.persona_words)),
+        "first_message": "Hello there, traveller.",
+    }
+
+
+def measure(turns, prefix_for):
+    timings = []
+    for data in turns:
+        # A fresh object per turn, as the character cache hands out
+        character = Character(**data)
+        started = time.perf_counter()
+        prefix_for(character)
+        timings.append((time.perf_counter() - started) * 1_000_000)
+    timings.sort()
+    return {
+        "p50_us": round(statistics.median(timings), 2),
+        "p99_us": round(timings[int(len(timings) * 0.99) - 1], 2),
+        "mean_us": round(statistics.fmean(timings), 2),
+    }
+
+
+if __name__ == "__main__":
+    random.seed(args.seed)
+    catalog = [character_data(n) for n in range(1, args.characters + 1)]
+    # A few popular characters take most of the chats
+    weights = [1 / rank for rank in range(1, len(catalog) + 1)]
+    turns = random.choices(catalog, weights=weights, k=args.turns)
+
+    cache = prompts.PromptCache(args.cache_entries or prompts.PROMPT_CACHE_MAX_ENTRIES)
+    uncached = measure(turns, prompts.compile_prefix)
+    cached = measure(turns, cache.prefix)
+
+    # The prefix sent on a character's second turn must serialize to the same bytes as on its first
+    first = json.dumps(list(cache.prefix(Character(**catalog[0])).messages))
+    catalog[0]["persona"] += " changed"
+    updated = json.dumps(list(cache.prefix(Character(**catalog[0])).messages))
+    again = json.dumps(list(cache.prefix(Character(**catalog[0])).messages))
+
+    report = {
+        "benchmark": "prompt_prefix",
+        "tokenizer": "tiktoken cl100k_base" if context._encoding is not None else "length estimate",
+        "characters": args.characters,
+        "turns": args.turns,
+        "prefix_tokens_mean": round(statistics.fmean(prompts.compile_prefix(Character(**data)).tokens for data in catalog[:100]), 1),
+        "compile_every_turn": uncached,
+        "prompt_cache": cached,
+        "speedup": round(uncached["mean_us"] / cached["mean_us"], 1),
+        "cache": cache.stats(),
+        "prefix_changes_on_update": first != updated,
+        "prefix_stable_between_turns": updated == again,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,129 @@
+import os
+import sys
+import json
+import time
+import random
+import resource
+import argparse
+import statistics
+import itertools
+
+# Add the backend directory to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+parser = argparse.ArgumentParser(description="Character search latency on the in-process index over a synthetic catalog")
+parser.add_argument("--characters", type=int, default=1_000_000)
+parser.add_argument("--vocabulary", type=int, default=50_000, help="distinct words, drawn with a Zipf distribution")
+parser.add_argument("--description-words", type=int, default=15)
+parser.add_argument("--persona-words", type=int, default=30)
+parser.add_argument("--queries", type=int, default=300, help="queries per query kind")
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--output", help="write the JSON report to this file as well")
+args = parser.parse_args()
+
+# The index needs no database; these only satisfy the app's import-time settings
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from app.features.character_creation.search import InvertedIndex  # noqa: E402
+
+GENDERS = ["female", "male", "non-binary"]
+ORIENTATIONS = ["straight", "gay", "bisexual", "pansexual", "asexual"]
+SYLLABLES = ["ka", "lo", "mi", "ra", "ven", "tor", "sha", "el", "dor", "qui", "na", "bel", "zar", "ith", "um", "os", "fen", "gar"]
+
+
+def make_words(count):
+    words = set()
+    while len(words) < count:
+        words.add("".join(random.choice(SYLLABLES) for _ in range(random.randint(2, 4))))
+    return sorted(words, key=lambda word: random.random())
+
+
+def typo(word):
+    i = random.randrange(len(word))
+    return word[:i] + random.choice("aeiouxz") + word[i + 1:]
+
+
+def measure(index, queries, filters=None):
+    timings = []
+    hits = 0
+    for query in queries:
+        started = time.perf_counter()
+        results = index.search(query, filters() if filters else None, limit=20)
+        timings.append((time.perf_counter() - started) * 1000)
+        hits += len(results)
+    timings.sort()
+    return {
+        "p50_ms": round(statistics.median(timings), 3),
+        "p95_ms": round(timings[int(len(timings) * 0.95) - 1], 3),
+        "p99_ms": round(timings[int(len(timings) * 0.99) - 1], 3),
+        "mean_ms": round(statistics.fmean(timings), 3),
+        "mean_hits": round(hits / len(queries), 1),
+    }
+
+
+if __name__ == "__main__":
+    random.seed(args.seed)
+    vocabulary = make_words(args.vocabulary)
+    cumulative = list(itertools.accumulate(1 / (rank + 1) ** 1.07 for rank in range(len(vocabulary))))
+
+    def text(words):
+        return " ".join(random.choices(vocabulary, cum_weights=cumulative, k=words))
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    index = InvertedIndex()
+    started = time.perf_counter()
+    for character_id in range(1, args.characters + 1):
+        index.add(character_id, {
+            "name": f"{random.choice(vocabulary).title()} {random.choice(vocabulary).title()}",
+            "description": text(args.description_words),
+            "persona": text(args.persona_words),
+            "gender_identity": random.choice(GENDERS),
+            "sexual_orientation": random.choice(ORIENTATIONS),
+        })
+    build_seconds = time.perf_counter() - started
+    # ru_maxrss is in kilobytes on Linux
+    index_mb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024
+
+    n = args.queries
+    # Bands of the Zipf ranking, as fractions so they hold for any --vocabulary (at the default
+    # 50,000: the top 50 words, ranks 500-5,000 and everything past 20,000)
+    size = len(vocabulary)
+    common = vocabulary[:max(1, size // 1000)]
+    middle = vocabulary[size // 100:max(size // 100 + 1, size // 10)]
+    rare = vocabulary[min(size - 1, size * 2 // 5):]
+    kinds = {
+        "common_word": measure(index, [random.choice(common) for _ in range(n)]),
+        "mid_frequency_word": measure(index, [random.choice(middle) + " " for _ in range(n)]),
+        "rare_word": measure(index, [random.choice(rare) + " " for _ in range(n)]),
+        "two_words": measure(index, [f"{random.choice(middle)} {random.choice(common)} " for _ in range(n)]),
+        "three_words": measure(index, [f"{random.choice(rare)} {random.choice(middle)} {random.choice(common)} " for _ in range(n)]),
+        "prefix": measure(index, [random.choice(middle)[:4] for _ in range(n)]),
+        "typo": measure(index, [typo(random.choice(middle)) + " " for _ in range(n)]),
+        "filtered": measure(index, [f"{random.choice(middle)} {random.choice(common)} " for _ in range(n)],
+                            filters=lambda: {"gender_identity": random.choice(GENDERS), "sexual_orientation": random.choice(ORIENTATIONS)}),
+    }
+
+    # Writes while serving: updates supersede old postings, which later scans compact
+    started = time.perf_counter()
+    for _ in range(n):
+        character_id = random.randint(1, args.characters)
+        index.add(character_id, {"name": random.choice(vocabulary), "description": text(args.description_words), "persona": text(args.persona_words)})
+    update_ms = (time.perf_counter() - started) * 1000 / n
+
+    report = {
+        "benchmark": "character_search",
+        "characters": args.characters,
+        "vocabulary": args.vocabulary,
+        "words_per_character": args.description_words + args.persona_words + 2,
+        "build_seconds": round(build_seconds, 2),
+        "build_rate_per_s": round(args.characters / build_seconds),
+        "index_rss_mb": round(index_mb, 1),
+        "update_mean_ms": round(update_ms, 3),
+        "index": index.stats(),
+        "queries": kinds,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,159 @@
+import json
+import random
+import hashlib
+import asyncio
+import argparse
+from collections import OrderedDict
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Stand-in for the OpenRouter chat completions API with injectable latency and failures.
+# Point the app at it with OPENROUTER_BASE_URL=http://127.0.0.1:8799/api/v1. Faults can be
+# changed while it runs: curl -X POST localhost:8799/_faults -d '{"failure_rate": 0.3}', and
+# overridden per model: -d '{"models": {"some/model": {"latency": 5}}}'
+
+parser = argparse.ArgumentParser(description="Mock OpenRouter server for load and resilience tests")
+parser.add_argument("--host", default="127.0.0.1")
+parser.add_argument("--port", type=int, default=8799)
+parser.add_argument("--latency", type=float, default=0.05, help="seconds before a response starts")
+parser.add_argument("--jitter", type=float, default=0.02, help="uniform extra latency, in seconds")
+parser.add_argument("--slow-rate", type=float, default=0.0, help="fraction of calls that take --slow-latency instead")
+parser.add_argument("--slow-latency", type=float, default=2.0)
+parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of calls that fail with --failure-status")
+parser.add_argument("--failure-status", type=int, default=503)
+parser.add_argument("--retry-after", type=float, help="Retry-After header sent with 429 responses")
+parser.add_argument("--token-delay", type=float, default=0.01, help="seconds between streamed tokens")
+parser.add_argument("--reply-words", type=int, default=40)
+parser.add_argument("--prefill-per-1k", type=float, default=0.0, help="extra seconds per 1000 prompt tokens not served from the prompt cache")
+parser.add_argument("--prompt-cache-size", type=int, default=100_000, help="message-boundary prefixes the simulated prompt cache keeps")
+
+FAULTS = {}
+counters = {"requests": 0, "streams": 0, "failures": 0, "slow": 0, "by_model": {}, "prompt_tokens": 0, "cached_prompt_tokens": 0}
+# Like a provider's automatic prompt caching: a request reuses the prefill of the longest
+# run of leading messages that an earlier request to the same model sent byte for byte
+PROMPT_CACHE = OrderedDict()
+
+app = FastAPI()
+
+
+def reply_text(body, faults):
+    words = faults["reply_words"]
+    return " ".join(f"word{i}" for i in range(words)) + f" ({len(body['messages'])} messages)"
+
+
+def content_length(message):
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return sum(len(part.get("text") or "") for part in content)
+    return len(content)
+
+
+def prompt_cache_lookup(body, faults):
+    # (prompt tokens, of which cached) after recording every message-boundary prefix
+    digest = hashlib.sha256(body["model"].encode())
+    length = cached = 0
+    for message in body["messages"]:
+        digest.update(json.dumps(message, sort_keys=True).encode())
+        length += content_length(message)
+        key = digest.hexdigest()
+        if key in PROMPT_CACHE and cached == length - content_length(message):
+            PROMPT_CACHE.move_to_end(key)
+            cached = length
+        PROMPT_CACHE[key] = True
+    while len(PROMPT_CACHE) > faults["prompt_cache_size"]:
+        PROMPT_CACHE.popitem(last=False)
+    return length // 4, cached // 4
+
+
+def usage(prompt_tokens, cached_tokens, text):
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": len(text) // 4,
+        "total_tokens": prompt_tokens + len(text) // 4,
+        "prompt_tokens_details": {"cached_tokens": cached_tokens},
+    }
+
+
+@app.post("/api/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    counters["requests"] += 1
+    counters["by_model"][body["model"]] = counters["by_model"].get(body["model"], 0) + 1
+    faults = {**FAULTS, **FAULTS["models"].get(body["model"], {})}
+    if random.random() < faults["failure_rate"]:
+        counters["failures"] += 1
+        headers = {}
+        if faults["failure_status"] == 429 and faults["retry_after"] is not None:
+            headers["Retry-After"] = str(faults["retry_after"])
+        return JSONResponse({"error": {"message": "injected failure", "code": faults["failure_status"]}}, status_code=faults["failure_status"], headers=headers)
+
+    if random.random() < faults["slow_rate"]:
+        counters["slow"] += 1
+        delay = faults["slow_latency"]
+    else:
+        delay = faults["latency"] + random.uniform(0, faults["jitter"])
+    prompt_tokens, cached_tokens = prompt_cache_lookup(body, faults)
+    counters["prompt_tokens"] += prompt_tokens
+    counters["cached_prompt_tokens"] += cached_tokens
+    await asyncio.sleep(delay + (prompt_tokens - cached_tokens) / 1000 * faults["prefill_per_1k"])
+
+    text = reply_text(body, faults)
+    if body.get("stream"):
+        counters["streams"] += 1
+
+        async def events():
+            for word in text.split(" "):
+                yield "data: " + json.dumps({"choices": [{"delta": {"content": word + " "}}]}) + "\n\n"
+                await asyncio.sleep(faults["token_delay"])
+            yield "data: " + json.dumps({"choices": [{"delta": {}, "finish_reason": "stop"}], "usage": usage(prompt_tokens, cached_tokens, text)}) + "\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return {
+        "id": f"mock-{counters['requests']}",
+        "model": body["model"],
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+        "usage": usage(prompt_tokens, cached_tokens, text),
+    }
+
+
+@app.post("/_faults")
+async def set_faults(request: Request):
+    changes = await request.json()
+    FAULTS.update({key: value for key, value in changes.items() if key in FAULTS})
+    return FAULTS
+
+
+@app.get("/_stats")
+async def stats():
+    return {**counters, "faults": FAULTS}
+
+
+def configure(args):
+    FAULTS.update({
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "slow_rate": args.slow_rate,
+        "slow_latency": args.slow_latency,
+        "failure_rate": args.failure_rate,
+        "failure_status": args.failure_status,
+        "retry_after": args.retry_after,
+        "token_delay": args.token_delay,
+        "reply_words": args.reply_words,
+        "prefill_per_1k": args.prefill_per_1k,
+        "prompt_cache_size": args.prompt_cache_size,
+        "models": {},
+    })
+
+
+# Defaults when imported (e.g. `uvicorn benchmarks.mock_openrouter:app`)
+configure(parser.parse_args([]))
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    args = parser.parse_args()
+    configure(args)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,137 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+CODE_CACHE_PATH = os.getenv("CODE_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "code_cache.sqlite3"))
+CODE_CACHE_TTL = float(os.getenv("CODE_CACHE_TTL", str(7 * 24 * 3600)))
+# Total size of the outputs the cache may point at before least recently used entries go
+CODE_CACHE_MAX_BYTES = int(os.getenv("CODE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+
+def normalize_code(code: str) -> str:
+    # Line endings, trailing whitespace and surrounding blank lines do not change what the model sees
+    lines = [line.rstrip() for line in code.replace("\r\n", "\n").replace("\r", "\n").split("\n")]
+    return "\n".join(lines).strip("\n")
+
+
+def cache_key(operation: str, language: str, route: str, code: str) -> str:
+    # route is the model router's version of the task (its models); any model it picks gives
+    # an acceptable answer, but a registry change that swaps them starts the cache afresh
+    payload = "\0".join([operation, language.strip().lower(), route, normalize_code(code)])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CodeOperationCache:
+    # Maps a normalized request to the blob-store hash of its output; the output itself lives
+    # in the blob store, so a hit costs one index lookup and one blob read and writes nothing
+
+    def __init__(self, path=CODE_CACHE_PATH, ttl=CODE_CACHE_TTL, max_bytes=CODE_CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, ipfs_hash TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_entries_last_access ON entries (last_access)")
+        self.total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT ipfs_hash, size, created_at FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            ipfs_hash, size, created_at = row
+            if created_at + self.ttl < now:
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.total_bytes -= size
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return ipfs_hash
+
+    def put_many(self, entries):
+        # entries: (key, ipfs_hash, size) tuples, written in one transaction
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for key, ipfs_hash, size in entries:
+                    old = self._conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+                    if old:
+                        self.total_bytes -= old[0]
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO entries (key, ipfs_hash, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                        (key, ipfs_hash, size, now, now),
+                    )
+                    self.total_bytes += size
+                self._evict()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                self.total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+                raise
+
+    def put(self, key, ipfs_hash, size):
+        self.put_many([(key, ipfs_hash, size)])
+
+    def invalidate(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            if row:
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.total_bytes -= row[0]
+
+    def _evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+        # Expired entries go first, then least recently used ones
+        expired = self._conn.execute("DELETE FROM entries WHERE created_at < ?", (time.time() - self.ttl,))
+        if expired.rowcount:
+            self.evictions += expired.rowcount
+            self.total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        while self.total_bytes > self.max_bytes:
+            rows = self._conn.execute("SELECT key, size FROM entries ORDER BY last_access LIMIT 100").fetchall()
+            if not rows:
+                self.total_bytes = 0
+                break
+            for key, size in rows:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.total_bytes -= size
+                self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {
+            "entries": entries,
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypasses": self.bypasses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+code_cache = CodeOperationCache()
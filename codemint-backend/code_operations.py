@@ -1,11 +1,18 @@
 import os
-import openai
+import json
+import asyncio
+from typing import List
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from app.ipfs_utils import add_to_ipfs, get_from_ipfs
+from starlette.concurrency import run_in_threadpool
+from app import upstream
+from app.model_router import model_router
+from app.singleflight import SingleFlight, request_key
+from ipfs_utils import add_to_ipfs, get_from_ipfs
+from code_cache import code_cache, cache_key
 import logging
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
@@ -14,95 +21,213 @@ class CodeSnippet(BaseModel):
     language: str
     code: str
 
-# Set up OpenRouter client
-openai.api_base = "https://openrouter.ai/api/v1"
-openai.api_key = os.getenv("OPENROUTER_API_KEY")
+class BatchRequest(BaseModel):
+    snippets: List[CodeSnippet]
+    operations: List[str]
+    no_cache: bool = False
 
-def generate_code_with_ai(language: str, prompt: str):
+# Concurrent upstream calls allowed per operation, and how long one may take including the wait for a slot
+OPERATION_LIMITS = {
+    "generate": int(os.getenv("CODE_GENERATE_CONCURRENCY", "16")),
+    "optimize": int(os.getenv("CODE_OPTIMIZE_CONCURRENCY", "16")),
+    "debug": int(os.getenv("CODE_DEBUG_CONCURRENCY", "16")),
+}
+OPERATION_TIMEOUTS = {
+    "generate": float(os.getenv("CODE_GENERATE_TIMEOUT", "90")),
+    "optimize": float(os.getenv("CODE_OPTIMIZE_TIMEOUT", "90")),
+    "debug": float(os.getenv("CODE_DEBUG_TIMEOUT", "90")),
+}
+
+# Fan-out width of one batch request, and the largest batch we accept
+BATCH_CONCURRENCY = int(os.getenv("CODE_BATCH_CONCURRENCY", "32"))
+BATCH_MAX_ITEMS = int(os.getenv("CODE_BATCH_MAX_ITEMS", "2000"))
+
+# Created on first use so they bind to the running event loop
+_semaphores = {}
+
+# Identical in-flight calls (same operation and prompt) share one upstream request and take one slot
+code_flight = SingleFlight("code")
+
+async def _limited_completion(operation: str, messages):
+    semaphore = _semaphores.get(operation)
+    if semaphore is None:
+        semaphore = _semaphores[operation] = asyncio.Semaphore(OPERATION_LIMITS[operation])
+    async with semaphore:
+        response = await model_router.chat_completion("code", messages)
+    return response["choices"][0]["message"]["content"]
+
+async def run_code_operation(operation: str, messages):
+    try:
+        key = request_key(operation, messages)
+        shared = code_flight.do(key, lambda: _limited_completion(operation, messages))
+        return await asyncio.wait_for(shared, timeout=OPERATION_TIMEOUTS[operation])
+    except asyncio.TimeoutError:
+        logger.error("Timed out in %s after %ss", operation, OPERATION_TIMEOUTS[operation])
+        raise HTTPException(status_code=504, detail=f"{operation} timed out")
+    except upstream.UpstreamUnavailable as e:
+        logger.warning("Skipped %s: %s", operation, e)
+        raise HTTPException(status_code=503, detail=f"{operation} temporarily unavailable", headers={"Retry-After": str(int(e.retry_after or 1) + 1)})
+
+async def generate_code_with_ai(language: str, prompt: str):
     try:
-        response = openai.ChatCompletion.create(
-            model="microsoft/phi-3.5-mini-128k-instruct",
-            messages=[
-                {"role": "system", "content": f"You are an expert programmer proficient in multiple programming languages. Generate high-quality, efficient, and well-documented code in {language} based on the user's prompt."},
-                {"role": "user", "content": f"Generate {language} code for: {prompt}"}
-            ]
-        )
-        return response.choices[0].message['content']
+        return await run_code_operation("generate", [
+            {"role": "system", "content": f"You are an expert programmer proficient in multiple programming languages. Generate high-quality, efficient, and well-documented code in {language} based on the user's prompt."},
+            {"role": "user", "content": f"Generate {language} code for: {prompt}"}
+        ])
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error in generate_code_with_ai: {str(e)}")
+        logger.error("Error in generate_code_with_ai: %s", e)
         raise
 
-def optimize_code_with_ai(language: str, code: str):
+async def optimize_code_with_ai(language: str, code: str):
     try:
-        response = openai.ChatCompletion.create(
-            model="microsoft/phi-3.5-mini-128k-instruct",
-            messages=[
-                {"role": "system", "content": f"You are an expert programmer specializing in code optimization for various languages. Analyze the given {language} code and provide an optimized version with explanations for your changes."},
-                {"role": "user", "content": f"Optimize this {language} code:\n\n{code}"}
-            ]
-        )
-        return response.choices[0].message['content']
+        return await run_code_operation("optimize", [
+            {"role": "system", "content": f"You are an expert programmer specializing in code optimization for various languages. Analyze the given {language} code and provide an optimized version with explanations for your changes."},
+            {"role": "user", "content": f"Optimize this {language} code:\n\n{code}"}
+        ])
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error in optimize_code_with_ai: {str(e)}")
+        logger.error("Error in optimize_code_with_ai: %s", e)
         raise
 
-def debug_code_with_ai(language: str, code: str):
+async def debug_code_with_ai(language: str, code: str):
     try:
-        response = openai.ChatCompletion.create(
-            model="microsoft/phi-3.5-mini-128k-instruct",
-            messages=[
-                {"role": "system", "content": f"You are an expert debugger proficient in multiple programming languages. Analyze the given {language} code, identify any issues or potential improvements, and provide a detailed explanation of your findings."},
-                {"role": "user", "content": f"Debug this {language} code and provide a list of issues and suggestions:\n\n{code}"}
-            ]
-        )
-        return response.choices[0].message['content']
+        return await run_code_operation("debug", [
+            {"role": "system", "content": f"You are an expert debugger proficient in multiple programming languages. Analyze the given {language} code, identify any issues or potential improvements, and provide a detailed explanation of your findings."},
+            {"role": "user", "content": f"Debug this {language} code and provide a list of issues and suggestions:\n\n{code}"}
+        ])
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error in debug_code_with_ai: {str(e)}")
+        logger.error("Error in debug_code_with_ai: %s", e)
         raise
 
+def _cached_output(key: str):
+    ipfs_hash = code_cache.get(key)
+    if ipfs_hash is None:
+        return None, None
+    output = get_from_ipfs(ipfs_hash)
+    if output is None:
+        # The blob is gone; forget the entry so the next call repopulates it
+        code_cache.invalidate(key)
+        return None, None
+    return output, ipfs_hash
+
+async def memoized_operation(operation: str, language: str, code: str, call, bypass: bool = False):
+    # Returns (output, ipfs_hash, cached). A hit reuses the stored blob and writes nothing.
+    key = cache_key(operation, language, model_router.route_version("code"), code)
+    if bypass:
+        code_cache.bypasses += 1
+    else:
+        output, ipfs_hash = await run_in_threadpool(_cached_output, key)
+        if output is not None:
+            return output, ipfs_hash, True
+    output = await call()
+    ipfs_hash = await run_in_threadpool(add_to_ipfs, output)
+    if ipfs_hash:
+        await run_in_threadpool(code_cache.put, key, ipfs_hash, len(output))
+    return output, ipfs_hash, False
+
 @router.post("/generate")
-async def generate_code(language: str, prompt: str):
+async def generate_code(language: str, prompt: str, no_cache: bool = False):
     try:
-        generated_code = generate_code_with_ai(language, prompt)
-        ipfs_hash = add_to_ipfs(generated_code)
+        generated_code, ipfs_hash, cached = await memoized_operation("generate", language, prompt, lambda: generate_code_with_ai(language, prompt), bypass=no_cache)
         if ipfs_hash:
-            return {"generated_code": generated_code, "ipfs_hash": ipfs_hash, "language": language}
+            return {"generated_code": generated_code, "ipfs_hash": ipfs_hash, "language": language, "cached": cached}
         raise HTTPException(status_code=500, detail="Failed to store code in IPFS")
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error in generate_code: {str(e)}")
+        logger.error("Error in generate_code: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/optimize")
-async def optimize_code(snippet: CodeSnippet):
+async def optimize_code(snippet: CodeSnippet, no_cache: bool = False):
     try:
-        optimized_code = optimize_code_with_ai(snippet.language, snippet.code)
-        ipfs_hash = add_to_ipfs(optimized_code)
+        optimized_code, ipfs_hash, cached = await memoized_operation("optimize", snippet.language, snippet.code, lambda: optimize_code_with_ai(snippet.language, snippet.code), bypass=no_cache)
         if ipfs_hash:
-            return {"optimized_code": optimized_code, "ipfs_hash": ipfs_hash, "language": snippet.language}
+            return {"optimized_code": optimized_code, "ipfs_hash": ipfs_hash, "language": snippet.language, "cached": cached}
         raise HTTPException(status_code=500, detail="Failed to store code in IPFS")
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error in optimize_code: {str(e)}")
+        logger.error("Error in optimize_code: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/debug")
-async def debug_code(snippet: CodeSnippet):
+async def debug_code(snippet: CodeSnippet, no_cache: bool = False):
     try:
-        debug_info = debug_code_with_ai(snippet.language, snippet.code)
-        ipfs_hash = add_to_ipfs(debug_info)
+        debug_info, ipfs_hash, cached = await memoized_operation("debug", snippet.language, snippet.code, lambda: debug_code_with_ai(snippet.language, snippet.code), bypass=no_cache)
         if ipfs_hash:
-            return {"debug_info": debug_info, "ipfs_hash": ipfs_hash, "language": snippet.language}
+            return {"debug_info": debug_info, "ipfs_hash": ipfs_hash, "language": snippet.language, "cached": cached}
         raise HTTPException(status_code=500, detail="Failed to store debug info in IPFS")
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error in debug_code: {str(e)}")
+        logger.error("Error in debug_code: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
+BATCH_OPERATIONS = {
+    "generate": lambda snippet: generate_code_with_ai(snippet.language, snippet.code),
+    "optimize": lambda snippet: optimize_code_with_ai(snippet.language, snippet.code),
+    "debug": lambda snippet: debug_code_with_ai(snippet.language, snippet.code),
+}
+
+@router.post("/batch")
+async def batch_code_operations(batch: BatchRequest):
+    unknown = [op for op in batch.operations if op not in BATCH_OPERATIONS]
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Unknown operations: {', '.join(unknown)}")
+    items = [(index, op, snippet) for index, snippet in enumerate(batch.snippets) for op in batch.operations]
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Batch of {len(items)} items exceeds the limit of {BATCH_MAX_ITEMS}")
+
+    async def results():
+        fan_out = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+        async def run_item(index, op, snippet):
+            async with fan_out:
+                try:
+                    # Stored (and cached) before its line is sent, so every hash a client sees
+                    # is the one the store returned and can already be retrieved
+                    output, ipfs_hash, cached = await memoized_operation(op, snippet.language, snippet.code, lambda: BATCH_OPERATIONS[op](snippet), bypass=batch.no_cache)
+                    if not ipfs_hash:
+                        return {"index": index, "operation": op, "language": snippet.language, "error": "Failed to store output in IPFS"}
+                    return {"index": index, "operation": op, "language": snippet.language, "output": output, "ipfs_hash": ipfs_hash, "cached": cached}
+                except Exception as e:
+                    detail = e.detail if isinstance(e, HTTPException) else str(e)
+                    return {"index": index, "operation": op, "language": snippet.language, "error": detail}
+
+        tasks = [asyncio.ensure_future(run_item(*item)) for item in items]
+        failed = 0
+        try:
+            # One NDJSON line per item, in completion order
+            for next_done in asyncio.as_completed(tasks):
+                result = await next_done
+                failed += "error" in result
+                yield json.dumps(result) + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+        yield json.dumps({"done": True, "items": len(items), "failed": failed}) + "\n"
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
 @router.get("/retrieve/{ipfs_hash}")
 async def retrieve_from_ipfs(ipfs_hash: str):
     try:
-        content = get_from_ipfs(ipfs_hash)
+        content = await run_in_threadpool(get_from_ipfs, ipfs_hash)
         if content:
             return {"content": content}
         raise HTTPException(status_code=404, detail="Content not found in IPFS")
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error in retrieve_from_ipfs: {str(e)}")
+        logger.error("Error in retrieve_from_ipfs: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/code-cache/stats")
+async def code_cache_stats():
+    return {**await run_in_threadpool(code_cache.stats), "coalescing": code_flight.stats()}
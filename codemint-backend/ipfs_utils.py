@@ -1,41 +1,164 @@
+import os
+import re
+import base64
+import hashlib
 import logging
-from uuid import uuid4
+import tempfile
+import threading
+from collections import OrderedDict
+from app.tracing import traced
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-class MockIPFSClient:
-    def __init__(self):
-        self.storage = {}
+# "local" keeps blobs on disk under BLOB_STORE_PATH; "ipfs" talks to a running IPFS daemon
+BLOB_STORE = os.getenv("BLOB_STORE", "local")
+BLOB_STORE_PATH = os.getenv("BLOB_STORE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "blobstore"))
+BLOB_CACHE_BYTES = int(os.getenv("BLOB_CACHE_BYTES", str(32 * 1024 * 1024)))
+# Blobs at least this large are read from disk every time rather than kept in the hot cache
+BLOB_CACHE_MAX_BLOB = int(os.getenv("BLOB_CACHE_MAX_BLOB", str(1024 * 1024)))
+IPFS_API_ADDR = os.getenv("IPFS_API_ADDR", "/dns/localhost/tcp/5001/http")
 
-    def add_str(self, content):
-        hash = str(uuid4())
-        self.storage[hash] = content
-        return hash
+# CIDv1 header for a raw block addressed by sha2-256: version 1, codec raw, multihash sha2-256, 32 bytes
+_CID_PREFIX = bytes([0x01, 0x55, 0x12, 0x20])
+_CID_PATTERN = re.compile(r"^b[a-z2-7]{58}$")
 
-    def cat(self, hash):
-        return self.storage.get(hash, "").encode('utf-8')
 
-mock_client = MockIPFSClient()
+def compute_cid(data: bytes) -> str:
+    # Same CID an IPFS node reports for a single raw block, so identical content always maps
+    # to the same address and is stored once
+    digest = hashlib.sha256(data).digest()
+    return "b" + base64.b32encode(_CID_PREFIX + digest).decode("ascii").lower().rstrip("=")
+
+
+class LocalBlobStore:
+    def __init__(self, root=BLOB_STORE_PATH, cache_bytes=BLOB_CACHE_BYTES, max_cached_blob=BLOB_CACHE_MAX_BLOB):
+        self.root = root
+        self.cache_bytes = cache_bytes
+        self.max_cached_blob = max_cached_blob
+        self._cache = OrderedDict()  # cid -> bytes, least recently used first
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.dedup_hits = 0
+
+    def _path(self, cid):
+        # Two levels of 1024 directories keep every directory small at millions of blobs
+        return os.path.join(self.root, cid[-4:-2], cid[-2:], cid)
+
+    def _remember(self, cid, data):
+        if len(data) >= self.max_cached_blob or len(data) > self.cache_bytes:
+            return
+        with self._lock:
+            if cid in self._cache:
+                self._cache.move_to_end(cid)
+                return
+            self._cache[cid] = data
+            self._cached_bytes += len(data)
+            while self._cached_bytes > self.cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= len(evicted)
+
+    def add(self, data: bytes) -> str:
+        cid = compute_cid(data)
+        path = self._path(cid)
+        if os.path.exists(path):
+            self.dedup_hits += 1
+        else:
+            directory = os.path.dirname(path)
+            os.makedirs(directory, exist_ok=True)
+            # Write to a temp file and rename so readers never see a partial blob
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+        self._remember(cid, data)
+        return cid
+
+    def get(self, cid: str):
+        if not _CID_PATTERN.match(cid):
+            return None
+        with self._lock:
+            data = self._cache.get(cid)
+            if data is not None:
+                self._cache.move_to_end(cid)
+                self.hits += 1
+                return data
+        self.misses += 1
+        path = self._path(cid)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        self._remember(cid, data)
+        return data
+
+    def stats(self):
+        return {
+            "cached_blobs": len(self._cache),
+            "cached_bytes": self._cached_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "dedup_hits": self.dedup_hits,
+        }
+
+
+class IPFSDaemonStore:
+    def __init__(self, addr=IPFS_API_ADDR):
+        import ipfshttpclient
+        self.client = ipfshttpclient.connect(addr)
+
+    def add(self, data: bytes) -> str:
+        return self.client.add_bytes(data, cid_version=1, raw_leaves=True)
+
+    def get(self, cid: str):
+        try:
+            return self.client.cat(cid)
+        except Exception:
+            return None
+
+    def stats(self):
+        return {}
+
+
+def create_store(kind=BLOB_STORE):
+    if kind == "ipfs":
+        logger.info("Using IPFS daemon at %s", IPFS_API_ADDR)
+        return IPFSDaemonStore()
+    logger.info("Using local blob store at %s", BLOB_STORE_PATH)
+    return LocalBlobStore()
+
+
+store = create_store()
 
 def connect_to_ipfs():
-    logger.info("Connected to mock IPFS client")
-    return mock_client
+    return store
 
+@traced
 def add_to_ipfs(content):
     try:
-        res = mock_client.add_str(content)
-        logger.info(f"Successfully added content to mock IPFS with hash: {res}")
+        res = store.add(content.encode('utf-8'))
+        logger.info("Successfully added content to blob store with hash: %s", res)
         return res
     except Exception as e:
-        logger.error(f"Error adding content to mock IPFS: {str(e)}")
+        logger.error("Error adding content to blob store: %s", e)
     return None
 
+@traced
 def get_from_ipfs(hash):
     try:
-        content = mock_client.cat(hash)
-        logger.info(f"Successfully retrieved content from mock IPFS for hash: {hash}")
+        content = store.get(hash)
+        if content is None:
+            logger.warning("Content not found in blob store for hash: %s", hash)
+            return None
+        logger.info("Successfully retrieved content from blob store for hash: %s", hash)
         return content.decode('utf-8')
     except Exception as e:
-        logger.error(f"Error retrieving content from mock IPFS: {str(e)}")
-    return None
\ No newline at end of file
+        logger.error("Error retrieving content from blob store: %s", e)
+    return None
@@ -1,15 +1,37 @@
-from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
-from app.api.endpoints import chat
-from app.database import engine
-from app import models
+from app.logging_config import configure_logging, shutdown_logging
+
+# Before anything else is imported, so lines logged at import time are formatted and queued too
+configure_logging()
+
+from fastapi import FastAPI, Response  # noqa: E402
+from fastapi.middleware.cors import CORSMiddleware  # noqa: E402
+from app.api.endpoints import chat  # noqa: E402
+from app.features.character_creation import routes as character_routes  # noqa: E402
+from app.features.character_creation import crud as character_crud  # noqa: E402
+from app.features.character_creation.search import character_search  # noqa: E402
+from app.database import engine, async_engine  # noqa: E402
+from app import models, upstream, summarization, persistence, cache, tracing, archival  # noqa: E402
+from app.model_router import model_router  # noqa: E402
+from app.admission import AdmissionMiddleware, admission  # noqa: E402
+from app.metrics import MetricsMiddleware, instrument_engine  # noqa: E402
+from app.tracing import TracingMiddleware  # noqa: E402
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST  # noqa: E402
+import code_operations  # noqa: E402
 
 # Initialize the database models
 models.Base.metadata.create_all(bind=engine)
 
+# Count database round trips for /metrics
+instrument_engine(engine, "sync")
+instrument_engine(async_engine.sync_engine, "async")
+
 # Initialize the FastAPI app
 app = FastAPI()
 
+# Shed load with 429 + Retry-After before it reaches the routers; added first so the CORS
+# middleware still wraps the rejections
+app.add_middleware(AdmissionMiddleware)
+
 # Add CORS middleware to allow requests from localhost:3000
 app.add_middleware(
     CORSMiddleware,
@@ -17,10 +39,65 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Not CORS-safelisted, so the browser hides them unless exposed: conditional GETs and
+    # keyset pagination of the character list need them
+    expose_headers=["ETag", "X-Next-Cursor", "Link"],
 )
 
-# Include the chat router
+# Outermost, so route latency includes time spent queued or shed by admission control
+app.add_middleware(MetricsMiddleware)
+# Root span per request, around everything else
+app.add_middleware(TracingMiddleware)
+
+# Include the chat, character and code operation routers
 app.include_router(chat.router)
+app.include_router(character_routes.router)
+app.include_router(code_operations.router)
+
+# Open and close the shared upstream connection pool and background workers with the app
+@app.on_event("startup")
+async def startup():
+    tracing.setup()
+    await upstream.startup()
+    await persistence.startup()
+    await summarization.startup()
+    await character_crud.startup()
+    await character_search.startup()
+    await archival.startup()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await archival.shutdown()
+    await character_search.shutdown()
+    await summarization.shutdown()
+    await persistence.shutdown()
+    await upstream.shutdown()
+    await cache.shutdown()
+    await async_engine.dispose()
+    tracing.shutdown()
+    shutdown_logging()
+
+@app.get("/upstream/stats")
+async def upstream_stats():
+    return upstream.stats()
+
+@app.get("/metrics")
+def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/archive/stats")
+async def archive_stats():
+    # Space held by the cold tier, and rehydration latency seen by this process
+    return await archival.stats()
+
+@app.get("/admission/stats")
+async def admission_stats():
+    return admission.stats()
+
+@app.get("/models/stats")
+async def model_stats():
+    # Registry, rolling health per model, current ranking per task and recent routing decisions
+    return model_router.stats()
 
 @app.get("/")
 def read_root():
@@ -0,0 +1,12 @@
+import os
+import sys
+
+# The backend and its benchmarks (for mock_openrouter) on the path, as the benchmark scripts do
+BACKEND = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, BACKEND)
+sys.path.insert(0, os.path.join(BACKEND, "benchmarks"))
+
+# The app reads these at import time; nothing here needs a real database or upstream
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("OPENROUTER_API_KEY", "test")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
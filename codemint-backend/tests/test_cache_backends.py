@@ -0,0 +1,128 @@
+import json
+import asyncio
+import pytest
+from app.cache import ConversationState, SessionStateCache, SessionStateStore, SESSION_CACHE_TTL
+from app.cache_backends import RedisBackend, InMemoryBackend, VersionedCache, create_backend
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+@pytest.fixture
+def server():
+    # One fake Redis server; each backend built on it plays a separate worker process
+    return fakeredis.FakeServer()
+
+
+def worker(server):
+    # Only from inside a coroutine: the client binds to the running loop (Python 3.9 has no
+    # loop to find outside one)
+    return RedisBackend(client=fakeredis.FakeAsyncRedis(server=server))
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_create_backend_picks_redis_for_redis_urls():
+    async def scenario():
+        # Builds a client without connecting to anything
+        return create_backend("redis://localhost:6379/0"), create_backend("memory://")
+
+    redis_backend, memory_backend = run(scenario())
+    assert isinstance(redis_backend, RedisBackend)
+    assert isinstance(memory_backend, InMemoryBackend)
+
+
+def test_redis_backend_round_trip(server):
+    async def scenario():
+        backend = worker(server)
+        assert await backend.get("missing") is None
+        await backend.set("key", "value", ttl=30)
+        assert await backend.get("key") == b"value"
+        assert 0 < await backend.client.ttl("key") <= 30
+        await backend.set("forever", "value")
+        assert await backend.client.ttl("forever") == -1
+        assert await backend.incr("counter") == 1
+        assert await backend.incr("counter") == 2
+        await backend.delete("key")
+        assert await backend.get("key") is None
+        await backend.close()
+
+    run(scenario())
+
+
+def test_versioned_cache_get_set_invalidate(server):
+    async def scenario():
+        cache = VersionedCache(worker(server), "character", ttl=60)
+        assert await cache.get(7) == (None, 0)
+        assert await cache.set(7, {"name": "Ada"}) == 0
+        assert await cache.get(7) == ({"name": "Ada"}, 0)
+
+        assert await cache.invalidate(7) == 1
+        assert await cache.version(7) == 1
+        # The old value is still stored, but under a version nobody reads any more
+        assert await cache.get(7) == (None, 1)
+        assert json.loads(await cache.backend.get(cache.data_key(7, 0))) == {"name": "Ada"}
+
+        await cache.set(7, {"name": "Grace"})
+        assert await cache.get(7) == ({"name": "Grace"}, 1)
+        # A reader that looked the version up before the bump still sees only its own version
+        assert await cache.get(7, version=0) == ({"name": "Ada"}, 0)
+        return cache.stats()
+
+    stats = run(scenario())
+    assert stats["hits"] == 3
+    assert stats["misses"] == 2
+
+
+def test_versioned_cache_set_at_an_old_version_is_never_read(server):
+    async def scenario():
+        cache = VersionedCache(worker(server), "character")
+        # Read-through: version first, then the row; an update lands in between
+        _, version = await cache.get(3)
+        await cache.invalidate(3)
+        await cache.set(3, {"name": "stale"}, version=version)
+        return await cache.get(3)
+
+    assert run(scenario()) == (None, 1)
+
+
+def test_invalidation_reaches_other_workers(server):
+    async def scenario():
+        first = VersionedCache(worker(server), "character")
+        second = VersionedCache(worker(server), "character")
+        await first.set(1, {"name": "Ada"})
+        assert await second.get(1) == ({"name": "Ada"}, 0)
+        await second.invalidate(1)
+        assert await first.get(1) == (None, 1)
+
+    run(scenario())
+
+
+def test_session_state_is_shared_between_workers(server):
+    def store():
+        return SessionStateStore(SessionStateCache(), VersionedCache(worker(server), "conversation_state", ttl=SESSION_CACHE_TTL))
+
+    message = {"id": 1, "role": "user", "content": "hello"}
+
+    async def scenario():
+        first, second = store(), store()
+        await first.put("session", ConversationState(5, messages=[message]))
+        state = await second.get("session")
+        assert state.conversation_id == 5
+        assert [m["content"] for m in state.messages] == ["hello"]
+
+        # A write through one worker bumps the version, so the other drops its local copy
+        reply = {"id": 2, "role": "assistant", "content": "hi"}
+        await first.append_messages("session", 5, [reply])
+        state = await second.get("session")
+        assert [m["content"] for m in state.messages] == ["hello", "hi"]
+
+        await second.invalidate_conversation(5)
+        assert await first.get("session") is None
+
+        # The session mapping expires with the state rather than living forever
+        mapping_key = first.sessions.data_key("session", 0)
+        assert 0 < await first.shared.backend.client.ttl(mapping_key) <= SESSION_CACHE_TTL
+
+    run(scenario())
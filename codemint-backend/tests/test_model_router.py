@@ -0,0 +1,106 @@
+import asyncio
+import pytest
+from app import upstream
+from app.model_router import ModelRouter, ModelSpec, NoModelAvailable
+
+
+def router():
+    return ModelRouter([ModelSpec(f"model-{n}", ["chat"], tier=3 - n) for n in range(3)])
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    # Every model answers with the status given in `failures` (by name), or succeeds
+    tried = []
+    failures = {}
+
+    async def chat_completion(model, messages, **params):
+        tried.append(model)
+        if model in failures:
+            raise upstream.UpstreamError("injected", status_code=failures[model])
+        return {"model": model}
+
+    async def stream_chat_completion(model, messages, **params):
+        tried.append(model)
+        if model in failures:
+            raise upstream.UpstreamError("injected", status_code=failures[model])
+        yield model
+
+    monkeypatch.setattr(upstream, "chat_completion", chat_completion)
+    monkeypatch.setattr(upstream, "stream_chat_completion", stream_chat_completion)
+    monkeypatch.setattr(upstream, "_breakers", {})
+    return tried, failures
+
+
+async def collect(tokens):
+    return [token async for token in tokens]
+
+
+def test_falls_back_on_a_server_error(calls):
+    tried, failures = calls
+    failures["model-0"] = 503
+    models = router()
+    assert asyncio.run(models.chat_completion("chat", [])) == {"model": "model-1"}
+    assert tried == ["model-0", "model-1"]
+    assert models.models[0].errors == 1
+
+
+def test_client_error_is_raised_without_fallback(calls):
+    tried, failures = calls
+    failures.update({"model-0": 400, "model-1": 400, "model-2": 400})
+    models = router()
+    with pytest.raises(upstream.UpstreamError) as error:
+        asyncio.run(models.chat_completion("chat", []))
+    assert error.value.status_code == 400
+    assert tried == ["model-0"]
+    assert all(model.calls == 0 and model.error_rate == 0 for model in models.models)
+
+
+def test_stream_client_error_is_raised_without_fallback(calls):
+    tried, failures = calls
+    failures["model-0"] = 422
+    models = router()
+    with pytest.raises(upstream.UpstreamError) as error:
+        asyncio.run(collect(models.stream_chat_completion("chat", [])))
+    assert error.value.status_code == 422
+    assert tried == ["model-0"]
+    assert models.models[0].calls == 0
+
+
+def test_stream_falls_back_until_the_first_token(calls):
+    tried, failures = calls
+    failures.update({"model-0": 429, "model-1": 502})
+    assert asyncio.run(collect(router().stream_chat_completion("chat", []))) == ["model-2"]
+    assert tried == ["model-0", "model-1", "model-2"]
+
+
+def test_no_model_available_when_all_fail(calls):
+    tried, failures = calls
+    failures.update({"model-0": 500, "model-1": 500, "model-2": 500})
+    with pytest.raises(NoModelAvailable):
+        asyncio.run(router().chat_completion("chat", []))
+
+
+def test_streams_and_completions_keep_separate_latencies(calls):
+    fast_start, slow_start = ModelSpec("fast-start", ["chat"]), ModelSpec("slow-start", ["chat"])
+    models = ModelRouter([slow_start, fast_start])
+    for _ in range(20):
+        # slow-start finishes whole replies sooner but takes longer to its first token
+        slow_start.observe(2.0)
+        slow_start.observe(1.5, stream=True)
+        fast_start.observe(6.0)
+        fast_start.observe(0.2, stream=True)
+    assert models.rank("chat", "latency", explore=False)[1][0] is slow_start
+    assert models.rank("chat", "latency", explore=False, stream=True)[1][0] is fast_start
+    assert fast_start.latency == pytest.approx(6.0, abs=0.1)
+    assert fast_start.first_token_latency == pytest.approx(0.2, abs=0.1)
+
+
+def test_route_version_follows_the_registry_not_health():
+    models = router()
+    version = models.route_version("chat")
+    models.models[0].observe(failed=True)
+    assert models.route_version("chat") == version
+    swapped = ModelRouter([ModelSpec("model-9", ["chat"])] + models.models[1:])
+    assert swapped.route_version("chat") != version
+    assert models.route_version("code") == ""
@@ -0,0 +1,43 @@
+import asyncio
+from app import crud, persistence
+
+
+def test_stop_keeps_the_batch_being_flushed(monkeypatch):
+    stored = []
+
+    async def slow_write(db, messages, session_ids):
+        await asyncio.sleep(0.05)
+        stored.extend(messages)
+
+    monkeypatch.setattr(crud, "create_chat_turns_async", slow_write)
+    queue = persistence.WriteBehindQueue(flush_interval=0.01)
+
+    async def scenario():
+        await queue.start()
+        assert queue.offer(1, persistence.turn_messages(1, "hello", "hi"))
+        # Stop while the loop is in the middle of writing that batch
+        await asyncio.sleep(0.03)
+        assert queue._lock.locked()
+        await queue.stop()
+
+    asyncio.run(scenario())
+    assert [message.content for message in stored] == ["hello", "hi"]
+    assert queue.messages == [] and not queue.running
+
+
+def test_stop_drains_what_is_still_buffered(monkeypatch):
+    stored = []
+
+    async def write(db, messages, session_ids):
+        stored.extend(messages)
+
+    monkeypatch.setattr(crud, "create_chat_turns_async", write)
+    queue = persistence.WriteBehindQueue(flush_interval=60)
+
+    async def scenario():
+        await queue.start()
+        queue.offer(1, persistence.turn_messages(1, "hello", "hi"))
+        await queue.stop()
+
+    asyncio.run(scenario())
+    assert len(stored) == 2
@@ -0,0 +1,90 @@
+import time
+import asyncio
+import pytest
+from app.resilience import RetryBudget, CircuitBreaker, CircuitOpenError, LatencyTracker, backoff_delay, hedged
+
+
+def test_backoff_delay_is_jittered_below_the_cap():
+    for attempt in range(1, 10):
+        assert 0 <= backoff_delay(attempt, 0.25, 2) <= min(2, 0.25 * 2 ** (attempt - 1))
+
+
+def test_backoff_delay_prefers_retry_after_up_to_the_cap():
+    assert backoff_delay(1, 0.25, 8, retry_after=3) == 3
+    assert backoff_delay(1, 0.25, 8, retry_after=60) == 8
+
+
+def test_retry_budget_earns_a_fraction_per_request():
+    budget = RetryBudget(ratio=0.5, max_tokens=1)
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
+    assert budget.exhausted == 2
+
+
+def test_breaker_opens_then_lets_one_probe_through():
+    breaker = CircuitBreaker(threshold=2, cooldown=0.05)
+    for _ in range(2):
+        breaker.before_call()
+        breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    time.sleep(0.06)
+    breaker.before_call()
+    assert breaker.state == "half_open"
+    # Only the one probe while it is in flight
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert breaker.times_opened == 2
+
+    time.sleep(0.06)
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.stats()["rejected"] == 2
+
+
+def test_breaker_release_frees_the_probe():
+    breaker = CircuitBreaker(threshold=1, cooldown=0)
+    breaker.before_call()
+    breaker.record_failure()
+    breaker.before_call()
+    breaker.release()
+    breaker.before_call()
+    assert breaker.state == "half_open"
+
+
+def test_latency_tracker_quantiles():
+    tracker = LatencyTracker(window=100)
+    assert tracker.quantile(0.95) is None
+    for n in range(1, 101):
+        tracker.observe(n / 100)
+    assert tracker.quantile(0.5) == 0.51
+    assert tracker.quantile(0.95) == 0.96
+
+
+def test_hedged_returns_the_backup_when_the_primary_is_slow():
+    delays = [1.0, 0.0]
+
+    async def call():
+        await asyncio.sleep(delays.pop(0))
+        return "done"
+
+    started = time.monotonic()
+    assert asyncio.run(hedged(call, 0.02, lambda: True)) == ("done", True)
+    assert time.monotonic() - started < 0.5
+
+
+def test_hedged_sends_no_backup_when_not_allowed():
+    async def call():
+        await asyncio.sleep(0.05)
+        return "done"
+
+    assert asyncio.run(hedged(call, 0.01, lambda: False)) == ("done", None)
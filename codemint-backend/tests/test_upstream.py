@@ -0,0 +1,233 @@
+import asyncio
+import httpx
+import pytest
+import mock_openrouter
+from app import upstream
+from app.resilience import RetryBudget
+
+MODEL = "test/model"
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+
+@pytest.fixture
+def mock(monkeypatch):
+    # The upstream client pointed at mock_openrouter in-process, with fresh breakers, budget
+    # and counters, and retries that back off for a millisecond rather than seconds
+    mock_openrouter.configure(mock_openrouter.parser.parse_args(["--latency", "0", "--jitter", "0", "--token-delay", "0", "--reply-words", "3"]))
+    monkeypatch.setattr(mock_openrouter, "counters", {key: {} if isinstance(value, dict) else 0 for key, value in mock_openrouter.counters.items()})
+    monkeypatch.setattr(upstream, "_breakers", {})
+    monkeypatch.setattr(upstream, "_latency", {})
+    monkeypatch.setattr(upstream, "counters", dict.fromkeys(upstream.counters, 0))
+    monkeypatch.setattr(upstream, "retry_budget", RetryBudget(1, 20))
+    monkeypatch.setattr(upstream, "UPSTREAM_MAX_RETRIES", 2)
+    monkeypatch.setattr(upstream, "UPSTREAM_BACKOFF_BASE", 0.001)
+    monkeypatch.setattr(upstream, "UPSTREAM_BREAKER_THRESHOLD", 5)
+    monkeypatch.setattr(upstream, "UPSTREAM_BREAKER_COOLDOWN", 30)
+    monkeypatch.setattr(upstream, "UPSTREAM_HEDGE", False)
+    client = httpx.AsyncClient(app=mock_openrouter.app, base_url="http://mock/api/v1")
+    monkeypatch.setattr(upstream, "_client", client)
+    yield mock_openrouter
+    asyncio.run(client.aclose())
+
+
+def faults(mock, **changes):
+    mock.FAULTS.update(changes)
+
+
+def complete():
+    return asyncio.run(upstream.chat_completion(MODEL, MESSAGES))
+
+
+async def stream():
+    return "".join([token async for token in upstream.stream_chat_completion(MODEL, MESSAGES)])
+
+
+class Scripted:
+    # Stands in for the mock's random module: random() answers from a script, uniform() is 0
+    def __init__(self, *values):
+        self.values = list(values)
+
+    def random(self):
+        return self.values.pop(0)
+
+    def uniform(self, low, high):
+        return low
+
+
+def test_success_passes_through(mock):
+    result = complete()
+    assert result["choices"][0]["message"]["content"].startswith("word0")
+    assert mock.counters["requests"] == 1
+    assert upstream.counters["retries"] == 0
+
+
+def test_stream_relays_tokens(mock):
+    assert asyncio.run(stream()).startswith("word0 word1 word2")
+    assert mock.counters["streams"] == 1
+
+
+def test_5xx_is_retried_then_given_up(mock):
+    faults(mock, failure_rate=1.0, failure_status=503)
+    with pytest.raises(upstream.UpstreamError) as error:
+        complete()
+    assert error.value.status_code == 503
+    assert mock.counters["requests"] == 3
+    assert upstream.counters["retries"] == 2
+    assert upstream.counters["gave_up"] == 1
+
+
+def test_4xx_is_not_retried_and_does_not_trip_the_breaker(mock):
+    faults(mock, failure_rate=1.0, failure_status=400)
+    with pytest.raises(upstream.UpstreamError) as error:
+        complete()
+    assert error.value.status_code == 400
+    assert mock.counters["requests"] == 1
+    assert upstream.breaker_for(MODEL).failures == 0
+
+
+def test_429_waits_for_retry_after(mock, monkeypatch):
+    faults(mock, failure_rate=1.0, failure_status=429, retry_after=0.05)
+    delays = []
+    backoff_delay = upstream.backoff_delay
+
+    def recording_backoff(*args):
+        delays.append(backoff_delay(*args))
+        return delays[-1]
+
+    monkeypatch.setattr(upstream, "backoff_delay", recording_backoff)
+    with pytest.raises(upstream.UpstreamError) as error:
+        complete()
+    assert error.value.status_code == 429
+    assert error.value.retry_after == 0.05
+    assert delays == [0.05, 0.05]
+
+
+def test_stream_open_is_retried(mock, monkeypatch):
+    # Fails once, then succeeds: only the first call draws a failure
+    faults(mock, failure_rate=0.5, failure_status=502)
+    monkeypatch.setattr(mock, "random", Scripted(0.0, 0.9, 0.9))
+    assert asyncio.run(stream()).startswith("word0")
+    assert mock.counters["failures"] == 1
+    assert upstream.counters["retries"] == 1
+
+
+def test_breaker_opens_fails_fast_and_half_opens(mock, monkeypatch):
+    monkeypatch.setattr(upstream, "UPSTREAM_MAX_RETRIES", 0)
+    monkeypatch.setattr(upstream, "UPSTREAM_BREAKER_THRESHOLD", 2)
+    monkeypatch.setattr(upstream, "UPSTREAM_BREAKER_COOLDOWN", 0.05)
+    faults(mock, failure_rate=1.0, failure_status=500)
+    for _ in range(2):
+        with pytest.raises(upstream.UpstreamError):
+            complete()
+    breaker = upstream.breaker_for(MODEL)
+    assert breaker.state == "open"
+
+    # Open: nothing reaches the upstream
+    with pytest.raises(upstream.UpstreamUnavailable) as error:
+        complete()
+    assert error.value.status_code == 503
+    assert 0 < error.value.retry_after <= 0.05
+    assert mock.counters["requests"] == 2
+
+    # After the cooldown a failed probe reopens it, and a good one closes it
+    asyncio.run(asyncio.sleep(0.06))
+    with pytest.raises(upstream.UpstreamError):
+        complete()
+    assert breaker.state == "open"
+    assert breaker.times_opened == 2
+    assert mock.counters["requests"] == 3
+
+    faults(mock, failure_rate=0.0)
+    asyncio.run(asyncio.sleep(0.06))
+    complete()
+    assert breaker.state == "closed"
+    assert upstream.stats()["models"][MODEL]["rejected"] == 1
+
+
+def test_half_open_admits_one_probe_at_a_time(mock, monkeypatch):
+    monkeypatch.setattr(upstream, "UPSTREAM_MAX_RETRIES", 0)
+    monkeypatch.setattr(upstream, "UPSTREAM_BREAKER_THRESHOLD", 1)
+    monkeypatch.setattr(upstream, "UPSTREAM_BREAKER_COOLDOWN", 0.01)
+    faults(mock, failure_rate=1.0, failure_status=503)
+    with pytest.raises(upstream.UpstreamError):
+        complete()
+    faults(mock, failure_rate=0.0, latency=0.1)
+
+    async def probe_and_follow():
+        await asyncio.sleep(0.02)
+        return await asyncio.gather(
+            upstream.chat_completion(MODEL, MESSAGES),
+            upstream.chat_completion(MODEL, MESSAGES),
+            return_exceptions=True,
+        )
+
+    probe, follower = asyncio.run(probe_and_follow())
+    assert "choices" in probe
+    assert isinstance(follower, upstream.UpstreamUnavailable)
+    assert upstream.breaker_for(MODEL).state == "closed"
+
+
+def test_retry_budget_exhaustion_stops_retries(mock, monkeypatch):
+    # One retry in the bucket and none earned back
+    monkeypatch.setattr(upstream, "retry_budget", RetryBudget(0, 1))
+    faults(mock, failure_rate=1.0, failure_status=503)
+    for _ in range(2):
+        with pytest.raises(upstream.UpstreamError):
+            complete()
+    # The first call retried once before the bucket ran dry; the second could not retry at all
+    assert mock.counters["requests"] == 3
+    assert upstream.counters["retries"] == 1
+    assert upstream.counters["gave_up"] == 2
+    assert upstream.stats()["retry_budget_exhausted"] == 2
+
+
+def test_hedge_wins_against_a_slow_response(mock, monkeypatch):
+    monkeypatch.setattr(upstream, "UPSTREAM_HEDGE", True)
+    monkeypatch.setattr(upstream, "UPSTREAM_HEDGE_DEFAULT_DELAY", 0.02)
+    faults(mock, slow_rate=0.5, slow_latency=2.0, latency=0.0)
+    # Primary: no failure, slow. Backup: no failure, fast.
+    monkeypatch.setattr(mock, "random", Scripted(0.9, 0.0, 0.9, 0.9))
+    result = complete()
+    assert "choices" in result
+    assert mock.counters["slow"] == 1
+    assert upstream.counters["hedges_sent"] == 1
+    assert upstream.counters["hedges_won"] == 1
+
+
+def test_no_hedge_for_a_fast_response(mock, monkeypatch):
+    monkeypatch.setattr(upstream, "UPSTREAM_HEDGE", True)
+    monkeypatch.setattr(upstream, "UPSTREAM_HEDGE_DEFAULT_DELAY", 0.5)
+    complete()
+    assert upstream.counters["hedges_sent"] == 0
+    assert upstream.counters["hedges_won"] == 0
+
+
+def test_hedges_draw_on_the_retry_budget(mock, monkeypatch):
+    monkeypatch.setattr(upstream, "UPSTREAM_HEDGE", True)
+    monkeypatch.setattr(upstream, "UPSTREAM_HEDGE_DEFAULT_DELAY", 0.01)
+    monkeypatch.setattr(upstream, "retry_budget", RetryBudget(0, 0))
+    faults(mock, latency=0.05)
+    complete()
+    assert mock.counters["requests"] == 1
+    assert upstream.counters["hedges_sent"] == 0
+    assert upstream.stats()["retry_budget_exhausted"] == 1
+
+
+def test_malformed_stream_chunk_is_an_upstream_error(mock, monkeypatch):
+    def handler(request):
+        return httpx.Response(200, text='data: {"choices": [{"delta": {"content": "ok"}}]}\n\ndata: {not json\n\n')
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="http://mock/api/v1")
+    monkeypatch.setattr(upstream, "_client", client)
+    with pytest.raises(upstream.UpstreamError) as error:
+        asyncio.run(stream())
+    assert "Malformed stream chunk" in str(error.value)
+
+
+def test_malformed_response_is_an_upstream_error(mock, monkeypatch):
+    monkeypatch.setattr(upstream, "UPSTREAM_MAX_RETRIES", 0)
+    client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, text="<html>")), base_url="http://mock/api/v1")
+    monkeypatch.setattr(upstream, "_client", client)
+    with pytest.raises(upstream.UpstreamError):
+        complete()
+    assert upstream.breaker_for(MODEL).failures == 1